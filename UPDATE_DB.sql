@@ -37,6 +37,13 @@ CREATE TABLE IF NOT EXISTS payment_history (
 CREATE INDEX IF NOT EXISTS idx_business_connections_user ON business_connections(user_id);
 CREATE INDEX IF NOT EXISTS idx_subscriptions_active ON subscriptions(user_id, is_active);
 CREATE INDEX IF NOT EXISTS idx_payment_history_user ON payment_history(user_id);
+CREATE INDEX IF NOT EXISTS idx_payment_history_completed ON payment_history(created_at) WHERE status = 'completed';
+CREATE INDEX IF NOT EXISTS idx_payment_history_user_time ON payment_history(user_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_subscriptions_active_type ON subscriptions(subscription_type) WHERE is_active;
+CREATE INDEX IF NOT EXISTS idx_users_authenticated ON users(user_id) WHERE is_authenticated;
+
+-- Пользователи, заблокировавшие бота, исключаются из рассылок
+ALTER TABLE users ADD COLUMN IF NOT EXISTS blocked BOOLEAN DEFAULT FALSE;
 
 -- Таблица админов
 CREATE TABLE IF NOT EXISTS admins (
@@ -70,6 +77,30 @@ CREATE TABLE IF NOT EXISTS referrals (
 CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals(referrer_id);
 CREATE INDEX IF NOT EXISTS idx_referrals_referred ON referrals(referred_id);
 
+-- Одна строка на пользователя в failed_logins (счётчик обновляется через UPSERT)
+DELETE FROM failed_logins f
+USING failed_logins newer
+WHERE f.user_id = newer.user_id AND f.id < newer.id;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_failed_logins_user_unique ON failed_logins(user_id);
+
+-- Индекс для экспорта истории чата (выборка по времени без сортировки)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_owner_chat_time ON messages(owner_id, chat_id, created_at DESC);
+
+-- Индекс для списков выгрузки в админке (index-only scan по владельцу, чату и собеседнику)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_owner_chat_user ON messages(owner_id, chat_id, user_id);
+
+-- Ссылки хранятся массивом text[] вместо строки через ", " (поиск: links @> ARRAY['https://...'])
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'messages' AND column_name = 'links' AND data_type = 'text'
+    ) THEN
+        ALTER TABLE messages ALTER COLUMN links TYPE TEXT[] USING string_to_array(links, ', ');
+    END IF;
+END $$;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_links ON messages USING GIN (links);
+
 -- Комментарии
 COMMENT ON TABLE business_connections IS 'Подключения к Telegram Business API';
 COMMENT ON TABLE subscriptions IS 'Подписки пользователей на бота';
@@ -1,15 +1,18 @@
 # Admin panel callback handlers
 # This file contains all interactive admin panel handlers
 
+import asyncio
+
+
 async def handle_admin_revenue(callback, bot, db_pool):
     """Show revenue statistics with graphs by period"""
-    from bot import get_revenue_by_period
+    from bot import get_revenue_by_periods
     
     # Get revenue for different periods
-    day_stats = await get_revenue_by_period("day")
-    week_stats = await get_revenue_by_period("week")
-    month_stats = await get_revenue_by_period("month")
-    year_stats = await get_revenue_by_period("year")
+    revenue = await get_revenue_by_periods()
+    day_stats, week_stats, month_stats, year_stats = (
+        revenue["day"], revenue["week"], revenue["month"], revenue["year"]
+    )
     
     text = "📊 <b>Статистика прибыли</b>\n\n"
     text += f"📅 <b>За день:</b>\n"
@@ -86,7 +89,7 @@ async def handle_admin_export_csv(callback, bot, db_pool):
     
     # Send CSV file
     csv_file = BufferedInputFile(
-        csv_content.encode('utf-8-sig'),
+        csv_content,
         filename=f"users_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
     )
     
@@ -110,8 +113,7 @@ async def handle_back_to_admin(callback, bot, db_pool):
     is_super = await is_super_admin(user_id)
     
     # Get stats
-    users_stats = await get_users_stats()
-    revenue = await get_revenue_stats()
+    users_stats, revenue = await asyncio.gather(get_users_stats(), get_revenue_stats())
     
     text = "👮 <b>Админ-панель MessageGuardian</b>\n\n"
     text += f"👥 Всего пользователей: <b>{users_stats['total_users']}</b>\n"
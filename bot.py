@@ -1,34 +1,81 @@
 import os
+import platform
+import shutil
 import asyncio
+from functools import lru_cache
 from pathlib import Path
 from typing import Optional
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, F
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.types import Message, BusinessMessagesDeleted, FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton, LabeledPrice, PreCheckoutQuery, CallbackQuery, BufferedInputFile, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, KeyboardButtonRequestUsers, UsersShared
 from aiogram.filters import Command
+from aiogram.filters.callback_data import CallbackData
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
 import asyncpg
 import io
 import csv
-import matplotlib
-matplotlib.use('Agg')  # Use non-interactive backend
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-from collections import defaultdict
+import base64
+import inspect
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+from collections import defaultdict, deque
+from html import escape as _esc
+from contextlib import asynccontextmanager
 
 load_dotenv()
 
 MEDIA_DIR = Path("saved_media")
 MEDIA_DIR.mkdir(exist_ok=True)
 
+# Filesystem whose usage is shown in the DB memory panel
+DISK_ROOT = "C:\\" if platform.system() == "Windows" else "/"
+
+
+def _sticker_ext(sticker) -> str:
+    if sticker.is_video:
+        return "webm"
+    return "tgs" if sticker.is_animated else "webp"
+
+
+def _document_ext(document) -> str:
+    return document.file_name.split('.')[-1] if document.file_name else "file"
+
+
+# Media saved from business messages, in priority order:
+# (message attribute, file name suffix, extension or ext(obj), downloadable getter)
+MEDIA_HANDLERS = (
+    ("photo", "photo", "jpg", lambda obj: obj[-1]),
+    ("video", "video", "mp4", None),
+    ("document", "doc", _document_ext, None),
+    ("sticker", "sticker", _sticker_ext, None),
+    ("voice", "voice", "ogg", None),
+    ("video_note", "videonote", "mp4", None),
+    ("animation", "animation", "mp4", None),
+)
+
+START_PHOTO = "photo_2025-12-29_00-18-36.jpg"  # Welcome photo for /start and the main menu
+
 BOT_PASSWORD = os.getenv("BOT_PASSWORD", "12391")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "825042510"))
 SUPER_ADMIN_ID = 825042510  # Главный админ
 REQUIRED_CHANNEL = "@MessageAssistant"  # Обязательный канал для подписки
+BROADCAST_CONCURRENCY = 20  # Parallel sends during admin broadcast
+BROADCAST_PROGRESS_EVERY = 1000  # Update the admin's status message after this many sends
+BLOCKED_FLUSH_EVERY = 500  # Flag users who blocked the bot in batches of this size during a broadcast
+DELETE_NOTIFY_CONCURRENCY = 10  # Deleted-message notifications sent in parallel per deletion event
+BACKUP_CONCURRENCY = 2  # Chat-clear HTML backups built at the same time (each streams a whole chat to disk)
+SEND_RATE_PER_SECOND = 25  # Bot-wide budget for bulk/outgoing sends (Telegram allows ~30/s)
+HTTP_POOL_LIMIT = 100  # Keep-alive connections to the Bot API shared by polling and broadcast fan-out
+HTTP_TIMEOUT = 90  # Seconds per Bot API request; uploads of large saved media need more than the default 60
 
 # PostgreSQL connection
 DB_HOST = os.getenv("DB_HOST", "localhost")
@@ -40,8 +87,107 @@ DB_PASSWORD = os.getenv("DB_PASSWORD", "1")
 # Global database pool
 db_pool = None
 
+# Queue-backed logger: records are written to stdout by a listener thread, not the event loop
+logger = logging.getLogger("messageassistant")
+logger.setLevel(logging.DEBUG if os.getenv("DEBUG") else logging.INFO)
+logger.propagate = False
+_log_queue = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler(sys.stdout))
+
+# matplotlib is imported on first chart request (see _load_matplotlib)
+_plt = None
+_mdates = None
+
+# DB helpers accept the pool or an already acquired connection
+DBHandle = asyncpg.Pool | asyncpg.Connection
+
+# Media placeholders for HTML chat exports
+_MEDIA_LABELS = {
+    'photo': '📷 Фото', 'photo_reply': '📷 Фото',
+    'video': '🎥 Видео', 'video_reply': '🎥 Видео',
+    'document': '📄 Документ', 'sticker': '🎭 Стикер',
+    'voice': '🎤 Голосовое', 'video_note': '🎬 Видеосообщение',
+    'animation': '🎬 GIF'
+}
+_MEDIA_HTML = {k: f'<div class="message-media">{v}</div>' for k, v in _MEDIA_LABELS.items()}
+_MEDIA_HTML_DEFAULT = '<div class="message-media">📎 Медиа</div>'
+
+
+class TTLCache:
+    """Size-capped mapping whose entries expire ttl seconds after they are set.
+    
+    Keys are kept in insertion order and re-inserted on every set, so the
+    oldest (and first to expire) entries are always at the front; going over
+    maxsize drops expired entries first, then the oldest live ones.
+    """
+    
+    def __init__(self, ttl: float, maxsize: int = 10_000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: dict = {}  # {key: (value, expires_at)}
+    
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        if entry[1] <= time.monotonic():
+            del self._data[key]
+            return default
+        return entry[0]
+    
+    def __setitem__(self, key, value) -> None:
+        self._data.pop(key, None)
+        now = time.monotonic()
+        self._data[key] = (value, now + self.ttl)
+        if len(self._data) > self.maxsize:
+            for old_key in list(self._data):
+                if len(self._data) <= self.maxsize and self._data[old_key][1] > now:
+                    break
+                del self._data[old_key]
+    
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+    
+    def clear(self) -> None:
+        self._data.clear()
+    
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+# Short-lived per-user caches for lookups done on almost every update
+_CACHE_TTL = 30  # seconds
+_CACHE_MAXSIZE = 10_000  # entries per cache
+_sub_cache = TTLCache(_CACHE_TTL, _CACHE_MAXSIZE)  # {user_id: subscription status}
+_auth_cache = TTLCache(_CACHE_TTL, _CACHE_MAXSIZE)  # {user_id: is_authenticated}
+
+# All admin ids, reloaded as one set; admin checks are then a membership test
+_ADMIN_IDS_TTL = 60  # seconds
+admin_ids: frozenset[int] = frozenset()
+_admin_ids_expires_at = 0.0
+
+# business_connection_id -> owner user_id; a connection never changes owner
+_CONNECTION_TTL = 3600  # seconds
+_connection_owner_cache = TTLCache(_CONNECTION_TTL, _CACHE_MAXSIZE)  # {connection_id: user_id}
+
+# Display names of exported chats; they rarely change, so keep them for an hour
+_CHAT_NAME_TTL = 3600  # seconds
+_chat_name_cache = TTLCache(_CHAT_NAME_TTL, _CACHE_MAXSIZE)  # {chat_id: name}
+
+# saved_media usage (bytes, files) shown in the DB memory panel
+_MEDIA_SCAN_TTL = 60  # seconds
+_media_scan_cache: dict[Path, tuple[tuple[int, int], float]] = {}  # {dir: ((size, files), expires_at)}
+
+# Admin dashboard aggregates, recomputed at most once per TTL
+_DASHBOARD_TTL = 60  # seconds
+_dashboard_cache: dict[str, tuple[dict, float]] = {}  # {stats name: (stats, expires_at)}
+
 # Track recent deletions for chat clear detection
-recent_deletions = {}  # {chat_id: [(timestamp, count), ...]}
+RECENT_DELETIONS_WINDOW = 10  # seconds
+recent_deletions: defaultdict[int, deque] = defaultdict(deque)  # {chat_id: deque[(monotonic_ts, count)]}
+recent_deletion_totals: defaultdict[int, int] = defaultdict(int)  # {chat_id: sum of counts in the window}
 
 # FSM States for admin panel
 class AdminStates(StatesGroup):
@@ -58,6 +204,114 @@ class AdminStates(StatesGroup):
 class DuplicateStates(StatesGroup):
     waiting_contact = State()
 
+# Callback data for the admin chat export screens. Cursor fields hold the sort key
+# of the boundary row: direction "a" pages after it, "b" pages before it.
+class ExportUsersPage(CallbackData, prefix="aep"):
+    page: int
+    direction: str | None = None
+    chats_count: int | None = None
+    user_id: int | None = None
+
+
+class ExportUserChatsPage(CallbackData, prefix="auc"):
+    user_id: int
+    page: int = 0
+    direction: str | None = None
+    msg_count: int | None = None
+    chat_id: int | None = None
+    chat_user_id: int | None = None
+
+
+class ExportChatDownload(CallbackData, prefix="adl"):
+    owner_id: int
+    chat_id: int
+
+
+class TokenBucket:
+    """Token-bucket limiter: acquire() waits until a token is available.
+    
+    Refills at rate tokens per second and bursts up to capacity, so callers
+    share one budget instead of each sleeping a fixed interval.
+    """
+    
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+send_limiter = TokenBucket(SEND_RATE_PER_SECOND)
+
+
+async def send_limited(method, *args, **kwargs):
+    """Call a Bot send method under send_limiter, retrying once after TelegramRetryAfter"""
+    for attempt in range(2):
+        await send_limiter.acquire()
+        try:
+            return await method(*args, **kwargs)
+        except TelegramRetryAfter as e:
+            if attempt:
+                raise
+            await asyncio.sleep(e.retry_after)
+
+
+class BlockedRecipients:
+    """Users who blocked the bot during one broadcast, flagged in the DB in batches"""
+    
+    def __init__(self, flush_every: int = BLOCKED_FLUSH_EVERY):
+        self.user_ids: list[int] = []
+        self._flushed = 0
+        self._flush_every = flush_every
+    
+    def __len__(self) -> int:
+        return len(self.user_ids)
+    
+    async def add(self, user_id: int) -> None:
+        self.user_ids.append(user_id)
+        if len(self.user_ids) - self._flushed >= self._flush_every:
+            await self.flush()
+    
+    async def flush(self) -> None:
+        batch = self.user_ids[self._flushed:]
+        self._flushed = len(self.user_ids)
+        try:
+            await mark_users_blocked(batch)
+        except Exception as e:
+            logger.warning("⚠️ Не удалось отметить заблокировавших бота: %s", e)
+
+
+async def run_broadcast(user_ids, send_one, concurrency: int = BROADCAST_CONCURRENCY) -> tuple[int, int]:
+    """Call send_one(user_id) for every id using a fixed pool of workers; returns (sent, total).
+    
+    Workers pull ids from one shared iterator, so only `concurrency` coroutines
+    exist at a time instead of a task per recipient.
+    """
+    ids = iter(user_ids)
+    sent = total = 0
+    
+    async def worker() -> None:
+        nonlocal sent, total
+        for user_id in ids:
+            total += 1
+            if await send_one(user_id):
+                sent += 1
+    
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return sent, total
+
 
 async def init_db():
     """Initialize database connection pool"""
@@ -70,7 +324,10 @@ async def init_db():
         user=DB_USER,
         password=DB_PASSWORD,
         min_size=10,  # Minimum connections
-        max_size=50   # Maximum connections for high load
+        max_size=50,  # Maximum connections for high load
+        # asyncpg prepares every query per connection; keep all of ours cached for good
+        statement_cache_size=1024,
+        max_cached_statement_lifetime=0
     )
     print("✅ PostgreSQL connection pool created")
     
@@ -96,11 +353,35 @@ async def close_db():
         print("✅ PostgreSQL connection pool closed")
 
 
+@asynccontextmanager
+async def _with_conn(db: DBHandle | None = None):
+    """Reuse an already acquired connection or acquire one from the pool"""
+    if isinstance(db, asyncpg.Connection):
+        yield db
+    else:
+        async with (db or db_pool).acquire() as conn:
+            yield conn
+
+
+def _load_matplotlib():
+    """Import matplotlib on first use and cache the modules"""
+    global _plt, _mdates
+    if _plt is None:
+        # Persistent config dir so the font cache is not rebuilt on every restart
+        os.environ.setdefault("MPLCONFIGDIR", str(Path("matplotlib_cache").resolve()))
+        import matplotlib
+        matplotlib.use('Agg')  # Use non-interactive backend
+        import matplotlib.pyplot as plt
+        import matplotlib.dates as mdates
+        _plt, _mdates = plt, mdates
+    return _plt, _mdates
+
+
 # ==================== SUBSCRIPTION FUNCTIONS ====================
 
-async def create_trial_subscription(user_id: int) -> None:
+async def create_trial_subscription(user_id: int, db: DBHandle | None = None) -> None:
     """Create 7-day trial subscription for new user"""
-    async with db_pool.acquire() as conn:
+    async with _with_conn(db) as conn:
         end_date = datetime.now() + timedelta(days=7)
         await conn.execute(
             """
@@ -110,11 +391,22 @@ async def create_trial_subscription(user_id: int) -> None:
             """,
             user_id, end_date
         )
+    _sub_cache.pop(user_id, None)
+    _dashboard_cache.clear()
 
 
-async def check_subscription(user_id: int) -> dict:
+async def check_subscription(user_id: int, db: DBHandle | None = None) -> dict:
     """Check if user has active subscription"""
-    async with db_pool.acquire() as conn:
+    cached = _sub_cache.get(user_id)
+    if cached is not None:
+        return cached
+    status = await _fetch_subscription(user_id, db=db)
+    _sub_cache[user_id] = status
+    return status
+
+
+async def _fetch_subscription(user_id: int, db: DBHandle | None = None) -> dict:
+    async with _with_conn(db) as conn:
         row = await conn.fetchrow(
             """
             SELECT subscription_type, end_date, is_active
@@ -148,9 +440,9 @@ async def check_subscription(user_id: int) -> dict:
         }
 
 
-async def grant_subscription(user_id: int, sub_type: str, days: int) -> None:
+async def grant_subscription(user_id: int, sub_type: str, days: int, db: DBHandle | None = None) -> None:
     """Grant subscription to user (admin function) - adds days to existing subscription"""
-    async with db_pool.acquire() as conn:
+    async with _with_conn(db) as conn:
         # Check if user has active subscription
         row = await conn.fetchrow(
             "SELECT end_date, is_active FROM subscriptions WHERE user_id = $1",
@@ -173,20 +465,24 @@ async def grant_subscription(user_id: int, sub_type: str, days: int) -> None:
             """,
             user_id, sub_type, new_end_date
         )
+    _sub_cache.pop(user_id, None)
+    _dashboard_cache.clear()
 
 
-async def revoke_subscription(user_id: int) -> None:
+async def revoke_subscription(user_id: int, db: DBHandle | None = None) -> None:
     """Revoke user subscription (admin function)"""
-    async with db_pool.acquire() as conn:
+    async with _with_conn(db) as conn:
         await conn.execute(
             "UPDATE subscriptions SET is_active = FALSE, updated_at = NOW() WHERE user_id = $1",
             user_id
         )
+    _sub_cache.pop(user_id, None)
+    _dashboard_cache.clear()
 
 
-async def extend_subscription(user_id: int, sub_type: str, days: int) -> None:
+async def extend_subscription(user_id: int, sub_type: str, days: int, db: DBHandle | None = None) -> None:
     """Extend or create subscription after payment"""
-    async with db_pool.acquire() as conn:
+    async with _with_conn(db) as conn:
         # Check if user has active subscription
         row = await conn.fetchrow(
             "SELECT end_date, is_active FROM subscriptions WHERE user_id = $1",
@@ -209,11 +505,13 @@ async def extend_subscription(user_id: int, sub_type: str, days: int) -> None:
             """,
             user_id, sub_type, new_end_date
         )
+    _sub_cache.pop(user_id, None)
+    _dashboard_cache.clear()
 
 
-async def save_payment(user_id: int, sub_type: str, amount: int, payment_id: str, status: str = 'completed') -> None:
+async def save_payment(user_id: int, sub_type: str, amount: int, payment_id: str, status: str = 'completed', db: DBHandle | None = None) -> None:
     """Save payment to history"""
-    async with db_pool.acquire() as conn:
+    async with _with_conn(db) as conn:
         await conn.execute(
             """
             INSERT INTO payment_history (user_id, subscription_type, amount, payment_id, status)
@@ -221,27 +519,74 @@ async def save_payment(user_id: int, sub_type: str, amount: int, payment_id: str
             """,
             user_id, sub_type, amount, payment_id, status
         )
+    _dashboard_cache.clear()
 
 
-async def get_all_users() -> list:
+async def get_all_users(db: DBHandle | None = None) -> list[asyncpg.Record]:
     """Get all authenticated users for broadcast"""
-    async with db_pool.acquire() as conn:
+    async with _with_conn(db) as conn:
+        rows = await conn.fetch(
+            "SELECT user_id, username, first_name FROM users WHERE is_authenticated = TRUE AND blocked IS NOT TRUE"
+        )
+        return rows
+
+
+async def mark_users_blocked(user_ids: list[int], db: DBHandle | None = None) -> None:
+    """Exclude users who blocked the bot from future broadcasts"""
+    if not user_ids:
+        return
+    async with _with_conn(db) as conn:
+        await conn.execute("UPDATE users SET blocked = TRUE WHERE user_id = ANY($1::bigint[])", user_ids)
+
+
+async def mark_user_unblocked(user_id: int, db: DBHandle | None = None) -> None:
+    async with _with_conn(db) as conn:
+        await conn.execute("UPDATE users SET blocked = FALSE WHERE user_id = $1 AND blocked", user_id)
+
+
+async def get_users_with_subscription_status(db: DBHandle | None = None) -> list[asyncpg.Record]:
+    """Get all authenticated users with subscription status and days left, same rules as check_subscription"""
+    async with _with_conn(db) as conn:
         rows = await conn.fetch(
-            "SELECT user_id, username, first_name FROM users WHERE is_authenticated = TRUE"
+            """
+            SELECT
+                u.user_id,
+                u.username,
+                u.first_name,
+                COALESCE(s.is_active AND s.end_date >= LOCALTIMESTAMP, FALSE) AS active,
+                CASE WHEN s.is_active AND s.end_date >= LOCALTIMESTAMP
+                     THEN FLOOR(EXTRACT(EPOCH FROM s.end_date - LOCALTIMESTAMP) / 86400)::int
+                     ELSE 0
+                END AS days_left
+            FROM users u
+            LEFT JOIN subscriptions s ON s.user_id = u.user_id
+            WHERE u.is_authenticated = TRUE
+            """
         )
-        return [dict(row) for row in rows]
+        return rows
 
 
 # ==================== ADMIN FUNCTIONS ====================
 
-async def is_admin(user_id: int) -> bool:
+async def is_admin(user_id: int, db: DBHandle | None = None) -> bool:
     """Check if user is admin"""
-    async with db_pool.acquire() as conn:
-        result = await conn.fetchval(
-            "SELECT EXISTS(SELECT 1 FROM admins WHERE user_id = $1)",
-            user_id
-        )
-        return result or False
+    if _admin_ids_expires_at <= time.monotonic():
+        await _load_admin_ids(db=db)
+    return user_id in admin_ids
+
+
+async def _load_admin_ids(db: DBHandle | None = None) -> None:
+    global admin_ids, _admin_ids_expires_at
+    async with _with_conn(db) as conn:
+        rows = await conn.fetch("SELECT user_id FROM admins")
+    admin_ids = frozenset(row['user_id'] for row in rows)
+    _admin_ids_expires_at = time.monotonic() + _ADMIN_IDS_TTL
+
+
+def invalidate_admin_ids() -> None:
+    """Force the next is_admin call to reload the admin set"""
+    global _admin_ids_expires_at
+    _admin_ids_expires_at = 0.0
 
 
 async def is_super_admin(user_id: int) -> bool:
@@ -249,9 +594,9 @@ async def is_super_admin(user_id: int) -> bool:
     return user_id == SUPER_ADMIN_ID
 
 
-async def add_admin(user_id: int, username: str, first_name: str, added_by: int) -> None:
+async def add_admin(user_id: int, username: str, first_name: str, added_by: int, db: DBHandle | None = None) -> None:
     """Add new admin"""
-    async with db_pool.acquire() as conn:
+    async with _with_conn(db) as conn:
         await conn.execute(
             """
             INSERT INTO admins (user_id, username, first_name, added_by, is_super_admin)
@@ -260,45 +605,60 @@ async def add_admin(user_id: int, username: str, first_name: str, added_by: int)
             """,
             user_id, username, first_name, added_by
         )
+    invalidate_admin_ids()
 
 
-async def remove_admin(user_id: int) -> None:
+async def remove_admin(user_id: int, db: DBHandle | None = None) -> None:
     """Remove admin (except super admin)"""
     if user_id == SUPER_ADMIN_ID:
         return
-    async with db_pool.acquire() as conn:
+    async with _with_conn(db) as conn:
         await conn.execute(
             "DELETE FROM admins WHERE user_id = $1 AND is_super_admin = FALSE",
             user_id
         )
+    invalidate_admin_ids()
 
 
-async def get_all_admins() -> list:
+async def get_all_admins(db: DBHandle | None = None) -> list[asyncpg.Record]:
     """Get all admins"""
-    async with db_pool.acquire() as conn:
+    async with _with_conn(db) as conn:
         rows = await conn.fetch(
             "SELECT user_id, username, first_name, is_super_admin, created_at FROM admins ORDER BY created_at"
         )
-        return [dict(row) for row in rows]
+        return rows
+
+
+async def _cached_dashboard_stats(key: str, fetch, db: DBHandle | None = None) -> dict:
+    cached = _dashboard_cache.get(key)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    stats = await fetch(db=db)
+    _dashboard_cache[key] = (stats, time.monotonic() + _DASHBOARD_TTL)
+    return stats
 
 
-async def get_revenue_stats() -> dict:
+async def get_revenue_stats(db: DBHandle | None = None) -> dict:
     """Get revenue statistics"""
-    async with db_pool.acquire() as conn:
-        total = await conn.fetchval(
-            "SELECT COALESCE(SUM(amount), 0) FROM payment_history WHERE status = 'completed'"
-        ) or 0
-        
-        count = await conn.fetchval(
-            "SELECT COUNT(*) FROM payment_history WHERE status = 'completed'"
-        ) or 0
+    return await _cached_dashboard_stats("revenue", _fetch_revenue_stats, db=db)
+
+
+async def _fetch_revenue_stats(db: DBHandle | None = None) -> dict:
+    async with _with_conn(db) as conn:
+        row = await conn.fetchrow(
+            """
+            SELECT COALESCE(SUM(amount), 0) AS total_stars, COUNT(*) AS total_payments
+            FROM payment_history
+            WHERE status = 'completed'
+            """
+        )
         
-        return {"total_stars": total, "total_payments": count}
+        return {"total_stars": row['total_stars'], "total_payments": row['total_payments']}
 
 
-async def get_revenue_by_period(period: str) -> dict:
+async def get_revenue_by_period(period: str, db: DBHandle | None = None) -> dict:
     """Get revenue statistics by period (day/week/month/year)"""
-    async with db_pool.acquire() as conn:
+    async with _with_conn(db) as conn:
         if period == "day":
             date_filter = "created_at >= NOW() - INTERVAL '1 day'"
         elif period == "week":
@@ -310,70 +670,130 @@ async def get_revenue_by_period(period: str) -> dict:
         else:
             date_filter = "TRUE"
         
-        total = await conn.fetchval(
-            f"SELECT COALESCE(SUM(amount), 0) FROM payment_history WHERE status = 'completed' AND {date_filter}"
-        ) or 0
+        row = await conn.fetchrow(
+            f"SELECT COALESCE(SUM(amount), 0) AS total_stars, COUNT(*) AS total_payments "
+            f"FROM payment_history WHERE status = 'completed' AND {date_filter}"
+        )
         
-        count = await conn.fetchval(
-            f"SELECT COUNT(*) FROM payment_history WHERE status = 'completed' AND {date_filter}"
-        ) or 0
+        return {"total_stars": row['total_stars'], "total_payments": row['total_payments'], "period": period}
+
+
+async def get_revenue_by_periods(db: DBHandle | None = None) -> dict:
+    """Get day/week/month/year revenue statistics in a single query"""
+    async with _with_conn(db) as conn:
+        row = await conn.fetchrow(
+            """
+            SELECT
+                COALESCE(SUM(amount) FILTER (WHERE created_at >= NOW() - INTERVAL '1 day'), 0) AS day_stars,
+                COUNT(*) FILTER (WHERE created_at >= NOW() - INTERVAL '1 day') AS day_payments,
+                COALESCE(SUM(amount) FILTER (WHERE created_at >= NOW() - INTERVAL '7 days'), 0) AS week_stars,
+                COUNT(*) FILTER (WHERE created_at >= NOW() - INTERVAL '7 days') AS week_payments,
+                COALESCE(SUM(amount) FILTER (WHERE created_at >= NOW() - INTERVAL '30 days'), 0) AS month_stars,
+                COUNT(*) FILTER (WHERE created_at >= NOW() - INTERVAL '30 days') AS month_payments,
+                COALESCE(SUM(amount), 0) AS year_stars,
+                COUNT(*) AS year_payments
+            FROM payment_history
+            WHERE status = 'completed' AND created_at >= NOW() - INTERVAL '365 days'
+            """
+        )
         
-        return {"total_stars": total, "total_payments": count, "period": period}
+        return {
+            period: {
+                "total_stars": row[f'{period}_stars'],
+                "total_payments": row[f'{period}_payments'],
+                "period": period
+            }
+            for period in ("day", "week", "month", "year")
+        }
 
 
-async def get_users_stats() -> dict:
+async def get_users_stats(db: DBHandle | None = None) -> dict:
     """Get detailed users statistics"""
-    async with db_pool.acquire() as conn:
-        total_users = await conn.fetchval("SELECT COUNT(*) FROM users") or 0
-        active_subs = await conn.fetchval(
-            "SELECT COUNT(*) FROM subscriptions WHERE is_active = TRUE"
-        ) or 0
-        trial_users = await conn.fetchval(
-            "SELECT COUNT(*) FROM subscriptions WHERE subscription_type = 'trial' AND is_active = TRUE"
-        ) or 0
-        paid_users = await conn.fetchval(
-            "SELECT COUNT(*) FROM subscriptions WHERE subscription_type != 'trial' AND is_active = TRUE"
-        ) or 0
+    return await _cached_dashboard_stats("users", _fetch_users_stats, db=db)
+
+
+async def _fetch_users_stats(db: DBHandle | None = None) -> dict:
+    async with _with_conn(db) as conn:
+        row = await conn.fetchrow(
+            """
+            SELECT
+                (SELECT COUNT(*) FROM users) AS total_users,
+                COUNT(*) FILTER (WHERE is_active) AS active_subs,
+                COUNT(*) FILTER (WHERE is_active AND subscription_type = 'trial') AS trial_users,
+                COUNT(*) FILTER (WHERE is_active AND subscription_type != 'trial') AS paid_users
+            FROM subscriptions
+            """
+        )
         
         return {
-            "total_users": total_users,
-            "active_subscriptions": active_subs,
-            "trial_users": trial_users,
-            "paid_users": paid_users
+            "total_users": row['total_users'],
+            "active_subscriptions": row['active_subs'],
+            "trial_users": row['trial_users'],
+            "paid_users": row['paid_users']
         }
 
 
-async def get_detailed_users_csv() -> str:
-    """Generate compact CSV optimized for mobile viewing"""
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch("""
-            SELECT 
-                u.user_id,
-                u.username,
-                u.first_name,
-                u.created_at as registered_at,
-                s.subscription_type,
-                s.is_active,
-                s.end_date,
-                COALESCE(SUM(ph.amount), 0) as total_spent,
-                COUNT(ph.payment_id) as payments_count,
-                EXISTS(SELECT 1 FROM business_connections bc WHERE bc.user_id = u.user_id) as has_business_connection
-            FROM users u
-            LEFT JOIN subscriptions s ON u.user_id = s.user_id
-            LEFT JOIN payment_history ph ON u.user_id = ph.user_id AND ph.status = 'completed'
-            GROUP BY u.user_id, u.username, u.first_name, u.created_at, s.subscription_type, s.is_active, s.end_date
-            ORDER BY total_spent DESC, u.created_at DESC
+_USERS_CSV_QUERY = """
+    SELECT 
+        u.user_id,
+        u.username,
+        u.first_name,
+        u.created_at as registered_at,
+        s.subscription_type,
+        s.is_active,
+        s.end_date,
+        COALESCE(SUM(ph.amount), 0) as total_spent,
+        COUNT(ph.payment_id) as payments_count,
+        EXISTS(SELECT 1 FROM business_connections bc WHERE bc.user_id = u.user_id) as has_business_connection
+    FROM users u
+    LEFT JOIN subscriptions s ON u.user_id = s.user_id
+    LEFT JOIN payment_history ph ON u.user_id = ph.user_id AND ph.status = 'completed'
+    GROUP BY u.user_id, u.username, u.first_name, u.created_at, s.subscription_type, s.is_active, s.end_date
+"""
+
+# Table rows rendered server-side for COPY; mirrors the formatting of the summary rows
+_USERS_CSV_ROWS_QUERY = f"""
+    SELECT
+        user_id,
+        COALESCE(NULLIF(first_name, ''), 'N/A'),
+        CASE WHEN COALESCE(username, '') = '' THEN '-' ELSE '@' || username END,
+        COALESCE(NULLIF(subscription_type, ''), 'trial'),
+        CASE WHEN is_active THEN '✓' ELSE '✗' END,
+        total_spent,
+        payments_count,
+        CASE WHEN has_business_connection THEN '✅ Да' ELSE '❌ Нет' END
+    FROM ({_USERS_CSV_QUERY}) per_user
+    ORDER BY total_spent DESC, registered_at DESC
+"""
+
+
+async def get_detailed_users_csv(db: DBHandle | None = None) -> bytes:
+    """Generate compact CSV optimized for mobile viewing, encoded as UTF-8 with BOM"""
+    async with _with_conn(db) as conn:
+        # The summary goes above the table, so totals are aggregated server-side first
+        totals = await conn.fetchrow(f"""
+            SELECT
+                COUNT(*) AS total_users,
+                COALESCE(SUM(total_spent), 0)::bigint AS total_revenue,
+                COALESCE(SUM(payments_count), 0)::bigint AS total_payments,
+                COUNT(*) FILTER (WHERE is_active) AS active_subs,
+                COUNT(*) FILTER (WHERE has_business_connection) AS connected_bots
+            FROM ({_USERS_CSV_QUERY}) per_user
         """)
+        total_users = totals['total_users']
+        total_revenue = totals['total_revenue']
+        total_payments = totals['total_payments']
         
-        # Calculate totals
-        total_users = len(rows)
-        total_revenue = sum(row['total_spent'] for row in rows)
-        total_payments = sum(row['payments_count'] for row in rows)
-        active_subs = sum(1 for row in rows if row['is_active'])
-        connected_bots = sum(1 for row in rows if row['has_business_connection'])
-        
+        result = io.BytesIO()
+        result.write(b'\xef\xbb\xbf')  # BOM so Excel detects UTF-8
         output = io.StringIO()
-        writer = csv.writer(output, delimiter=',')  # Comma for mobile compatibility
+        # Comma for mobile compatibility; \n to match the rows COPY emits
+        writer = csv.writer(output, delimiter=',', lineterminator='\n')
+        
+        def flush() -> None:
+            result.write(output.getvalue().encode('utf-8'))
+            output.seek(0)
+            output.truncate(0)
         
         # Compact header
         writer.writerow(['MessageAssistant - Отчет', datetime.now().strftime("%d.%m.%Y %H:%M")])
@@ -382,8 +802,8 @@ async def get_detailed_users_csv() -> str:
         # Summary (compact)
         writer.writerow(['СТАТИСТИКА'])
         writer.writerow(['Пользователей', total_users])
-        writer.writerow(['Активных', active_subs])
-        writer.writerow(['Бот подключен', connected_bots])
+        writer.writerow(['Активных', totals['active_subs']])
+        writer.writerow(['Бот подключен', totals['connected_bots']])
         writer.writerow(['Прибыль ⭐', total_revenue])
         writer.writerow(['Платежей', total_payments])
         writer.writerow(['Средний чек', f'{total_revenue/total_payments:.1f}' if total_payments > 0 else '0'])
@@ -391,28 +811,25 @@ async def get_detailed_users_csv() -> str:
         
         # Compact user table (mobile-friendly columns)
         writer.writerow(['ID', 'Имя', 'Username', 'Подписка', 'Активна', 'Потрачено ', 'Платежей', 'Бот подключен'])
+        flush()
         
-        for row in rows:
-            writer.writerow([
-                row['user_id'],
-                row['first_name'] or 'N/A',
-                f"@{row['username']}" if row['username'] else '-',
-                row['subscription_type'] or 'trial',
-                '✓' if row['is_active'] else '✗',
-                row['total_spent'],
-                row['payments_count'],
-                '✅ Да' if row['has_business_connection'] else '❌ Нет'
-            ])
+        # The server writes the rows as CSV straight into the buffer
+        async def write_rows(chunk: bytes) -> None:
+            result.write(chunk)
+        
+        await conn.copy_from_query(_USERS_CSV_ROWS_QUERY, output=write_rows, format='csv')
         
         writer.writerow([])
         writer.writerow(['Всего записей:', total_users])
+        flush()
         
-        return output.getvalue()
+        return result.getvalue()
 
 
-async def generate_revenue_chart() -> io.BytesIO:
+async def generate_revenue_chart(db: DBHandle | None = None) -> io.BytesIO:
     """Generate beautiful revenue chart with daily statistics"""
-    async with db_pool.acquire() as conn:
+    plt, mdates = _load_matplotlib()
+    async with _with_conn(db) as conn:
         # Get revenue by day for last 30 days
         rows = await conn.fetch("""
             SELECT 
@@ -510,9 +927,10 @@ async def generate_revenue_chart() -> io.BytesIO:
     return buf
 
 
-async def generate_users_chart() -> io.BytesIO:
+async def generate_users_chart(db: DBHandle | None = None) -> io.BytesIO:
     """Generate beautiful users statistics chart"""
-    async with db_pool.acquire() as conn:
+    plt, mdates = _load_matplotlib()
+    async with _with_conn(db) as conn:
         # Get user registrations by day for last 30 days
         reg_rows = await conn.fetch("""
             SELECT 
@@ -647,26 +1065,27 @@ async def generate_users_chart() -> io.BytesIO:
 
 # ==================== REFERRAL FUNCTIONS ====================
 
-async def create_referral(referrer_id: int, referred_id: int) -> bool:
-    """Create referral link between users"""
+async def try_create_referral(referrer_id: int, referred_id: int, db: DBHandle | None = None) -> bool:
+    """Create referral link between users, return True only if it was newly inserted"""
     try:
-        async with db_pool.acquire() as conn:
-            await conn.execute(
+        async with _with_conn(db) as conn:
+            row = await conn.fetchrow(
                 """
                 INSERT INTO referrals (referrer_id, referred_id, used)
                 VALUES ($1, $2, FALSE)
                 ON CONFLICT (referred_id) DO NOTHING
+                RETURNING referred_id
                 """,
                 referrer_id, referred_id
             )
-            return True
+            return row is not None
     except:
         return False
 
 
-async def check_referral_used(user_id: int) -> bool:
+async def check_referral_used(user_id: int, db: DBHandle | None = None) -> bool:
     """Check if user already used referral bonus"""
-    async with db_pool.acquire() as conn:
+    async with _with_conn(db) as conn:
         result = await conn.fetchval(
             "SELECT EXISTS(SELECT 1 FROM referrals WHERE referred_id = $1)",
             user_id
@@ -674,18 +1093,18 @@ async def check_referral_used(user_id: int) -> bool:
         return result or False
 
 
-async def mark_referral_used(referred_id: int) -> None:
-    """Mark referral as used"""
-    async with db_pool.acquire() as conn:
-        await conn.execute(
-            "UPDATE referrals SET used = TRUE WHERE referred_id = $1",
+async def mark_referral_used(referred_id: int, db: DBHandle | None = None) -> Optional[int]:
+    """Mark referral as used, return referrer_id"""
+    async with _with_conn(db) as conn:
+        return await conn.fetchval(
+            "UPDATE referrals SET used = TRUE WHERE referred_id = $1 RETURNING referrer_id",
             referred_id
         )
 
 
-async def get_referral_count(user_id: int) -> int:
+async def get_referral_count(user_id: int, db: DBHandle | None = None) -> int:
     """Get count of successful referrals"""
-    async with db_pool.acquire() as conn:
+    async with _with_conn(db) as conn:
         count = await conn.fetchval(
             "SELECT COUNT(*) FROM referrals WHERE referrer_id = $1 AND used = TRUE",
             user_id
@@ -698,8 +1117,8 @@ async def get_referral_count(user_id: int) -> int:
 
 async def save_message(owner_id: int, chat_id: int, message_id: int, user_id: int | None, text: str | None,
                  media_type: str | None = None, file_path: str | None = None,
-                 caption: str | None = None, links: str | None = None) -> None:
-    async with db_pool.acquire() as conn:
+                 caption: str | None = None, links: list[str] | None = None, db: DBHandle | None = None) -> None:
+    async with _with_conn(db) as conn:
         await conn.execute(
             """
             INSERT INTO messages (owner_id, chat_id, message_id, user_id, text, media_type, file_path, caption, links)
@@ -711,61 +1130,94 @@ async def save_message(owner_id: int, chat_id: int, message_id: int, user_id: in
         )
 
 
-async def get_message_full(owner_id: int, chat_id: int, message_id: int) -> Optional[dict]:
-    async with db_pool.acquire() as conn:
+# One round-trip per stored message: the upsert and the owner's counter bump run as a single statement.
+# Keyed by stat column so only fixed identifiers are ever formatted into SQL.
+_SAVE_MESSAGE_AND_BUMP_SQL = {
+    column: f"""
+        WITH saved AS (
+            INSERT INTO messages (owner_id, chat_id, message_id, user_id, text, media_type, file_path, caption, links)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+            ON CONFLICT (owner_id, chat_id, message_id) DO UPDATE
+            SET text = $5, media_type = $6, file_path = $7, caption = $8, links = $9
+        )
+        INSERT INTO stats (owner_id, {column}, updated_at)
+        VALUES ($1, 1, NOW())
+        ON CONFLICT (owner_id) DO UPDATE
+        SET {column} = stats.{column} + 1, updated_at = NOW()
+    """
+    for column in ("total_messages", "total_edits")
+}
+
+
+async def save_message_and_bump(stat_type: str, owner_id: int, chat_id: int, message_id: int, user_id: int | None,
+                                text: str | None, media_type: str | None = None, file_path: str | None = None,
+                                caption: str | None = None, links: list[str] | None = None,
+                                db: DBHandle | None = None) -> None:
+    """save_message() + increment_stat(stat_type) in one statement."""
+    async with _with_conn(db) as conn:
+        await conn.execute(
+            _SAVE_MESSAGE_AND_BUMP_SQL[stat_type],
+            owner_id, chat_id, message_id, user_id, text or "", media_type, file_path, caption, links
+        )
+
+
+async def get_message_full(owner_id: int, chat_id: int, message_id: int, db: DBHandle | None = None) -> Optional[asyncpg.Record]:
+    async with _with_conn(db) as conn:
         row = await conn.fetchrow(
             "SELECT user_id, text, media_type, file_path, caption, links FROM messages WHERE owner_id = $1 AND chat_id = $2 AND message_id = $3",
             owner_id, chat_id, message_id
         )
         if row:
-            return dict(row)
+            return row
         return None
 
 
-async def delete_message_from_db(owner_id: int, chat_id: int, message_id: int) -> None:
-    async with db_pool.acquire() as conn:
+async def delete_messages_from_db(owner_id: int, chat_id: int, message_ids: list[int], db: DBHandle | None = None) -> None:
+    if not message_ids:
+        return
+    async with _with_conn(db) as conn:
         await conn.execute(
-            "DELETE FROM messages WHERE owner_id = $1 AND chat_id = $2 AND message_id = $3",
-            owner_id, chat_id, message_id
+            "DELETE FROM messages WHERE owner_id = $1 AND chat_id = $2 AND message_id = ANY($3::bigint[])",
+            owner_id, chat_id, message_ids
         )
 
 
-async def increment_stat(owner_id: int, stat_type: str) -> None:
-    async with db_pool.acquire() as conn:
+async def increment_stat(owner_id: int, stat_type: str, amount: int = 1, db: DBHandle | None = None) -> None:
+    async with _with_conn(db) as conn:
         if stat_type == "total_messages":
             await conn.execute(
                 """
                 INSERT INTO stats (owner_id, total_messages, updated_at)
-                VALUES ($1, 1, NOW())
+                VALUES ($1, $2, NOW())
                 ON CONFLICT (owner_id) DO UPDATE
-                SET total_messages = stats.total_messages + 1, updated_at = NOW()
+                SET total_messages = stats.total_messages + $2, updated_at = NOW()
                 """,
-                owner_id
+                owner_id, amount
             )
         elif stat_type == "total_edits":
             await conn.execute(
                 """
                 INSERT INTO stats (owner_id, total_edits, updated_at)
-                VALUES ($1, 1, NOW())
+                VALUES ($1, $2, NOW())
                 ON CONFLICT (owner_id) DO UPDATE
-                SET total_edits = stats.total_edits + 1, updated_at = NOW()
+                SET total_edits = stats.total_edits + $2, updated_at = NOW()
                 """,
-                owner_id
+                owner_id, amount
             )
         elif stat_type == "total_deletes":
             await conn.execute(
                 """
                 INSERT INTO stats (owner_id, total_deletes, updated_at)
-                VALUES ($1, 1, NOW())
+                VALUES ($1, $2, NOW())
                 ON CONFLICT (owner_id) DO UPDATE
-                SET total_deletes = stats.total_deletes + 1, updated_at = NOW()
+                SET total_deletes = stats.total_deletes + $2, updated_at = NOW()
                 """,
-                owner_id
+                owner_id, amount
             )
 
 
-async def get_stats(owner_id: int) -> dict:
-    async with db_pool.acquire() as conn:
+async def get_stats(owner_id: int, db: DBHandle | None = None) -> dict:
+    async with _with_conn(db) as conn:
         row = await conn.fetchrow(
             "SELECT total_messages, total_edits, total_deletes FROM stats WHERE owner_id = $1",
             owner_id
@@ -779,17 +1231,22 @@ async def get_stats(owner_id: int) -> dict:
         return {"messages": 0, "edits": 0, "deletes": 0}
 
 
-async def is_user_authenticated(user_id: int) -> bool:
-    async with db_pool.acquire() as conn:
+async def is_user_authenticated(user_id: int, db: DBHandle | None = None) -> bool:
+    cached = _auth_cache.get(user_id)
+    if cached is not None:
+        return cached
+    async with _with_conn(db) as conn:
         result = await conn.fetchval(
             "SELECT is_authenticated FROM users WHERE user_id = $1 AND is_banned = FALSE",
             user_id
         )
-        return result is True
+    result = result is True
+    _auth_cache[user_id] = result
+    return result
 
 
-async def is_user_banned(user_id: int) -> bool:
-    async with db_pool.acquire() as conn:
+async def is_user_banned(user_id: int, db: DBHandle | None = None) -> bool:
+    async with _with_conn(db) as conn:
         result = await conn.fetchval(
             "SELECT is_banned FROM users WHERE user_id = $1",
             user_id
@@ -797,66 +1254,63 @@ async def is_user_banned(user_id: int) -> bool:
         return result is True
 
 
-async def authenticate_user(user_id: int, username: str, first_name: str) -> None:
-    async with db_pool.acquire() as conn:
+async def authenticate_user(user_id: int, username: str, first_name: str, db: DBHandle | None = None) -> None:
+    async with _with_conn(db) as conn:
         await conn.execute(
             """
             INSERT INTO users (user_id, username, first_name, is_authenticated, last_login)
             VALUES ($1, $2, $3, TRUE, NOW())
             ON CONFLICT (user_id) DO UPDATE
-            SET is_authenticated = TRUE, last_login = NOW(), username = $2, first_name = $3
+            SET is_authenticated = TRUE, last_login = NOW(), username = $2, first_name = $3, blocked = FALSE
             """,
             user_id, username, first_name
         )
+    _auth_cache.pop(user_id, None)
 
 
-async def record_failed_login(user_id: int, username: str, first_name: str) -> int:
-    async with db_pool.acquire() as conn:
-        attempts = await conn.fetchval(
-            "SELECT attempts_count FROM failed_logins WHERE user_id = $1 ORDER BY attempt_time DESC LIMIT 1",
-            user_id
-        )
-        
-        if attempts is None:
-            attempts = 0
-        
-        new_attempts = attempts + 1
-        
-        await conn.execute(
-            "INSERT INTO failed_logins (user_id, username, first_name, attempts_count) VALUES ($1, $2, $3, $4)",
-            user_id, username, first_name, new_attempts
+async def record_failed_login(user_id: int, username: str, first_name: str, db: DBHandle | None = None) -> int:
+    async with _with_conn(db) as conn:
+        return await conn.fetchval(
+            """
+            INSERT INTO failed_logins (user_id, username, first_name, attempts_count)
+            VALUES ($1, $2, $3, 1)
+            ON CONFLICT (user_id) DO UPDATE SET
+                attempts_count = failed_logins.attempts_count + 1,
+                attempt_time = NOW(),
+                username = EXCLUDED.username,
+                first_name = EXCLUDED.first_name
+            RETURNING attempts_count
+            """,
+            user_id, username, first_name
         )
-        
-        return new_attempts
 
 
-async def ban_user(user_id: int, username: str, first_name: str) -> None:
-    async with db_pool.acquire() as conn:
+async def ban_user(user_id: int, username: str, first_name: str, db: DBHandle | None = None) -> None:
+    async with _with_conn(db) as conn:
         await conn.execute(
             """
-            INSERT INTO banned_users (user_id, username, first_name)
-            VALUES ($1, $2, $3)
-            ON CONFLICT (user_id) DO NOTHING
+            WITH banned AS (
+                INSERT INTO banned_users (user_id, username, first_name)
+                VALUES ($1, $2, $3)
+                ON CONFLICT (user_id) DO NOTHING
+            )
+            UPDATE users SET is_banned = TRUE WHERE user_id = $1
             """,
             user_id, username, first_name
         )
-        
-        await conn.execute(
-            "UPDATE users SET is_banned = TRUE WHERE user_id = $1",
-            user_id
-        )
+    _auth_cache.pop(user_id, None)
 
 
-async def get_banned_users() -> list:
-    async with db_pool.acquire() as conn:
+async def get_banned_users(db: DBHandle | None = None) -> list[asyncpg.Record]:
+    async with _with_conn(db) as conn:
         rows = await conn.fetch(
             "SELECT user_id, username, first_name, reason, banned_at FROM banned_users ORDER BY banned_at DESC"
         )
-        return [dict(row) for row in rows]
+        return rows
 
 
-async def get_failed_logins() -> list:
-    async with db_pool.acquire() as conn:
+async def get_failed_logins(db: DBHandle | None = None) -> list[asyncpg.Record]:
+    async with _with_conn(db) as conn:
         rows = await conn.fetch(
             """
             SELECT user_id, username, first_name, MAX(attempts_count) as attempts, MAX(attempt_time) as last_attempt
@@ -866,12 +1320,12 @@ async def get_failed_logins() -> list:
             LIMIT 50
             """
         )
-        return [dict(row) for row in rows]
+        return rows
 
 
-async def save_business_connection(connection_id: str, user_id: int, username: str, first_name: str) -> None:
+async def save_business_connection(connection_id: str, user_id: int, username: str, first_name: str, db: DBHandle | None = None) -> None:
     """Save business connection mapping"""
-    async with db_pool.acquire() as conn:
+    async with _with_conn(db) as conn:
         await conn.execute(
             """
             INSERT INTO business_connections (connection_id, user_id, username, first_name)
@@ -881,16 +1335,23 @@ async def save_business_connection(connection_id: str, user_id: int, username: s
             """,
             connection_id, user_id, username, first_name
         )
+    _connection_owner_cache[connection_id] = user_id
 
 
-async def get_user_by_connection(connection_id: str) -> Optional[int]:
+async def get_user_by_connection(connection_id: str, db: DBHandle | None = None) -> Optional[int]:
     """Get user_id by business_connection_id"""
-    async with db_pool.acquire() as conn:
+    cached = _connection_owner_cache.get(connection_id)
+    if cached is not None:
+        return cached
+    async with _with_conn(db) as conn:
         user_id = await conn.fetchval(
             "SELECT user_id FROM business_connections WHERE connection_id = $1",
             connection_id
         )
-        return user_id
+    # Unknown connections aren't cached: the connection event may still be on its way
+    if user_id is not None:
+        _connection_owner_cache[connection_id] = user_id
+    return user_id
 
 
 async def check_channel_subscription(bot: Bot, user_id: int) -> bool:
@@ -904,65 +1365,8 @@ async def check_channel_subscription(bot: Bot, user_id: int) -> bool:
         return False
 
 
-def to_fancy(text: str) -> str:
-    fancy_map = {
-        'A': '𝓐', 'B': '𝓑', 'C': '𝓒', 'D': '𝓓', 'E': '𝓔', 'F': '𝓕', 'G': '𝓖', 'H': '𝓗', 'I': '𝓘', 'J': '𝓙',
-        'K': '𝓚', 'L': '𝓛', 'M': '𝓜', 'N': '𝓝', 'O': '𝓞', 'P': '𝓟', 'Q': '𝓠', 'R': '𝓡', 'S': '𝓢', 'T': '𝓣',
-        'U': '𝓤', 'V': '𝓥', 'W': '𝓦', 'X': '𝓧', 'Y': '𝓨', 'Z': '𝓩',
-        'a': '𝓪', 'b': '𝓫', 'c': '𝓬', 'd': '𝓭', 'e': '𝓮', 'f': '𝓯', 'g': '𝓰', 'h': '𝓱', 'i': '𝓲', 'j': '𝓳',
-        'k': '𝓴', 'l': '𝓵', 'm': '𝓶', 'n': '𝓷', 'o': '𝓸', 'p': '𝓹', 'q': '𝓺', 'r': '𝓻', 's': '𝓼', 't': '𝓽',
-        'u': '𝓾', 'v': '𝓿', 'w': '𝔀', 'x': '𝔁', 'y': '𝔂', 'z': '𝔃'
-    }
-    return ''.join(fancy_map.get(c, c) for c in text)
-
-
-async def export_chat_via_api(owner_id: int, target_user_id: int, chat_name: str) -> str:
-    """Export chat history by fetching messages from Telegram API (not from DB)"""
-    print(f"📦 Начинаю экспорт чата через API для owner={owner_id}, target_user={target_user_id}")
-    
-    # Find chat_id where target_user_id is the chat_id itself (private chat)
-    # In Telegram, private chat_id equals user_id
-    chat_id = target_user_id
-    
-    async with db_pool.acquire() as conn:
-        # Check if we have any messages from this chat
-        message_count = await conn.fetchval(
-            """
-            SELECT COUNT(*) 
-            FROM messages 
-            WHERE owner_id = $1 AND chat_id = $2
-            """,
-            owner_id, chat_id
-        )
-        
-        if message_count == 0:
-            print(f"⚠️ Нет сообщений в БД для owner={owner_id}, chat_id={chat_id}")
-            return None
-        
-        print(f"📦 Найдено {message_count} сообщений для chat_id={chat_id}")
-        
-        # Get ALL messages from DB (includes deleted and edited)
-        messages = await conn.fetch(
-            """
-            SELECT message_id, user_id, text, caption, media_type, file_path, created_at
-            FROM messages
-            WHERE owner_id = $1 AND chat_id = $2
-            ORDER BY created_at DESC
-            """,
-            owner_id, chat_id
-        )
-        
-        # Reverse to show oldest first
-        messages = list(reversed(messages))
-    
-    print(f"📦 Найдено сообщений в БД: {len(messages)}")
-    
-    if not messages:
-        print(f"⚠️ Нет сообщений для экспорта")
-        return None
-    
-    # Create HTML file with Telegram-style design
-    html_content = f"""
+# Static parts of the HTML chat export page (filled with str.format)
+_HTML_HEAD_FMT = """
 <!DOCTYPE html>
 <html lang="ru">
 <head>
@@ -970,12 +1374,14 @@ async def export_chat_via_api(owner_id: int, target_user_id: int, chat_name: str
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>💬 {chat_name} - Telegram Chat Export</title>
     <style>
-        * {{
+"""
+
+_CHAT_CSS_BASE = """        * {
             margin: 0;
             padding: 0;
             box-sizing: border-box;
-        }}
-        body {{
+        }
+        body {
             font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, Cantarell, sans-serif;
             background: #0E1621;
             background-image: 
@@ -986,16 +1392,16 @@ async def export_chat_via_api(owner_id: int, target_user_id: int, chat_name: str
             min-height: 100vh;
             padding: 0;
             overflow-x: hidden;
-        }}
-        .chat-container {{
+        }
+        .chat-container {
             max-width: 750px;
             margin: 0 auto;
             background: rgba(13, 17, 23, 0.95);
             min-height: 100vh;
             box-shadow: 0 0 60px rgba(0,0,0,0.6), 0 0 100px rgba(102, 126, 234, 0.1);
             backdrop-filter: blur(20px);
-        }}
-        .chat-header {{
+        }
+        .chat-header {
             background: linear-gradient(135deg, #1a1f2e 0%, #2d3748 100%);
             padding: 20px 24px;
             border-bottom: 1px solid rgba(102, 126, 234, 0.2);
@@ -1007,8 +1413,8 @@ async def export_chat_via_api(owner_id: int, target_user_id: int, chat_name: str
             z-index: 100;
             backdrop-filter: blur(20px);
             box-shadow: 0 2px 10px rgba(0,0,0,0.3);
-        }}
-        .chat-avatar {{
+        }
+        .chat-avatar {
             width: 48px;
             height: 48px;
             border-radius: 50%;
@@ -1022,60 +1428,60 @@ async def export_chat_via_api(owner_id: int, target_user_id: int, chat_name: str
             flex-shrink: 0;
             box-shadow: 0 4px 12px rgba(102, 126, 234, 0.4);
             border: 2px solid rgba(255,255,255,0.1);
-        }}
-        .chat-info {{
+        }
+        .chat-info {
             flex: 1;
-        }}
-        .chat-name {{
+        }
+        .chat-name {
             font-size: 17px;
             font-weight: 600;
             color: #ffffff;
             margin-bottom: 3px;
             letter-spacing: 0.3px;
-        }}
-        .chat-status {{
+        }
+        .chat-status {
             font-size: 13px;
             color: #8b949e;
             display: flex;
             align-items: center;
             gap: 6px;
-        }}
-        .status-dot {{
+        }
+        .status-dot {
             width: 6px;
             height: 6px;
             border-radius: 50%;
             background: #667eea;
             animation: pulse 2s infinite;
-        }}
-        @keyframes pulse {{
-            0%, 100% {{ opacity: 1; }}
-            50% {{ opacity: 0.5; }}
-        }}
-        .messages-container {{
+        }
+        @keyframes pulse {
+            0%, 100% { opacity: 1; }
+            50% { opacity: 0.5; }
+        }
+        .messages-container {
             padding: 24px 16px;
             background: transparent;
-        }}
-        .message-wrapper {{
+        }
+        .message-wrapper {
             display: flex;
             margin-bottom: 8px;
             align-items: flex-end;
             gap: 10px;
             animation: slideIn 0.3s ease-out;
-        }}
-        @keyframes slideIn {{
-            from {{
+        }
+        @keyframes slideIn {
+            from {
                 opacity: 0;
                 transform: translateY(10px);
-            }}
-            to {{
+            }
+            to {
                 opacity: 1;
                 transform: translateY(0);
-            }}
-        }}
-        .message-wrapper.outgoing {{
+            }
+        }
+        .message-wrapper.outgoing {
             flex-direction: row-reverse;
-        }}
-        .message-avatar {{
+        }
+        .message-avatar {
             width: 36px;
             height: 36px;
             border-radius: 50%;
@@ -1089,12 +1495,12 @@ async def export_chat_via_api(owner_id: int, target_user_id: int, chat_name: str
             flex-shrink: 0;
             box-shadow: 0 2px 8px rgba(240, 147, 251, 0.3);
             border: 2px solid rgba(255,255,255,0.15);
-        }}
-        .message-wrapper.outgoing .message-avatar {{
+        }
+        .message-wrapper.outgoing .message-avatar {
             background: linear-gradient(135deg, #4facfe 0%, #00f2fe 100%);
             box-shadow: 0 2px 8px rgba(79, 172, 254, 0.3);
-        }}
-        .message-bubble {{
+        }
+        .message-bubble {
             max-width: 70%;
             padding: 12px 16px;
             border-radius: 20px;
@@ -1102,32 +1508,32 @@ async def export_chat_via_api(owner_id: int, target_user_id: int, chat_name: str
             word-wrap: break-word;
             box-shadow: 0 2px 8px rgba(0,0,0,0.4);
             transition: transform 0.2s;
-        }}
-        .message-bubble:hover {{
+        }
+        .message-bubble:hover {
             transform: translateY(-1px);
             box-shadow: 0 4px 12px rgba(0,0,0,0.5);
-        }}
-        .message-wrapper.incoming .message-bubble {{
+        }
+        .message-wrapper.incoming .message-bubble {
             background: linear-gradient(135deg, #2d3748 0%, #1e2936 100%);
             border-bottom-left-radius: 6px;
             border: 1px solid rgba(255,255,255,0.05);
-        }}
-        .message-wrapper.outgoing .message-bubble {{
+        }
+        .message-wrapper.outgoing .message-bubble {
             background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
             border-bottom-right-radius: 6px;
             border: 1px solid rgba(255,255,255,0.1);
-        }}
-        .message-text {{
+        }
+        .message-text {
             font-size: 15px;
             line-height: 1.5;
             color: #ffffff;
             margin-bottom: 6px;
             word-break: break-word;
-        }}
-        .message-text:empty {{
+        }
+        .message-text:empty {
             display: none;
-        }}
-        .message-media {{
+        }
+        .message-media {
             display: inline-flex;
             align-items: center;
             gap: 8px;
@@ -1139,8 +1545,19 @@ async def export_chat_via_api(owner_id: int, target_user_id: int, chat_name: str
             color: #58a6ff;
             font-weight: 500;
             border: 1px solid rgba(255,255,255,0.08);
-        }}
-        .message-time {{
+        }
+"""
+
+# Inline photos are only embedded by create_chat_html_backup
+_CHAT_CSS_IMG = """        .message-media img {
+            max-width: 100%;
+            border-radius: 14px;
+            margin-bottom: 8px;
+            box-shadow: 0 4px 12px rgba(0,0,0,0.3);
+        }
+"""
+
+_CHAT_CSS_TAIL = """        .message-time {
             font-size: 11px;
             color: rgba(255,255,255,0.6);
             text-align: right;
@@ -1149,18 +1566,18 @@ async def export_chat_via_api(owner_id: int, target_user_id: int, chat_name: str
             align-items: center;
             justify-content: flex-end;
             gap: 4px;
-        }}
-        .message-wrapper.outgoing .message-time::after {{
+        }
+        .message-wrapper.outgoing .message-time::after {
             content: '✓✓';
             color: #58a6ff;
             font-size: 12px;
-        }}
-        .date-divider {{
+        }
+        .date-divider {
             text-align: center;
             margin: 28px 0;
             position: relative;
-        }}
-        .date-divider span {{
+        }
+        .date-divider span {
             background: rgba(102, 126, 234, 0.15);
             padding: 8px 20px;
             border-radius: 16px;
@@ -1170,16 +1587,16 @@ async def export_chat_via_api(owner_id: int, target_user_id: int, chat_name: str
             font-weight: 500;
             border: 1px solid rgba(102, 126, 234, 0.2);
             box-shadow: 0 2px 8px rgba(0,0,0,0.2);
-        }}
-        .chat-footer {{
+        }
+        .chat-footer {
             background: linear-gradient(135deg, #1a1f2e 0%, #2d3748 100%);
             padding: 20px 24px;
             border-top: 1px solid rgba(102, 126, 234, 0.2);
             text-align: center;
             color: #8b949e;
             font-size: 13px;
-        }}
-        .footer-logo {{
+        }
+        .footer-logo {
             font-size: 16px;
             font-weight: 600;
             color: #667eea;
@@ -1188,8 +1605,8 @@ async def export_chat_via_api(owner_id: int, target_user_id: int, chat_name: str
             align-items: center;
             justify-content: center;
             gap: 8px;
-        }}
-        .stats-badge {{
+        }
+        .stats-badge {
             display: inline-block;
             background: linear-gradient(135deg, rgba(102, 126, 234, 0.2) 0%, rgba(118, 75, 162, 0.2) 100%);
             color: #a0b3ff;
@@ -1199,495 +1616,474 @@ async def export_chat_via_api(owner_id: int, target_user_id: int, chat_name: str
             margin-top: 10px;
             border: 1px solid rgba(102, 126, 234, 0.3);
             box-shadow: 0 2px 8px rgba(102, 126, 234, 0.2);
-        }}
-        @media (max-width: 768px) {{
-            .chat-container {{
+        }
+        @media (max-width: 768px) {
+            .chat-container {
                 max-width: 100%;
-            }}
-            .message-bubble {{
+            }
+            .message-bubble {
                 max-width: 80%;
-            }}
-        }}
-    </style>
+            }
+        }
+"""
+
+_EXPORT_CSS = _CHAT_CSS_BASE + _CHAT_CSS_TAIL
+_BACKUP_CSS = _CHAT_CSS_BASE + _CHAT_CSS_IMG + _CHAT_CSS_TAIL
+
+_HTML_HEADER_FMT = """    </style>
 </head>
 <body>
     <div class="chat-container">
         <div class="chat-header">
-            <div class="chat-avatar">{chat_name[0].upper()}</div>
+            <div class="chat-avatar">{avatar}</div>
             <div class="chat-info">
                 <div class="chat-name">💬 {chat_name}</div>
                 <div class="chat-status">
                     <span class="status-dot"></span>
-                    Экспорт чата • {datetime.now().strftime('%d.%m.%Y в %H:%M')}
+                    Экспорт чата • {now}
                 </div>
             </div>
         </div>
         <div class="messages-container">
 """
-    
-    last_date = None
-    for msg in messages:
-        is_owner = msg['user_id'] == owner_id
-        sender_name = "Вы" if is_owner else chat_name
-        wrapper_class = "message-wrapper outgoing" if is_owner else "message-wrapper incoming"
-        text = msg['text'] or msg['caption'] or ""
-        media_content = ""
-        
-        # Date divider
-        msg_date = msg['created_at'].strftime('%d.%m.%Y')
-        if msg_date != last_date:
-            html_content += f'<div class="date-divider"><span>{msg_date}</span></div>\n'
-            last_date = msg_date
-        
-        # Handle media
-        if msg['media_type']:
-            media_types = {
-                'photo': '📷 Фото', 'photo_reply': '📷 Фото',
-                'video': '🎥 Видео', 'video_reply': '🎥 Видео',
-                'document': '📄 Документ', 'sticker': '🎭 Стикер',
-                'voice': '🎤 Голосовое', 'video_note': '🎬 Видеосообщение',
-                'animation': '🎬 GIF'
-            }
-            media_content = f'<div class="message-media">{media_types.get(msg["media_type"], "📎 Медиа")}</div>'
-        
-        time_str = msg['created_at'].strftime('%H:%M')
-        avatar_letter = sender_name[0].upper()
-        text_html = f'<div class="message-text">{text}</div>' if text else ''
-        
-        html_content += f"""
+
+# Per-message bubble; the backup writes the opening and closing halves around streamed media
+_MSG_OPEN_FMT = """
             <div class="{wrapper_class}">
                 <div class="message-avatar">{avatar_letter}</div>
                 <div class="message-bubble">
-                    {media_content}
+                    """
+_MSG_CLOSE_FMT = """
                     {text_html}
                     <div class="message-time">{time_str}</div>
                 </div>
             </div>
 """
-    
-    html_content += f"""
+_MSG_FMT = _MSG_OPEN_FMT + "{media_content}" + _MSG_CLOSE_FMT
+_MSG_TEXT_FMT = '<div class="message-text">{}</div>'
+_DATE_DIVIDER_FMT = '<div class="date-divider"><span>{}</span></div>\n'
+
+_HTML_FOOTER_FMT = """
         </div>
         <div class="chat-footer">
             <div class="footer-logo">🤖 MessageAssistant Bot</div>
-            <div style="font-size: 12px; color: #6b7280; margin-bottom: 8px;">Экспорт переписки Telegram</div>
-            <div class="stats-badge">📊 Всего сообщений: {len(messages)}</div>
+            <div style="font-size: 12px; color: #6b7280; margin-bottom: 8px;">{label}</div>
+            <div class="stats-badge">📊 Всего сообщений: {count}</div>
         </div>
     </div>
 </body>
 </html>
 """
+
+
+_FANCY_TABLE = str.maketrans({
+    'A': '𝓐', 'B': '𝓑', 'C': '𝓒', 'D': '𝓓', 'E': '𝓔', 'F': '𝓕', 'G': '𝓖', 'H': '𝓗', 'I': '𝓘', 'J': '𝓙',
+    'K': '𝓚', 'L': '𝓛', 'M': '𝓜', 'N': '𝓝', 'O': '𝓞', 'P': '𝓟', 'Q': '𝓠', 'R': '𝓡', 'S': '𝓢', 'T': '𝓣',
+    'U': '𝓤', 'V': '𝓥', 'W': '𝓦', 'X': '𝓧', 'Y': '𝓨', 'Z': '𝓩',
+    'a': '𝓪', 'b': '𝓫', 'c': '𝓬', 'd': '𝓭', 'e': '𝓮', 'f': '𝓯', 'g': '𝓰', 'h': '𝓱', 'i': '𝓲', 'j': '𝓳',
+    'k': '𝓴', 'l': '𝓵', 'm': '𝓶', 'n': '𝓷', 'o': '𝓸', 'p': '𝓹', 'q': '𝓺', 'r': '𝓻', 's': '𝓼', 't': '𝓽',
+    'u': '𝓾', 'v': '𝓿', 'w': '𝔀', 'x': '𝔁', 'y': '𝔂', 'z': '𝔃'
+})
+
+
+def to_fancy(text: str) -> str:
+    return text.translate(_FANCY_TABLE)
+
+
+@lru_cache(maxsize=4096)
+def to_fancy_name(name: str) -> str:
+    """to_fancy for display names, which repeat across events (message bodies stay uncached)"""
+    return to_fancy(name)
+
+
+# Notification texts shared by several handlers; filled with str.format_map
+VIEW_ONCE_CAPTION_TMPL = "🔒 <b>Исчезающее {kind} сохранено!</b>\n\n{name}{username} отправил(а) исчезающее {kind}\n\n@MessageAssistantBot_bot"
+EDIT_NOTICE_TMPL = (
+    "{name}{username} изменил(а) сообщение:\n\n"
+    "<blockquote>Old:\n{old}</blockquote>\n\n"
+    "<blockquote>New:\n{new}</blockquote>\n\n"
+    "@MessageAssistantBot_bot"
+)
+
+
+async def export_chat_via_api(owner_id: int, target_user_id: int, chat_name: str, db: DBHandle | None = None) -> str:
+    """Export chat history by fetching messages from Telegram API (not from DB)"""
+    logger.info("📦 Начинаю экспорт чата через API для owner=%s, target_user=%s", owner_id, target_user_id)
+    
+    # Find chat_id where target_user_id is the chat_id itself (private chat)
+    # In Telegram, private chat_id equals user_id
+    chat_id = target_user_id
+    
+    # User-controlled strings are escaped before going into the HTML
+    safe_name = _esc(chat_name, quote=False)
+    peer_avatar = _esc(chat_name[0].upper(), quote=False)
     
-    # Save to file
-    filename = f"chat_export_{owner_id}_{target_user_id}_{int(datetime.now().timestamp())}.html"
+    now = datetime.now()
+    filename = f"chat_export_{owner_id}_{target_user_id}_{int(now.timestamp())}.html"
     filepath = Path("saved_media") / filename
     filepath.parent.mkdir(exist_ok=True)
     
-    with open(filepath, 'w', encoding='utf-8') as f:
-        f.write(html_content)
+    # Stream ALL messages from DB (includes deleted and edited) straight into the file
+    message_count = 0
+    try:
+        async with _with_conn(db) as conn, conn.transaction():
+            with open(filepath, 'w', encoding='utf-8', buffering=1 << 20) as f:
+                # Create HTML file with Telegram-style design
+                f.write(_HTML_HEAD_FMT.format(chat_name=safe_name))
+                f.write(_EXPORT_CSS)
+                f.write(_HTML_HEADER_FMT.format(
+                    avatar=peer_avatar,
+                    chat_name=safe_name,
+                    now=now.strftime('%d.%m.%Y в %H:%M')
+                ))
+                
+                last_date = None
+                async for msg in conn.cursor(
+                    """
+                    SELECT message_id, user_id, text, caption, media_type, file_path,
+                           to_char(created_at, 'DD.MM.YYYY') AS msg_date, to_char(created_at, 'HH24:MI') AS time_str
+                    FROM messages
+                    WHERE owner_id = $1 AND chat_id = $2
+                    ORDER BY created_at ASC
+                    """,
+                    owner_id, chat_id,
+                    prefetch=1000
+                ):
+                    message_count += 1
+                    is_owner = msg['user_id'] == owner_id
+                    wrapper_class = "message-wrapper outgoing" if is_owner else "message-wrapper incoming"
+                    text = _esc(msg['text'] or msg['caption'] or "", quote=False)
+                    media_content = ""
+                    
+                    # Date divider
+                    msg_date = msg['msg_date']
+                    if msg_date != last_date:
+                        f.write(_DATE_DIVIDER_FMT.format(msg_date))
+                        last_date = msg_date
+                    
+                    # Handle media
+                    if msg['media_type']:
+                        media_content = _MEDIA_HTML.get(msg['media_type'], _MEDIA_HTML_DEFAULT)
+                    
+                    time_str = msg['time_str']
+                    avatar_letter = "В" if is_owner else peer_avatar
+                    text_html = _MSG_TEXT_FMT.format(text) if text else ''
+                    
+                    f.write(_MSG_FMT.format(
+                        wrapper_class=wrapper_class,
+                        avatar_letter=avatar_letter,
+                        media_content=media_content,
+                        text_html=text_html,
+                        time_str=time_str
+                    ))
+                
+                f.write(_HTML_FOOTER_FMT.format(label="Экспорт переписки Telegram", count=message_count))
+    except Exception:
+        # Don't leave a half-written export behind in saved_media
+        filepath.unlink(missing_ok=True)
+        raise
     
-    print(f"✅ HTML-файл создан: {filepath}")
+    logger.debug("📦 Найдено сообщений в БД: %s", message_count)
+    
+    if not message_count:
+        logger.info("⚠️ Нет сообщений в БД для owner=%s, chat_id=%s", owner_id, chat_id)
+        filepath.unlink()
+        return None
+    
+    logger.info("✅ HTML-файл создан: %s", filepath)
     return str(filepath)
 
 
-async def create_chat_html_backup(owner_id: int, chat_id: int, chat_name: str, limit: int = None) -> str:
+def _stream_b64(src, out) -> None:
+    """Base64-encode a binary file object into a text file object chunk by chunk"""
+    # 57 KB is a multiple of 3, so chunks encode without intermediate padding
+    while chunk := src.read(57 * 1024):
+        out.write(base64.b64encode(chunk).decode('ascii'))
+
+
+def _embed_photo(path: Path, out) -> None:
+    """Write a photo into the backup as an inline base64 <img> tag"""
+    # open() fails before anything is written, so the caller can fall back cleanly
+    with open(path, 'rb') as img_file:
+        out.write('<img src="data:image/jpeg;base64,')
+        try:
+            _stream_b64(img_file, out)
+        except OSError:
+            # Read failed midway: close the tag so the caller's placeholder lands outside it
+            out.write('" />')
+            raise
+        out.write('" style="max-width: 100%; border-radius: 12px; margin-bottom: 8px;" />')
+
+
+async def create_chat_html_backup(owner_id: int, chat_id: int, chat_name: str, limit: int = None, db: DBHandle | None = None) -> str:
     """Create HTML backup of chat history with optional message limit"""
     print(f"📦 Начинаю создание HTML-копии для чата {chat_id}, owner {owner_id}, limit={limit}")
     
-    async with db_pool.acquire() as conn:
-        if limit:
-            # Get last N messages
-            messages = await conn.fetch(
-                """
+    if limit:
+        # Get last N messages, oldest first
+        query = """
+            WITH last AS (
                 SELECT message_id, user_id, text, caption, media_type, file_path, created_at
                 FROM messages
                 WHERE owner_id = $1 AND chat_id = $2
                 ORDER BY created_at DESC
                 LIMIT $3
-                """,
-                owner_id, chat_id, limit
-            )
-            # Reverse to show oldest first
-            messages = list(reversed(messages))
-        else:
-            # Get all messages
-            messages = await conn.fetch(
-                """
-                SELECT message_id, user_id, text, caption, media_type, file_path, created_at
-                FROM messages
-                WHERE owner_id = $1 AND chat_id = $2
-                ORDER BY created_at ASC
-                """,
-                owner_id, chat_id
             )
+            SELECT message_id, user_id, text, caption, media_type, file_path,
+                   to_char(created_at, 'DD.MM.YYYY') AS msg_date, to_char(created_at, 'HH24:MI') AS time_str
+            FROM last ORDER BY created_at ASC
+        """
+        args = (owner_id, chat_id, limit)
+    else:
+        # Get all messages
+        query = """
+            SELECT message_id, user_id, text, caption, media_type, file_path,
+                   to_char(created_at, 'DD.MM.YYYY') AS msg_date, to_char(created_at, 'HH24:MI') AS time_str
+            FROM messages
+            WHERE owner_id = $1 AND chat_id = $2
+            ORDER BY created_at ASC
+        """
+        args = (owner_id, chat_id)
     
-    print(f"📦 Найдено сообщений в БД: {len(messages)}")
+    # Create saved_media directory if it doesn't exist
+    os.makedirs("saved_media", exist_ok=True)
+    
+    now = datetime.now()
+    filename = f"saved_media/chat_backup_{chat_id}_{now.strftime('%Y%m%d_%H%M%S')}.html"
+    
+    # User-controlled strings are escaped before going into the HTML
+    safe_name = _esc(chat_name, quote=False)
+    peer_avatar = _esc(chat_name[0].upper(), quote=False)
     
-    if not messages:
+    # One directory listing instead of a stat() per media message, taken off the event loop
+    media_files = set(await asyncio.to_thread(os.listdir, MEDIA_DIR))
+    
+    # Stream rows from a server-side cursor and write HTML as they arrive
+    message_count = 0
+    try:
+        async with _with_conn(db) as conn, conn.transaction():
+            with open(filename, 'w', encoding='utf-8', buffering=1 << 20) as f:
+                f.write(_HTML_HEAD_FMT.format(chat_name=safe_name))
+                f.write(_BACKUP_CSS)
+                f.write(_HTML_HEADER_FMT.format(
+                    avatar=peer_avatar,
+                    chat_name=safe_name,
+                    now=now.strftime('%d.%m.%Y в %H:%M')
+                ))
+            
+                last_date = None
+                async for msg in conn.cursor(query, *args, prefetch=1000):
+                    message_count += 1
+                    is_owner = msg['user_id'] == owner_id
+                    wrapper_class = "message-wrapper outgoing" if is_owner else "message-wrapper incoming"
+                    text = _esc(msg['text'] or msg['caption'] or "", quote=False)
+                    media_content = ""
+                
+                    # Date divider
+                    msg_date = msg['msg_date']
+                    if msg_date != last_date:
+                        f.write(_DATE_DIVIDER_FMT.format(msg_date))
+                        last_date = msg_date
+                
+                    time_str = msg['time_str']
+                    avatar_letter = "В" if is_owner else peer_avatar
+                
+                    text_html = _MSG_TEXT_FMT.format(text) if text else ''
+                
+                    f.write(_MSG_OPEN_FMT.format(wrapper_class=wrapper_class, avatar_letter=avatar_letter))
+                
+                    # Handle media with actual files
+                    if msg['media_type'] and msg['file_path']:
+                        file_path = Path(msg['file_path'])
+                        if file_path.parent == MEDIA_DIR:
+                            file_exists = file_path.name in media_files
+                        else:
+                            file_exists = file_path.exists()
+                        if file_exists:
+                            if msg['media_type'] in ('photo', 'photo_reply'):
+                                # Embed image as base64; read and encode off the event loop
+                                try:
+                                    await asyncio.to_thread(_embed_photo, file_path, f)
+                                except OSError:
+                                    media_content = '<div class="message-media">📷 Фото</div>'
+                            elif msg['media_type'] in ('video', 'video_reply'):
+                                media_content = '<div class="message-media">🎥 Видео</div>'
+                            elif msg['media_type'] == 'sticker':
+                                media_content = '<div class="message-media">🎭 Стикер</div>'
+                            elif msg['media_type'] == 'voice':
+                                media_content = '<div class="message-media">🎤 Голосовое сообщение</div>'
+                            elif msg['media_type'] == 'video_note':
+                                media_content = '<div class="message-media">🎬 Видеосообщение</div>'
+                            elif msg['media_type'] == 'animation':
+                                media_content = '<div class="message-media">🎬 GIF</div>'
+                            elif msg['media_type'] == 'document':
+                                media_content = '<div class="message-media">📄 Документ</div>'
+                        else:
+                            # File doesn't exist, show placeholder
+                            media_content = _MEDIA_HTML.get(msg['media_type'], _MEDIA_HTML_DEFAULT)
+                
+                    f.write(media_content)
+                    f.write(_MSG_CLOSE_FMT.format(text_html=text_html, time_str=time_str))
+            
+                f.write(_HTML_FOOTER_FMT.format(label="Резервная копия переписки Telegram", count=message_count))
+    except Exception as e:
+        print(f"❌ Ошибка создания HTML файла: {e}")
+        # Don't leave a half-written backup behind in saved_media
+        Path(filename).unlink(missing_ok=True)
+        return None
+    
+    print(f"📦 Найдено сообщений в БД: {message_count}")
+    
+    if not message_count:
         print(f"⚠️ Нет сообщений для создания HTML-копии")
+        os.remove(filename)
         return None
     
-    html_content = f"""
-<!DOCTYPE html>
-<html lang="ru">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>💬 {chat_name} - Telegram Chat Export</title>
-    <style>
-        * {{
-            margin: 0;
-            padding: 0;
-            box-sizing: border-box;
-        }}
-        body {{
-            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, Cantarell, sans-serif;
-            background: #0E1621;
-            background-image: 
-                radial-gradient(at 40% 20%, rgba(102, 126, 234, 0.15) 0px, transparent 50%),
-                radial-gradient(at 80% 0%, rgba(118, 75, 162, 0.15) 0px, transparent 50%),
-                radial-gradient(at 0% 50%, rgba(79, 172, 254, 0.1) 0px, transparent 50%);
-            color: #ffffff;
-            min-height: 100vh;
-            padding: 0;
-            overflow-x: hidden;
-        }}
-        .chat-container {{
-            max-width: 750px;
-            margin: 0 auto;
-            background: rgba(13, 17, 23, 0.95);
-            min-height: 100vh;
-            box-shadow: 0 0 60px rgba(0,0,0,0.6), 0 0 100px rgba(102, 126, 234, 0.1);
-            backdrop-filter: blur(20px);
-        }}
-        .chat-header {{
-            background: linear-gradient(135deg, #1a1f2e 0%, #2d3748 100%);
-            padding: 20px 24px;
-            border-bottom: 1px solid rgba(102, 126, 234, 0.2);
-            display: flex;
-            align-items: center;
-            gap: 16px;
-            position: sticky;
-            top: 0;
-            z-index: 100;
-            backdrop-filter: blur(20px);
-            box-shadow: 0 2px 10px rgba(0,0,0,0.3);
-        }}
-        .chat-avatar {{
-            width: 48px;
-            height: 48px;
-            border-radius: 50%;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            font-size: 22px;
-            font-weight: 700;
-            color: white;
-            flex-shrink: 0;
-            box-shadow: 0 4px 12px rgba(102, 126, 234, 0.4);
-            border: 2px solid rgba(255,255,255,0.1);
-        }}
-        .chat-info {{
-            flex: 1;
-        }}
-        .chat-name {{
-            font-size: 17px;
-            font-weight: 600;
-            color: #ffffff;
-            margin-bottom: 3px;
-            letter-spacing: 0.3px;
-        }}
-        .chat-status {{
-            font-size: 13px;
-            color: #8b949e;
-            display: flex;
-            align-items: center;
-            gap: 6px;
-        }}
-        .status-dot {{
-            width: 6px;
-            height: 6px;
-            border-radius: 50%;
-            background: #667eea;
-            animation: pulse 2s infinite;
-        }}
-        @keyframes pulse {{
-            0%, 100% {{ opacity: 1; }}
-            50% {{ opacity: 0.5; }}
-        }}
-        .messages-container {{
-            padding: 24px 16px;
-            background: transparent;
-        }}
-        .message-wrapper {{
-            display: flex;
-            margin-bottom: 8px;
-            align-items: flex-end;
-            gap: 10px;
-            animation: slideIn 0.3s ease-out;
-        }}
-        @keyframes slideIn {{
-            from {{
-                opacity: 0;
-                transform: translateY(10px);
-            }}
-            to {{
-                opacity: 1;
-                transform: translateY(0);
-            }}
-        }}
-        .message-wrapper.outgoing {{
-            flex-direction: row-reverse;
-        }}
-        .message-avatar {{
-            width: 36px;
-            height: 36px;
-            border-radius: 50%;
-            background: linear-gradient(135deg, #f093fb 0%, #f5576c 100%);
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            font-size: 15px;
-            font-weight: 700;
-            color: white;
-            flex-shrink: 0;
-            box-shadow: 0 2px 8px rgba(240, 147, 251, 0.3);
-            border: 2px solid rgba(255,255,255,0.15);
-        }}
-        .message-wrapper.outgoing .message-avatar {{
-            background: linear-gradient(135deg, #4facfe 0%, #00f2fe 100%);
-            box-shadow: 0 2px 8px rgba(79, 172, 254, 0.3);
-        }}
-        .message-bubble {{
-            max-width: 70%;
-            padding: 12px 16px;
-            border-radius: 20px;
-            position: relative;
-            word-wrap: break-word;
-            box-shadow: 0 2px 8px rgba(0,0,0,0.4);
-            transition: transform 0.2s;
-        }}
-        .message-bubble:hover {{
-            transform: translateY(-1px);
-            box-shadow: 0 4px 12px rgba(0,0,0,0.5);
-        }}
-        .message-wrapper.incoming .message-bubble {{
-            background: linear-gradient(135deg, #2d3748 0%, #1e2936 100%);
-            border-bottom-left-radius: 6px;
-            border: 1px solid rgba(255,255,255,0.05);
-        }}
-        .message-wrapper.outgoing .message-bubble {{
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            border-bottom-right-radius: 6px;
-            border: 1px solid rgba(255,255,255,0.1);
-        }}
-        .message-text {{
-            font-size: 15px;
-            line-height: 1.5;
-            color: #ffffff;
-            margin-bottom: 6px;
-            word-break: break-word;
-        }}
-        .message-text:empty {{
-            display: none;
-        }}
-        .message-media {{
-            display: inline-flex;
-            align-items: center;
-            gap: 8px;
-            padding: 8px 14px;
-            background: rgba(255,255,255,0.12);
-            border-radius: 14px;
-            font-size: 13px;
-            margin-bottom: 8px;
-            color: #58a6ff;
-            font-weight: 500;
-            border: 1px solid rgba(255,255,255,0.08);
-        }}
-        .message-media img {{
-            max-width: 100%;
-            border-radius: 14px;
-            margin-bottom: 8px;
-            box-shadow: 0 4px 12px rgba(0,0,0,0.3);
-        }}
-        .message-time {{
-            font-size: 11px;
-            color: rgba(255,255,255,0.6);
-            text-align: right;
-            margin-top: 4px;
-            display: flex;
-            align-items: center;
-            justify-content: flex-end;
-            gap: 4px;
-        }}
-        .message-wrapper.outgoing .message-time::after {{
-            content: '✓✓';
-            color: #58a6ff;
-            font-size: 12px;
-        }}
-        .date-divider {{
-            text-align: center;
-            margin: 28px 0;
-            position: relative;
-        }}
-        .date-divider span {{
-            background: rgba(102, 126, 234, 0.15);
-            padding: 8px 20px;
-            border-radius: 16px;
-            font-size: 13px;
-            color: #a0aec0;
-            display: inline-block;
-            font-weight: 500;
-            border: 1px solid rgba(102, 126, 234, 0.2);
-            box-shadow: 0 2px 8px rgba(0,0,0,0.2);
-        }}
-        .chat-footer {{
-            background: linear-gradient(135deg, #1a1f2e 0%, #2d3748 100%);
-            padding: 20px 24px;
-            border-top: 1px solid rgba(102, 126, 234, 0.2);
-            text-align: center;
-            color: #8b949e;
-            font-size: 13px;
-        }}
-        .footer-logo {{
-            font-size: 16px;
-            font-weight: 600;
-            color: #667eea;
-            margin-bottom: 10px;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            gap: 8px;
-        }}
-        .stats-badge {{
-            display: inline-block;
-            background: linear-gradient(135deg, rgba(102, 126, 234, 0.2) 0%, rgba(118, 75, 162, 0.2) 100%);
-            color: #a0b3ff;
-            padding: 10px 20px;
-            border-radius: 24px;
-            font-weight: 600;
-            margin-top: 10px;
-            border: 1px solid rgba(102, 126, 234, 0.3);
-            box-shadow: 0 2px 8px rgba(102, 126, 234, 0.2);
-        }}
-        @media (max-width: 768px) {{
-            .chat-container {{
-                max-width: 100%;
-            }}
-            .message-bubble {{
-                max-width: 80%;
-            }}
-        }}
-    </style>
-</head>
-<body>
-    <div class="chat-container">
-        <div class="chat-header">
-            <div class="chat-avatar">{chat_name[0].upper()}</div>
-            <div class="chat-info">
-                <div class="chat-name">💬 {chat_name}</div>
-                <div class="chat-status">
-                    <span class="status-dot"></span>
-                    Экспорт чата • {__import__('datetime').datetime.now().strftime('%d.%m.%Y в %H:%M')}
-                </div>
-            </div>
-        </div>
-        <div class="messages-container">
-"""
+    print(f"✅ HTML файл создан: {filename}")
+    return filename
+
+
+def _existing_files(paths: list[str]) -> set[str]:
+    """The subset of paths that are regular files; meant to run in a worker thread"""
+    return {path for path in paths if os.path.isfile(path)}
+
+
+def _scan_dir_usage(path) -> tuple[int, int]:
+    """Total size and number of files under path; DirEntry.stat reuses scandir's data"""
+    size = 0
+    files = 0
+    try:
+        entries = os.scandir(path)
+    except FileNotFoundError:
+        return 0, 0
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                sub_size, sub_files = _scan_dir_usage(entry.path)
+                size += sub_size
+                files += sub_files
+            elif entry.is_file():
+                size += entry.stat().st_size
+                files += 1
+    return size, files
+
+
+_SIZE_UNITS = ('Б', 'КБ', 'МБ', 'ГБ', 'ТБ', 'ПБ')
+
+
+def format_size(bytes_size: int) -> str:
+    """Human-readable size; the unit comes from the bit length instead of a division loop"""
+    i = min(max((abs(int(bytes_size)).bit_length() - 1) // 10, 0), len(_SIZE_UNITS) - 1)
+    return f"{bytes_size / (1 << (i * 10)):.2f} {_SIZE_UNITS[i]}"
+
+
+async def get_media_usage(media_dir: Path = MEDIA_DIR) -> tuple[int, int]:
+    """Size and file count of the media directory, scanned off-loop and cached"""
+    cached = _media_scan_cache.get(media_dir)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    usage = await asyncio.to_thread(_scan_dir_usage, media_dir)
+    _media_scan_cache[media_dir] = (usage, time.monotonic() + _MEDIA_SCAN_TTL)
+    return usage
+
+
+def invalidate_media_usage(media_dir: Path = MEDIA_DIR) -> None:
+    """Force the next get_media_usage call to rescan after media is removed in bulk"""
+    _media_scan_cache.pop(media_dir, None)
+
+
+# ==================== STATIC UI ====================
+
+_BACK_TO_START_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_start")]
+])
+
+_INSTRUCTIONS_TEXT = (
+    "📖 <b>Инструкция по использованию MessageAssistant</b>\n\n"
     
-    last_date = None
-    for msg in messages:
-        is_owner = msg['user_id'] == owner_id
-        sender_name = "Вы" if is_owner else chat_name
-        wrapper_class = "message-wrapper outgoing" if is_owner else "message-wrapper incoming"
-        text = msg['text'] or msg['caption'] or ""
-        media_content = ""
-        
-        # Date divider
-        msg_date = msg['created_at'].strftime('%d.%m.%Y')
-        if msg_date != last_date:
-            html_content += f'<div class="date-divider"><span>{msg_date}</span></div>\n'
-            last_date = msg_date
-        
-        # Handle media with actual files
-        if msg['media_type'] and msg['file_path']:
-            file_path = Path(msg['file_path'])
-            if file_path.exists():
-                if msg['media_type'] in ('photo', 'photo_reply'):
-                    # Embed image as base64
-                    import base64
-                    try:
-                        with open(file_path, 'rb') as img_file:
-                            img_data = base64.b64encode(img_file.read()).decode('utf-8')
-                            media_content = f'<img src="data:image/jpeg;base64,{img_data}" style="max-width: 100%; border-radius: 12px; margin-bottom: 8px;" />'
-                    except:
-                        media_content = '<div class="message-media">📷 Фото</div>'
-                elif msg['media_type'] in ('video', 'video_reply'):
-                    media_content = '<div class="message-media">🎥 Видео</div>'
-                elif msg['media_type'] == 'sticker':
-                    media_content = '<div class="message-media">🎭 Стикер</div>'
-                elif msg['media_type'] == 'voice':
-                    media_content = '<div class="message-media">🎤 Голосовое сообщение</div>'
-                elif msg['media_type'] == 'video_note':
-                    media_content = '<div class="message-media">🎬 Видеосообщение</div>'
-                elif msg['media_type'] == 'animation':
-                    media_content = '<div class="message-media">🎬 GIF</div>'
-                elif msg['media_type'] == 'document':
-                    media_content = '<div class="message-media">📄 Документ</div>'
-            else:
-                # File doesn't exist, show placeholder
-                media_types = {
-                    'photo': '📷 Фото', 'photo_reply': '📷 Фото',
-                    'video': '🎥 Видео', 'video_reply': '🎥 Видео',
-                    'document': '📄 Документ', 'sticker': '🎭 Стикер',
-                    'voice': '🎤 Голосовое', 'video_note': '🎬 Видеосообщение',
-                    'animation': '🎬 GIF'
-                }
-                media_content = f'<div class="message-media">{media_types.get(msg["media_type"], "📎 Медиа")}</div>'
-        
-        time_str = msg['created_at'].strftime('%H:%M')
-        avatar_letter = sender_name[0].upper()
-        
-        text_html = f'<div class="message-text">{text}</div>' if text else ''
-        
-        html_content += f"""
-            <div class="{wrapper_class}">
-                <div class="message-avatar">{avatar_letter}</div>
-                <div class="message-bubble">
-                    {media_content}
-                    {text_html}
-                    <div class="message-time">{time_str}</div>
-                </div>
-            </div>
-"""
+    "<b>🔔 Уведомления об удалённых сообщениях:</b>\n"
+    "• Когда собеседник удаляет сообщение, вы получите уведомление с текстом и медиа\n"
+    "• Поддерживаются: фото, видео, документы, стикеры, голосовые, видео-кружки\n\n"
     
-    html_content += f"""
-        </div>
-        <div class="chat-footer">
-            <div class="footer-logo">🤖 MessageAssistant Bot</div>
-            <div style="font-size: 12px; color: #6b7280; margin-bottom: 8px;">Резервная копия переписки Telegram</div>
-            <div class="stats-badge">📊 Всего сообщений: {len(messages)}</div>
-        </div>
-    </div>
-</body>
-</html>
-"""
+    "<b>✏️ Уведомления об изменённых сообщениях:</b>\n"
+    "• Видите старую и новую версию сообщения\n"
+    "• Отслеживаются все правки текста\n\n"
     
-    # Save HTML file
-    # Create saved_media directory if it doesn't exist
-    import os
-    os.makedirs("saved_media", exist_ok=True)
+    "<b>🔒 Исчезающие фото и видео:</b>\n"
+    "• View Once медиа автоматически сохраняются\n"
+    "• Вы получите копию даже после просмотра\n\n"
     
-    filename = f"saved_media/chat_backup_{chat_id}_{__import__('datetime').datetime.now().strftime('%Y%m%d_%H%M%S')}.html"
+    "<b>📦 Очистка чата:</b>\n"
+    "• При массовом удалении создаётся HTML-архив переписки\n"
+    "• Все медиа встроены в файл\n\n"
     
-    try:
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.write(html_content)
-        print(f"✅ HTML файл создан: {filename}")
-        return filename
-    except Exception as e:
-        print(f"❌ Ошибка создания HTML файла: {e}")
-        return None
+    "<b>🎁 Реферальная программа:</b>\n"
+    "• Пригласите друга - получите +7 дней подписки\n"
+    "• Ваша ссылка доступна в /start\n\n"
+    
+    "<b>📊 Команды:</b>\n"
+    "/start - главное меню\n"
+    "/stats - статистика\n"
+    "/help - справка\n"
+    "/admin - панель администратора (для админов)\n\n"
+    
+    "💡 <b>Важно:</b> Бот работает только с Telegram Business аккаунтами"
+)
+
+_BUY_SUB_TEXT = (
+    "💳 <b>Выберите подписку:</b>\n\n"
+    "⭐ <b>Неделя</b> - 50 звёзд (7 дней)\n"
+    "⭐ <b>Месяц</b> - 100 звёзд (30 дней)\n"
+    "⭐ <b>Год</b> - 550 звёзд (365 дней)\n\n"
+    "💡 Оплата через Telegram Stars\n"
+    "💰 При повторной оплате дни прибавляются к текущей подписке"
+)
+
+_BUY_SUB_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="⭐ Неделя - 50 звёзд", callback_data="sub_week")],
+    [InlineKeyboardButton(text="⭐ Месяц - 100 звёзд", callback_data="sub_month")],
+    [InlineKeyboardButton(text="⭐ Год - 550 звёзд", callback_data="sub_year")],
+    [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_start")]
+])
+
+# Trial-ended offer; only the referral link differs per user
+_PREMIUM_OFFER_FMT = (
+    "😔 <b>Ваш пробный период использования бота подошел к концу</b>\n\n"
+    "😊 Пожалуйста, подключите Premium-статус, либо пригласите хотя бы 1 пользователя с Telegram Premium для продления пробного периода\n\n"
+    "👑 <b>Подключить Premium-статус:</b>\n"
+    "➡️ Нажмите кнопку ниже\n\n"
+    "🎁 <b>Для приглашения:</b>\n"
+    "➡️ Отправьте эту ссылку своим друзьям и знакомым:\n"
+    "👉 <code>{ref_link}</code>"
+)
+
+_PREMIUM_OFFER_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="👑 Подключить Premium", callback_data="buy_subscription")],
+    [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_start")]
+])
+
+_SUB_MGMT_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="✅ Выдать подписку", callback_data="admin_grant_sub")],
+    [InlineKeyboardButton(text="🎁 Выдать всем пользователям", callback_data="admin_grant_all")],
+    [InlineKeyboardButton(text="❌ Забрать подписку", callback_data="admin_revoke_sub")],
+    [InlineKeyboardButton(text="🔍 Проверить подписку", callback_data="admin_check_sub")],
+    [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_admin")]
+])
+
+_CANCEL_TO_SUB_MGMT_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="❌ Отмена", callback_data="admin_subscriptions")]
+])
+
+# Subscription plans paid with Telegram Stars: {type: (name, price in stars, days)}
+_SUBSCRIPTION_PLANS = {"week": ("Неделя", 50, 7), "month": ("Месяц", 100, 30), "year": ("Год", 550, 365)}
+_SUB_INVOICES = {
+    sub_type: {
+        "title": f"Подписка MessageAssistant - {name}",
+        "prices": [LabeledPrice(label=f"Подписка {name}", amount=amount)]
+    }
+    for sub_type, (name, amount, _) in _SUBSCRIPTION_PLANS.items()
+}
+_SUB_DAYS = {sub_type: days for sub_type, (_, _, days) in _SUBSCRIPTION_PLANS.items()}
 
 
 async def main() -> None:
@@ -1698,9 +2094,48 @@ async def main() -> None:
         return
     
     await init_db()
-    bot = Bot(token=bot_token)
+    await _load_admin_ids()
+    session = AiohttpSession(limit=HTTP_POOL_LIMIT, timeout=HTTP_TIMEOUT)
+    # Hold idle TLS connections between broadcast bursts instead of re-handshaking
+    session._connector_init["keepalive_timeout"] = 75
+    bot = Bot(token=bot_token, session=session)
+    # Username never changes while running; used to build referral links
+    bot_username = (await bot.get_me()).username
     storage = MemoryStorage()
+    backup_semaphore = asyncio.Semaphore(BACKUP_CONCURRENCY)
     dp = Dispatcher(storage=storage)
+    
+    # Exact-match callback_data values resolve with one dict lookup instead of a chain of F.data == ... filters
+    static_callbacks = {}  # {callback_data: (handler, takes_state)}
+    
+    def on_callback(data: str):
+        def register(handler):
+            static_callbacks[data] = (handler, "state" in inspect.signature(handler).parameters)
+            return handler
+        return register
+    
+    @dp.callback_query(lambda callback: callback.data in static_callbacks)
+    async def dispatch_static_callback(callback: CallbackQuery, state: FSMContext):
+        handler, takes_state = static_callbacks[callback.data]
+        if takes_state:
+            await handler(callback, state)
+        else:
+            await handler(callback)
+    
+    # Welcome photo is uploaded from disk once, then re-sent by its Telegram file_id
+    start_photo_id = None
+    
+    async def send_start_photo(chat_id: int, caption: str, reply_markup: InlineKeyboardMarkup) -> None:
+        nonlocal start_photo_id
+        sent = await bot.send_photo(
+            chat_id,
+            start_photo_id or FSInputFile(START_PHOTO),
+            caption=caption,
+            parse_mode="HTML",
+            reply_markup=reply_markup
+        )
+        if start_photo_id is None:
+            start_photo_id = sent.photo[-1].file_id
 
     @dp.message(Command("start"))
     async def cmd_start(message: Message):
@@ -1731,36 +2166,42 @@ async def main() -> None:
                 pass
         
         # Auto-authenticate user
-        is_new_user = not await is_user_authenticated(user_id)
-        if is_new_user:
-            await authenticate_user(user_id, username, first_name)
-            # Create trial subscription for new user
-            await create_trial_subscription(user_id)
+        async with db_pool.acquire() as conn:
+            is_new_user = not await is_user_authenticated(user_id, db=conn)
+            referral_created = False
+            if is_new_user:
+                await authenticate_user(user_id, username, first_name, db=conn)
+                # Create trial subscription for new user
+                await create_trial_subscription(user_id, db=conn)
+                
+                # Process referral if exists
+                if referrer_id and referrer_id != user_id:
+                    # Only the first referral for this user is accepted
+                    if await try_create_referral(referrer_id, user_id, db=conn):
+                        # Give bonus to new user
+                        await extend_subscription(user_id, "referral_bonus", 7, db=conn)
+                        await mark_referral_used(user_id, db=conn)
+                        referral_created = True
+            else:
+                # Writing to the bot again means it was unblocked; put the user back into broadcasts
+                await mark_user_unblocked(user_id, db=conn)
             
-            # Process referral if exists
-            if referrer_id and referrer_id != user_id:
-                # Check if this user hasn't used referral before
-                if not await check_referral_used(user_id):
-                    await create_referral(referrer_id, user_id)
-                    # Give bonus to new user
-                    await extend_subscription(user_id, "referral_bonus", 7)
-                    await mark_referral_used(user_id)
-                    
-                    # Notify referrer
-                    try:
-                        await bot.send_message(
-                            referrer_id,
-                            "🎉 <b>Поздравляем!</b>\n\n"
-                            f"По вашей реферальной ссылке зарегистрировался новый пользователь!\n"
-                            "✅ Вам начислено +7 дней подписки",
-                            parse_mode="HTML"
-                        )
-                    except:
-                        pass
+            # Check subscription status
+            sub_status = await check_subscription(user_id, db=conn)
+            stats = await get_stats(user_id, db=conn)
         
-        # Check subscription status
-        sub_status = await check_subscription(user_id)
-        stats = await get_stats(user_id)
+        if referral_created:
+            # Notify referrer
+            try:
+                await bot.send_message(
+                    referrer_id,
+                    "🎉 <b>Поздравляем!</b>\n\n"
+                    f"По вашей реферальной ссылке зарегистрировался новый пользователь!\n"
+                    "✅ Вам начислено +7 дней подписки",
+                    parse_mode="HTML"
+                )
+            except:
+                pass
         
         # Build keyboard
         keyboard_buttons = [
@@ -1785,7 +2226,6 @@ async def main() -> None:
                 caption_text += f"✅ <b>Подписка активна</b>\n📅 Осталось дней: <b>{sub_status['days_left']}</b>\n\n"
             else:
                 # Trial expired - show subscription offer with referral link
-                bot_username = (await bot.get_me()).username
                 ref_link = f"https://t.me/{bot_username}?start={user_id}"
                 caption_text += "😢 <b>Пробный период закончился</b>\n\n"
                 caption_text += "💳 Можете приобрести подписку\n"
@@ -1803,13 +2243,7 @@ async def main() -> None:
         
         # Send photo with caption and inline button
         try:
-            await bot.send_photo(
-                user_id,
-                FSInputFile("photo_2025-12-29_00-18-36.jpg"),
-                caption=caption_text,
-                parse_mode="HTML",
-                reply_markup=keyboard
-            )
+            await send_start_photo(user_id, caption_text, keyboard)
         except Exception as e:
             print(f"❌ Ошибка отправки фото: {e}")
             # Fallback to text message if photo fails
@@ -1851,25 +2285,11 @@ async def main() -> None:
             return
         
         # Show subscription offer
-        bot_username = (await bot.get_me()).username
         ref_link = f"https://t.me/{bot_username}?start={user_id}"
         
-        text = (
-            "😔 <b>Ваш пробный период использования бота подошел к концу</b>\n\n"
-            "😊 Пожалуйста, подключите Premium-статус, либо пригласите хотя бы 1 пользователя с Telegram Premium для продления пробного периода\n\n"
-            "👑 <b>Подключить Premium-статус:</b>\n"
-            "➡️ Нажмите кнопку ниже\n\n"
-            "🎁 <b>Для приглашения:</b>\n"
-            "➡️ Отправьте эту ссылку своим друзьям и знакомым:\n"
-            f"👉 <code>{ref_link}</code>"
-        )
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="👑 Подключить Premium", callback_data="buy_subscription")],
-            [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_start")]
-        ])
+        text = _PREMIUM_OFFER_FMT.format(ref_link=ref_link)
         
-        await message.answer(text, parse_mode="HTML", reply_markup=keyboard)
+        await message.answer(text, parse_mode="HTML", reply_markup=_PREMIUM_OFFER_KB)
     
     @dp.message(Command("stats"))
     async def cmd_stats(message: Message):
@@ -1992,15 +2412,13 @@ async def main() -> None:
     
     @dp.message(DuplicateStates.waiting_contact, F.users_shared)
     async def process_duplicate_user_shared(message: Message, state: FSMContext):
-        print(f"🔍 DUPLICATE: Получено users_shared событие")
-        print(f"🔍 DUPLICATE: message.users_shared = {message.users_shared}")
-        print(f"🔍 DUPLICATE: Тип message = {type(message)}")
+        logger.debug("🔍 DUPLICATE: Получено users_shared событие: %s", message.users_shared)
         
         user_id = message.from_user.id
         
         # Get selected user ID
         if not message.users_shared or not message.users_shared.user_ids:
-            print(f"❌ DUPLICATE: users_shared пустой или нет user_ids")
+            logger.warning("❌ DUPLICATE: users_shared пустой или нет user_ids")
             await message.answer(
                 "❌ Не удалось получить информацию о пользователе. Попробуйте снова.",
                 reply_markup=ReplyKeyboardRemove()
@@ -2009,7 +2427,7 @@ async def main() -> None:
             return
         
         selected_user_id = message.users_shared.user_ids[0]
-        print(f"✅ DUPLICATE: Выбран пользователь {selected_user_id}")
+        logger.debug("✅ DUPLICATE: Выбран пользователь %s", selected_user_id)
         await state.clear()
         
         # Remove keyboard
@@ -2021,24 +2439,22 @@ async def main() -> None:
         
         # Get user info
         try:
-            print(f"🔍 DUPLICATE: Получаю информацию о пользователе {selected_user_id}")
+            logger.debug("🔍 DUPLICATE: Получаю информацию о пользователе %s", selected_user_id)
             user_info = await bot.get_chat(selected_user_id)
             chat_name = user_info.first_name or "Unknown"
             if user_info.last_name:
                 chat_name += f" {user_info.last_name}"
-            print(f"✅ DUPLICATE: Имя пользователя: {chat_name}")
+            logger.debug("✅ DUPLICATE: Имя пользователя: %s", chat_name)
         except Exception as e:
-            print(f"❌ DUPLICATE: Ошибка получения инфо: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("❌ DUPLICATE: Ошибка получения инфо: %s", e)
             chat_name = f"User {selected_user_id}"
         
         # Delete status message before long operation to avoid timeout
         try:
-            print(f"🔍 DUPLICATE: Удаляю статусное сообщение перед экспортом")
+            logger.debug("🔍 DUPLICATE: Удаляю статусное сообщение перед экспортом")
             await status_msg.delete()
         except Exception as e:
-            print(f"⚠️ DUPLICATE: Не удалось удалить статусное сообщение: {e}")
+            logger.warning("⚠️ DUPLICATE: Не удалось удалить статусное сообщение: %s", e)
         
         # Send new message about export
         try:
@@ -2049,14 +2465,14 @@ async def main() -> None:
                 parse_mode="HTML"
             )
         except Exception as e:
-            print(f"⚠️ DUPLICATE: Не удалось отправить сообщение об экспорте: {e}")
+            logger.warning("⚠️ DUPLICATE: Не удалось отправить сообщение об экспорте: %s", e)
             export_msg = None
         
         # Export chat history via Telegram API
         try:
-            print(f"🔍 DUPLICATE: Вызываю export_chat_via_api для owner={user_id}, target={selected_user_id}")
+            logger.debug("🔍 DUPLICATE: Вызываю export_chat_via_api для owner=%s, target=%s", user_id, selected_user_id)
             html_file = await export_chat_via_api(user_id, selected_user_id, chat_name)
-            print(f"🔍 DUPLICATE: export_chat_via_api вернул: {html_file}")
+            logger.debug("🔍 DUPLICATE: export_chat_via_api вернул: %s", html_file)
             
             if not html_file:
                 error_text = (
@@ -2073,7 +2489,7 @@ async def main() -> None:
                     await message.answer(error_text, parse_mode="HTML")
                 return
             
-            if html_file and Path(html_file).exists():
+            if html_file and await asyncio.to_thread(Path(html_file).exists):
                 await bot.send_document(
                     user_id,
                     FSInputFile(html_file),
@@ -2092,7 +2508,7 @@ async def main() -> None:
                 
                 # Clean up file
                 try:
-                    Path(html_file).unlink()
+                    await asyncio.to_thread(Path(html_file).unlink)
                 except:
                     pass
             else:
@@ -2105,9 +2521,7 @@ async def main() -> None:
                 else:
                     await message.answer(error_text, parse_mode="HTML")
         except Exception as e:
-            print(f"❌ DUPLICATE: Ошибка экспорта: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("❌ DUPLICATE: Ошибка экспорта: %s", e)
             error_text = (
                 f"❌ <b>Ошибка при экспорте</b>\n\n"
                 f"Произошла ошибка: {str(e)}\n\n"
@@ -2131,8 +2545,7 @@ async def main() -> None:
         is_super = await is_super_admin(user_id)
         
         # Get stats
-        users_stats = await get_users_stats()
-        revenue = await get_revenue_stats()
+        users_stats, revenue = await asyncio.gather(get_users_stats(), get_revenue_stats())
         
         text = "👮 <b>Админ-панель MessageAssistant</b>\n\n"
         text += f"👥 Всего пользователей: <b>{users_stats['total_users']}</b>\n"
@@ -2162,137 +2575,53 @@ async def main() -> None:
     
     # ==================== SUBSCRIPTION CALLBACKS ====================
     
-    @dp.callback_query(F.data == "show_instructions")
+    @on_callback("show_instructions")
     async def callback_show_instructions(callback):
         """Show usage instructions"""
-        text = (
-            "📖 <b>Инструкция по использованию MessageAssistant</b>\n\n"
-            
-            "<b>🔔 Уведомления об удалённых сообщениях:</b>\n"
-            "• Когда собеседник удаляет сообщение, вы получите уведомление с текстом и медиа\n"
-            "• Поддерживаются: фото, видео, документы, стикеры, голосовые, видео-кружки\n\n"
-            
-            "<b>✏️ Уведомления об изменённых сообщениях:</b>\n"
-            "• Видите старую и новую версию сообщения\n"
-            "• Отслеживаются все правки текста\n\n"
-            
-            "<b>🔒 Исчезающие фото и видео:</b>\n"
-            "• View Once медиа автоматически сохраняются\n"
-            "• Вы получите копию даже после просмотра\n\n"
-            
-            "<b>📦 Очистка чата:</b>\n"
-            "• При массовом удалении создаётся HTML-архив переписки\n"
-            "• Все медиа встроены в файл\n\n"
-            
-            "<b>🎁 Реферальная программа:</b>\n"
-            "• Пригласите друга - получите +7 дней подписки\n"
-            "• Ваша ссылка доступна в /start\n\n"
-            
-            "<b>📊 Команды:</b>\n"
-            "/start - главное меню\n"
-            "/stats - статистика\n"
-            "/help - справка\n"
-            "/admin - панель администратора (для админов)\n\n"
-            
-            "💡 <b>Важно:</b> Бот работает только с Telegram Business аккаунтами"
+        await asyncio.gather(
+            callback.message.edit_text(_INSTRUCTIONS_TEXT, parse_mode="HTML", reply_markup=_BACK_TO_START_KB),
+            callback.answer(),
         )
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_start")]
-        ])
-        
-        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
-        await callback.answer()
     
-    @dp.callback_query(F.data == "buy_subscription")
+    @on_callback("buy_subscription")
     async def callback_buy_subscription(callback):
         """Show subscription options"""
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="⭐ Неделя - 50 звёзд", callback_data="sub_week")],
-            [InlineKeyboardButton(text="⭐ Месяц - 100 звёзд", callback_data="sub_month")],
-            [InlineKeyboardButton(text="⭐ Год - 550 звёзд", callback_data="sub_year")],
-            [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_start")]
-        ])
-        
-        text = (
-            "💳 <b>Выберите подписку:</b>\n\n"
-            "⭐ <b>Неделя</b> - 50 звёзд (7 дней)\n"
-            "⭐ <b>Месяц</b> - 100 звёзд (30 дней)\n"
-            "⭐ <b>Год</b> - 550 звёзд (365 дней)\n\n"
-            "💡 Оплата через Telegram Stars\n"
-            "💰 При повторной оплате дни прибавляются к текущей подписке"
-        )
+        # Text messages are edited in place; the welcome photo can't become text
+        if callback.message.text:
+            await asyncio.gather(
+                callback.message.edit_text(_BUY_SUB_TEXT, parse_mode="HTML", reply_markup=_BUY_SUB_KB),
+                callback.answer(),
+            )
+            return
         
-        # Delete original message and send new one
         try:
             await callback.message.delete()
         except:
             pass
         
-        await bot.send_message(callback.from_user.id, text, parse_mode="HTML", reply_markup=keyboard)
+        await bot.send_message(callback.from_user.id, _BUY_SUB_TEXT, parse_mode="HTML", reply_markup=_BUY_SUB_KB)
         await callback.answer()
     
-    @dp.callback_query(F.data.startswith("view_edit_"))
-    async def callback_view_edit(callback: CallbackQuery):
-        """Show subscription offer when trying to view edited message"""
-        bot_username = (await bot.get_me()).username
+    @dp.callback_query(F.data.startswith(("view_edit_", "view_delete_")))
+    async def callback_view_locked(callback: CallbackQuery):
+        """Show subscription offer when trying to view an edited or deleted message"""
         ref_link = f"https://t.me/{bot_username}?start={callback.from_user.id}"
         
-        text = (
-            "😔 <b>Ваш пробный период использования бота подошел к концу</b>\n\n"
-            "😊 Пожалуйста, подключите Premium-статус, либо пригласите хотя бы 1 пользователя с Telegram Premium для продления пробного периода\n\n"
-            "👑 <b>Подключить Premium-статус:</b>\n"
-            "➡️ Нажмите кнопку ниже\n\n"
-            "🎁 <b>Для приглашения:</b>\n"
-            "➡️ Отправьте эту ссылку своим друзьям и знакомым:\n"
-            f"👉 <code>{ref_link}</code>"
-        )
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="👑 Подключить Premium", callback_data="buy_subscription")],
-            [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_start")]
-        ])
+        text = _PREMIUM_OFFER_FMT.format(ref_link=ref_link)
         
-        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
-        await callback.answer()
-    
-    @dp.callback_query(F.data.startswith("view_delete_"))
-    async def callback_view_delete(callback: CallbackQuery):
-        """Show subscription offer when trying to view deleted message"""
-        bot_username = (await bot.get_me()).username
-        ref_link = f"https://t.me/{bot_username}?start={callback.from_user.id}"
-        
-        text = (
-            "😔 <b>Ваш пробный период использования бота подошел к концу</b>\n\n"
-            "😊 Пожалуйста, подключите Premium-статус, либо пригласите хотя бы 1 пользователя с Telegram Premium для продления пробного периода\n\n"
-            "👑 <b>Подключить Premium-статус:</b>\n"
-            "➡️ Нажмите кнопку ниже\n\n"
-            "🎁 <b>Для приглашения:</b>\n"
-            "➡️ Отправьте эту ссылку своим друзьям и знакомым:\n"
-            f"👉 <code>{ref_link}</code>"
+        await asyncio.gather(
+            callback.message.edit_text(text, parse_mode="HTML", reply_markup=_PREMIUM_OFFER_KB),
+            callback.answer(),
         )
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="👑 Подключить Premium", callback_data="buy_subscription")],
-            [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_start")]
-        ])
-        
-        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
-        await callback.answer()
     
-    @dp.callback_query(F.data == "back_to_start")
+    @on_callback("back_to_start")
     async def callback_back_to_start(callback):
         """Return to start menu"""
-        try:
-            await callback.message.delete()
-        except:
-            pass
         await callback.answer("Возвращаемся в главное меню...")
         
         # Get subscription and stats
         user_id = callback.from_user.id
-        sub_status = await check_subscription(user_id)
-        stats = await get_stats(user_id)
+        sub_status, stats = await asyncio.gather(check_subscription(user_id), get_stats(user_id))
         
         # Build keyboard
         keyboard_buttons = [
@@ -2322,15 +2651,22 @@ async def main() -> None:
             f"/help - справка"
         )
         
+        # The welcome photo only needs a new caption; text screens are replaced
+        if callback.message.photo:
+            try:
+                await callback.message.edit_caption(caption=caption_text, parse_mode="HTML", reply_markup=keyboard)
+                return
+            except:
+                pass
+        
+        try:
+            await callback.message.delete()
+        except:
+            pass
+        
         # Send photo
         try:
-            await bot.send_photo(
-                user_id,
-                FSInputFile("photo_2025-12-29_00-18-36.jpg"),
-                caption=caption_text,
-                parse_mode="HTML",
-                reply_markup=keyboard
-            )
+            await send_start_photo(user_id, caption_text, keyboard)
         except:
             await bot.send_message(user_id, caption_text, parse_mode="HTML", reply_markup=keyboard)
     
@@ -2340,26 +2676,19 @@ async def main() -> None:
         sub_type = callback.data.split("_")[1]
         user_id = callback.from_user.id
         
-        # Define prices and names
-        prices = {"week": 50, "month": 100, "year": 550}
-        names = {"week": "Неделя", "month": "Месяц", "year": "Год"}
-        
-        if sub_type not in prices:
+        invoice = _SUB_INVOICES.get(sub_type)
+        if invoice is None:
             await callback.answer("❌ Неверный тип подписки")
             return
         
-        amount = prices[sub_type]
-        name = names[sub_type]
-        
         # Create invoice
         await bot.send_invoice(
             chat_id=user_id,
-            title=f"Подписка MessageAssistant - {name}",
             description=f"Подписка на бота",
             payload=f"subscription_{sub_type}_{user_id}",
             provider_token="",  # Empty for Stars
             currency="XTR",  # Telegram Stars
-            prices=[LabeledPrice(label=f"Подписка {name}", amount=amount)]
+            **invoice
         )
         
         await callback.answer()
@@ -2380,15 +2709,14 @@ async def main() -> None:
         if len(payload_parts) >= 2:
             sub_type = payload_parts[1]
             
-            # Define days
-            days_map = {"week": 7, "month": 30, "year": 365}
-            days = days_map.get(sub_type, 7)
+            days = _SUB_DAYS.get(sub_type, 7)
             
-            # Extend subscription
-            await extend_subscription(user_id, sub_type, days)
-            
-            # Save payment
-            await save_payment(user_id, sub_type, payment.total_amount, payment.telegram_payment_charge_id)
+            async with db_pool.acquire() as conn:
+                # Extend subscription
+                await extend_subscription(user_id, sub_type, days, db=conn)
+                
+                # Save payment
+                await save_payment(user_id, sub_type, payment.total_amount, payment.telegram_payment_charge_id, db=conn)
             
             # Send confirmation
             await message.answer(
@@ -2400,7 +2728,7 @@ async def main() -> None:
     
     # ==================== ADMIN PANEL CALLBACKS ====================
     
-    @dp.callback_query(F.data == "admin_revenue")
+    @on_callback("admin_revenue")
     async def callback_admin_revenue(callback: CallbackQuery):
         """Show revenue statistics with beautiful charts"""
         if not await is_admin(callback.from_user.id):
@@ -2409,11 +2737,11 @@ async def main() -> None:
         
         await callback.answer("⏳ Генерирую графики...")
         
-        # Get statistics
-        day_stats = await get_revenue_by_period("day")
-        week_stats = await get_revenue_by_period("week")
-        month_stats = await get_revenue_by_period("month")
-        year_stats = await get_revenue_by_period("year")
+        # Get statistics and the chart concurrently
+        revenue, revenue_chart = await asyncio.gather(get_revenue_by_periods(), generate_revenue_chart())
+        day_stats, week_stats, month_stats, year_stats = (
+            revenue["day"], revenue["week"], revenue["month"], revenue["year"]
+        )
         
         text = "📊 <b>Статистика прибыли</b>\n\n"
         text += f"📅 <b>За день:</b> {day_stats['total_stars']} ⭐ ({day_stats['total_payments']} платежей)\n"
@@ -2432,8 +2760,7 @@ async def main() -> None:
             [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_admin")]
         ])
         
-        # Generate and send revenue chart
-        revenue_chart = await generate_revenue_chart()
+        # Send revenue chart
         revenue_photo = BufferedInputFile(revenue_chart.read(), filename="revenue_chart.png")
         
         await callback.message.delete()
@@ -2445,7 +2772,7 @@ async def main() -> None:
             reply_markup=keyboard
         )
     
-    @dp.callback_query(F.data == "admin_users_stats")
+    @on_callback("admin_users_stats")
     async def callback_admin_users_stats(callback: CallbackQuery):
         """Show users statistics with beautiful charts"""
         if not await is_admin(callback.from_user.id):
@@ -2454,8 +2781,8 @@ async def main() -> None:
         
         await callback.answer("⏳ Генерирую графики...")
         
-        # Get statistics
-        users_stats = await get_users_stats()
+        # Get statistics and the chart concurrently
+        users_stats, users_chart = await asyncio.gather(get_users_stats(), generate_users_chart())
         
         text = "👥 <b>Статистика пользователей</b>\n\n"
         text += f"👤 Всего пользователей: <b>{users_stats['total_users']}</b>\n"
@@ -2469,8 +2796,7 @@ async def main() -> None:
             [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_admin")]
         ])
         
-        # Generate and send users chart
-        users_chart = await generate_users_chart()
+        # Send users chart
         users_photo = BufferedInputFile(users_chart.read(), filename="users_chart.png")
         
         await callback.message.delete()
@@ -2482,7 +2808,7 @@ async def main() -> None:
             reply_markup=keyboard
         )
     
-    @dp.callback_query(F.data == "admin_broadcast")
+    @on_callback("admin_broadcast")
     async def callback_admin_broadcast(callback: CallbackQuery, state: FSMContext):
         """Start broadcast process"""
         if not await is_admin(callback.from_user.id):
@@ -2499,10 +2825,12 @@ async def main() -> None:
         ])
         
         await state.set_state(AdminStates.waiting_broadcast_content)
-        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
-        await callback.answer()
+        await asyncio.gather(
+            callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard),
+            callback.answer(),
+        )
     
-    @dp.callback_query(F.data == "admin_subscriptions")
+    @on_callback("admin_subscriptions")
     async def callback_admin_subscriptions(callback: CallbackQuery):
         """Show subscription management menu"""
         if not await is_admin(callback.from_user.id):
@@ -2512,18 +2840,12 @@ async def main() -> None:
         text = "👥 <b>Управление подписками</b>\n\n"
         text += "Выберите действие:"
         
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="✅ Выдать подписку", callback_data="admin_grant_sub")],
-            [InlineKeyboardButton(text="🎁 Выдать всем пользователям", callback_data="admin_grant_all")],
-            [InlineKeyboardButton(text="❌ Забрать подписку", callback_data="admin_revoke_sub")],
-            [InlineKeyboardButton(text="🔍 Проверить подписку", callback_data="admin_check_sub")],
-            [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_admin")]
-        ])
-        
-        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
-        await callback.answer()
+        await asyncio.gather(
+            callback.message.edit_text(text, parse_mode="HTML", reply_markup=_SUB_MGMT_KB),
+            callback.answer(),
+        )
     
-    @dp.callback_query(F.data == "admin_grant_sub")
+    @on_callback("admin_grant_sub")
     async def callback_admin_grant_sub(callback: CallbackQuery, state: FSMContext):
         """Start grant subscription process"""
         if not await is_admin(callback.from_user.id):
@@ -2533,13 +2855,11 @@ async def main() -> None:
         text = "✅ <b>Выдать подписку</b>\n\n"
         text += "Отправьте User ID пользователя:"
         
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="❌ Отмена", callback_data="admin_subscriptions")]
-        ])
-        
         await state.set_state(AdminStates.waiting_grant_user_id)
-        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
-        await callback.answer()
+        await asyncio.gather(
+            callback.message.edit_text(text, parse_mode="HTML", reply_markup=_CANCEL_TO_SUB_MGMT_KB),
+            callback.answer(),
+        )
     
     @dp.message(AdminStates.waiting_grant_user_id)
     async def process_grant_user_id(message: Message, state: FSMContext):
@@ -2548,17 +2868,19 @@ async def main() -> None:
             return
         
         try:
-            user_id = int(message.text.strip())
-            await state.update_data(target_user_id=user_id)
-            await state.set_state(AdminStates.waiting_grant_days)
-            
-            await message.answer(
-                f"✅ User ID: <code>{user_id}</code>\n\n"
-                "Теперь отправьте количество дней подписки:",
-                parse_mode="HTML"
-            )
-        except:
+            user_id = int((message.text or "").strip())
+        except ValueError:
             await message.answer("❌ Неверный формат. Отправьте числовой User ID.")
+            return
+        
+        await state.update_data(target_user_id=user_id)
+        await state.set_state(AdminStates.waiting_grant_days)
+        
+        await message.answer(
+            f"✅ User ID: <code>{user_id}</code>\n\n"
+            "Теперь отправьте количество дней подписки:",
+            parse_mode="HTML"
+        )
     
     @dp.message(AdminStates.waiting_grant_days)
     async def process_grant_days(message: Message, state: FSMContext):
@@ -2567,23 +2889,30 @@ async def main() -> None:
             return
         
         try:
-            days = int(message.text.strip())
-            data = await state.get_data()
-            target_user_id = data['target_user_id']
-            
-            await grant_subscription(target_user_id, "admin_grant", days)
-            await state.clear()
-            
-            await message.answer(
-                f"✅ <b>Подписка выдана!</b>\n\n"
-                f"👤 User ID: <code>{target_user_id}</code>\n"
-                f"📅 Дней: <b>{days}</b>",
-                parse_mode="HTML"
-            )
-        except:
+            days = int((message.text or "").strip())
+        except ValueError:
             await message.answer("❌ Неверный формат. Отправьте число дней.")
+            return
+        
+        data = await state.get_data()
+        target_user_id = data['target_user_id']
+        
+        try:
+            await grant_subscription(target_user_id, "admin_grant", days)
+        except Exception as e:
+            logger.exception("❌ Ошибка выдачи подписки %s: %s", target_user_id, e)
+            await message.answer(f"❌ Ошибка: {e}")
+            return
+        await state.clear()
+        
+        await message.answer(
+            f"✅ <b>Подписка выдана!</b>\n\n"
+            f"👤 User ID: <code>{target_user_id}</code>\n"
+            f"📅 Дней: <b>{days}</b>",
+            parse_mode="HTML"
+        )
     
-    @dp.callback_query(F.data == "admin_grant_all")
+    @on_callback("admin_grant_all")
     async def callback_admin_grant_all(callback: CallbackQuery):
         """Show options for granting subscription to all users"""
         if not await is_admin(callback.from_user.id):
@@ -2606,8 +2935,10 @@ async def main() -> None:
             [InlineKeyboardButton(text="◀️ Назад", callback_data="admin_subscriptions")]
         ])
         
-        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
-        await callback.answer()
+        await asyncio.gather(
+            callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard),
+            callback.answer(),
+        )
     
     @dp.callback_query(F.data.startswith("grant_all_"))
     async def callback_grant_all_execute(callback: CallbackQuery):
@@ -2643,7 +2974,7 @@ async def main() -> None:
                 for user_row in users:
                     user_id = user_row['user_id']
                     try:
-                        await grant_subscription(user_id, "mass_grant", days)
+                        await grant_subscription(user_id, "mass_grant", days, db=conn)
                         success_count += 1
                     except Exception as e:
                         print(f"❌ Ошибка выдачи подписки пользователю {user_id}: {e}")
@@ -2675,7 +3006,7 @@ async def main() -> None:
             ])
             await callback.message.edit_text(error_text, parse_mode="HTML", reply_markup=keyboard)
     
-    @dp.callback_query(F.data == "admin_revoke_sub")
+    @on_callback("admin_revoke_sub")
     async def callback_admin_revoke_sub(callback: CallbackQuery, state: FSMContext):
         """Start revoke subscription process"""
         if not await is_admin(callback.from_user.id):
@@ -2685,13 +3016,11 @@ async def main() -> None:
         text = "❌ <b>Забрать подписку</b>\n\n"
         text += "Отправьте User ID пользователя:"
         
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="❌ Отмена", callback_data="admin_subscriptions")]
-        ])
-        
         await state.set_state(AdminStates.waiting_revoke_user_id)
-        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
-        await callback.answer()
+        await asyncio.gather(
+            callback.message.edit_text(text, parse_mode="HTML", reply_markup=_CANCEL_TO_SUB_MGMT_KB),
+            callback.answer(),
+        )
     
     @dp.message(AdminStates.waiting_revoke_user_id)
     async def process_revoke_user_id(message: Message, state: FSMContext):
@@ -2700,19 +3029,26 @@ async def main() -> None:
             return
         
         try:
-            user_id = int(message.text.strip())
-            await revoke_subscription(user_id)
-            await state.clear()
-            
-            await message.answer(
-                f"❌ <b>Подписка отозвана!</b>\n\n"
-                f"👤 User ID: <code>{user_id}</code>",
-                parse_mode="HTML"
-            )
-        except:
+            user_id = int((message.text or "").strip())
+        except ValueError:
             await message.answer("❌ Неверный формат. Отправьте числовой User ID.")
+            return
+        
+        try:
+            await revoke_subscription(user_id)
+        except Exception as e:
+            logger.exception("❌ Ошибка отзыва подписки %s: %s", user_id, e)
+            await message.answer(f"❌ Ошибка: {e}")
+            return
+        await state.clear()
+        
+        await message.answer(
+            f"❌ <b>Подписка отозвана!</b>\n\n"
+            f"👤 User ID: <code>{user_id}</code>",
+            parse_mode="HTML"
+        )
     
-    @dp.callback_query(F.data == "admin_check_sub")
+    @on_callback("admin_check_sub")
     async def callback_admin_check_sub(callback: CallbackQuery, state: FSMContext):
         """Check user subscription"""
         if not await is_admin(callback.from_user.id):
@@ -2722,13 +3058,11 @@ async def main() -> None:
         text = "🔍 <b>Проверить подписку</b>\n\n"
         text += "Отправьте User ID пользователя:"
         
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="❌ Отмена", callback_data="admin_subscriptions")]
-        ])
-        
         await state.set_state(AdminStates.waiting_check_user_id)
-        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
-        await callback.answer()
+        await asyncio.gather(
+            callback.message.edit_text(text, parse_mode="HTML", reply_markup=_CANCEL_TO_SUB_MGMT_KB),
+            callback.answer(),
+        )
     
     @dp.message(AdminStates.waiting_check_user_id)
     async def process_check_user_id(message: Message, state: FSMContext):
@@ -2737,33 +3071,38 @@ async def main() -> None:
             return
         
         try:
-            user_id = int(message.text.strip())
-            sub_status = await check_subscription(user_id)
-            await state.clear()
-            
-            if sub_status['active']:
-                text = (
-                    f"✅ <b>ПОДПИСКА АКТИВНА</b>\n\n"
-                    f"👤 User ID: <code>{user_id}</code>\n"
-                    f"📦 Тип подписки: <b>{sub_status['type']}</b>\n"
-                    f"📅 Осталось дней: <b>{sub_status['days_left']}</b>\n"
-                    f"🗓 Дата окончания: <b>{sub_status['end_date'].strftime('%d.%m.%Y')}</b>\n\n"
-                    f"✨ Подписка действует"
-                )
-            else:
-                text = (
-                    f"❌ <b>ПОДПИСКА НЕАКТИВНА</b>\n\n"
-                    f"👤 User ID: <code>{user_id}</code>\n\n"
-                    f"⚠️ У пользователя нет активной подписки"
-                )
-            
-            await message.answer(text, parse_mode="HTML")
+            user_id = int((message.text or "").strip())
         except ValueError:
             await message.answer("❌ Неверный формат. Отправьте числовой User ID.")
+            return
+        
+        try:
+            sub_status = await check_subscription(user_id)
         except Exception as e:
+            logger.exception("❌ Ошибка проверки подписки %s: %s", user_id, e)
             await message.answer(f"❌ Ошибка: {e}")
+            return
+        await state.clear()
+        
+        if sub_status['active']:
+            text = (
+                f"✅ <b>ПОДПИСКА АКТИВНА</b>\n\n"
+                f"👤 User ID: <code>{user_id}</code>\n"
+                f"📦 Тип подписки: <b>{sub_status['type']}</b>\n"
+                f"📅 Осталось дней: <b>{sub_status['days_left']}</b>\n"
+                f"🗓 Дата окончания: <b>{sub_status['end_date'].strftime('%d.%m.%Y')}</b>\n\n"
+                f"✨ Подписка действует"
+            )
+        else:
+            text = (
+                f"❌ <b>ПОДПИСКА НЕАКТИВНА</b>\n\n"
+                f"👤 User ID: <code>{user_id}</code>\n\n"
+                f"⚠️ У пользователя нет активной подписки"
+            )
+        
+        await message.answer(text, parse_mode="HTML")
     
-    @dp.callback_query(F.data == "admin_export_csv")
+    @on_callback("admin_export_csv")
     async def callback_admin_export_csv(callback: CallbackQuery):
         """Export users to detailed CSV"""
         if not await is_admin(callback.from_user.id):
@@ -2774,7 +3113,7 @@ async def main() -> None:
         
         csv_content = await get_detailed_users_csv()
         csv_file = BufferedInputFile(
-            csv_content.encode('utf-8-sig'),
+            csv_content,
             filename=f"users_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
         )
         
@@ -2785,7 +3124,7 @@ async def main() -> None:
             parse_mode="HTML"
         )
     
-    @dp.callback_query(F.data == "admin_db_memory")
+    @on_callback("admin_db_memory")
     async def callback_admin_db_memory(callback: CallbackQuery):
         """Show database memory usage statistics"""
         if not await is_admin(callback.from_user.id):
@@ -2795,81 +3134,55 @@ async def main() -> None:
         await callback.answer("⏳ Получаю статистику БД...")
         
         async with db_pool.acquire() as conn:
-            # Get database size
-            db_size = await conn.fetchval(
-                "SELECT pg_database_size(current_database())"
-            )
-            
-            # Get messages table size specifically
-            messages_table_size = await conn.fetchval(
-                "SELECT pg_total_relation_size('messages')"
+            # Sizes and row counts in one round-trip. Counts are the planner's
+            # pg_class.reltuples estimates, so refreshing doesn't scan every table;
+            # a missing payments table simply yields 0.
+            overview = await conn.fetchrow(
+                """
+                SELECT
+                    pg_database_size(current_database()) AS db_size,
+                    pg_total_relation_size('messages') AS messages_table_size,
+                    (SELECT COALESCE(SUM(GREATEST(reltuples, 0)), 0)::bigint
+                     FROM pg_class WHERE oid = to_regclass('public.users')) AS users_count,
+                    (SELECT COALESCE(SUM(GREATEST(reltuples, 0)), 0)::bigint
+                     FROM pg_class WHERE oid = to_regclass('public.messages')) AS messages_count,
+                    (SELECT COALESCE(SUM(GREATEST(reltuples, 0)), 0)::bigint
+                     FROM pg_class WHERE oid = to_regclass('public.subscriptions')) AS subscriptions_count,
+                    (SELECT COALESCE(SUM(GREATEST(reltuples, 0)), 0)::bigint
+                     FROM pg_class WHERE oid = to_regclass('public.payments')) AS payments_count
+                """
             )
+            db_size = overview['db_size']
+            messages_table_size = overview['messages_table_size']
+            users_count = overview['users_count']
+            messages_count = overview['messages_count']
+            subscriptions_count = overview['subscriptions_count']
+            payments_count = overview['payments_count']
             
             # Get table sizes
             tables_info = await conn.fetch(
                 """
-                SELECT 
-                    schemaname,
-                    tablename,
-                    pg_size_pretty(pg_total_relation_size(schemaname||'.'||tablename)) AS size,
-                    pg_total_relation_size(schemaname||'.'||tablename) AS size_bytes
-                FROM pg_tables
-                WHERE schemaname = 'public'
+                SELECT tablename, pg_size_pretty(size_bytes) AS size, size_bytes
+                FROM (
+                    SELECT tablename, pg_total_relation_size(format('%I.%I', schemaname, tablename)) AS size_bytes
+                    FROM pg_tables
+                    WHERE schemaname = 'public'
+                ) t
                 ORDER BY size_bytes DESC
+                LIMIT 5
                 """
             )
-            
-            # Get row counts
-            users_count = await conn.fetchval("SELECT COUNT(*) FROM users")
-            messages_count = await conn.fetchval("SELECT COUNT(*) FROM messages")
-            subscriptions_count = await conn.fetchval("SELECT COUNT(*) FROM subscriptions")
-            
-            # Check if payments table exists
-            payments_exists = await conn.fetchval(
-                """
-                SELECT EXISTS (
-                    SELECT FROM information_schema.tables 
-                    WHERE table_schema = 'public' 
-                    AND table_name = 'payments'
-                )
-                """
-            )
-            payments_count = await conn.fetchval("SELECT COUNT(*) FROM payments") if payments_exists else 0
-            
-            # Get media files size
-            media_dir = Path("saved_media")
-            media_size = 0
-            media_files_count = 0
-            if media_dir.exists():
-                for file in media_dir.rglob("*"):
-                    if file.is_file():
-                        media_size += file.stat().st_size
-                        media_files_count += 1
-            
-            # Get disk space - platform independent
-            import shutil
-            import os
-            import platform
-            
-            # Determine root path based on OS
-            if platform.system() == "Windows":
-                root_path = "C:\\"
-            else:
-                root_path = "/"
-            
-            disk_usage = shutil.disk_usage(root_path)
-            disk_total = disk_usage.total
-            disk_used = disk_usage.used
-            disk_free = disk_usage.free
         
-        # Format sizes
-        def format_size(bytes_size):
-            for unit in ['Б', 'КБ', 'МБ', 'ГБ', 'ТБ']:
-                if bytes_size < 1024.0:
-                    return f"{bytes_size:.2f} {unit}"
-                bytes_size /= 1024.0
-            return f"{bytes_size:.2f} ПБ"
+        # Disk space and media size both hit the filesystem, so they run off the event loop
+        disk_usage, (media_size, media_files_count) = await asyncio.gather(
+            asyncio.to_thread(shutil.disk_usage, DISK_ROOT),
+            get_media_usage()
+        )
+        disk_total = disk_usage.total
+        disk_used = disk_usage.used
+        disk_free = disk_usage.free
         
+        # Format sizes
         db_size_formatted = format_size(db_size)
         messages_table_formatted = format_size(messages_table_size)
         media_size_formatted = format_size(media_size)
@@ -2893,14 +3206,14 @@ async def main() -> None:
         text += f"📁 Медиа файлы: <b>{media_size_formatted}</b> ({media_files_count} файлов)\n"
         text += f"📦 Всего занято ботом: <b>{total_size_formatted}</b>\n\n"
         
-        text += "📋 <b>Записи в таблицах:</b>\n"
+        text += "📋 <b>Записи в таблицах (примерно):</b>\n"
         text += f"👥 Пользователи: <b>{users_count:,}</b>\n"
         text += f"💬 Сообщения: <b>{messages_count:,}</b>\n"
         text += f"🎫 Подписки: <b>{subscriptions_count:,}</b>\n"
         text += f"💳 Платежи: <b>{payments_count:,}</b>\n\n"
         
         text += "📂 <b>Размеры таблиц:</b>\n"
-        for table in tables_info[:5]:  # Show top 5 tables
+        for table in tables_info:  # Top 5 tables
             text += f"• {table['tablename']}: <b>{table['size']}</b>\n"
         
         text += f"\n⚙️ <b>Статус:</b> "
@@ -2919,7 +3232,7 @@ async def main() -> None:
         
         await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
     
-    @dp.callback_query(F.data == "admin_cleanup_messages")
+    @on_callback("admin_cleanup_messages")
     async def callback_admin_cleanup_messages(callback: CallbackQuery):
         """Show options for cleaning up old messages"""
         if not await is_admin(callback.from_user.id):
@@ -2943,8 +3256,10 @@ async def main() -> None:
             [InlineKeyboardButton(text="◀️ Назад", callback_data="admin_db_memory")]
         ])
         
-        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
-        await callback.answer()
+        await asyncio.gather(
+            callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard),
+            callback.answer(),
+        )
     
     @dp.callback_query(F.data.startswith("cleanup_"))
     async def callback_cleanup_execute(callback: CallbackQuery):
@@ -2977,32 +3292,35 @@ async def main() -> None:
                 
                 # Count messages to be deleted
                 count_to_delete = await conn.fetchval(
-                    f"SELECT COUNT(*) FROM messages WHERE created_at < NOW() - INTERVAL '{days} days'"
+                    "SELECT COUNT(*) FROM messages WHERE created_at < NOW() - make_interval(days => $1)",
+                    days
                 )
                 print(f"📊 Найдено сообщений для удаления: {count_to_delete}")
                 
                 # Get file paths of messages to be deleted (for media cleanup)
                 old_messages = await conn.fetch(
-                    f"""
+                    """
                     SELECT file_path 
                     FROM messages 
-                    WHERE created_at < NOW() - INTERVAL '{days} days'
+                    WHERE created_at < NOW() - make_interval(days => $1)
                     AND file_path IS NOT NULL
-                    """
+                    """,
+                    days
                 )
                 
                 print(f"📁 Найдено медиа-файлов для удаления: {len(old_messages)}")
                 
                 # Delete old messages and count
                 deleted_count = await conn.fetchval(
-                    f"""
+                    """
                     WITH deleted AS (
                         DELETE FROM messages 
-                        WHERE created_at < NOW() - INTERVAL '{days} days'
+                        WHERE created_at < NOW() - make_interval(days => $1)
                         RETURNING *
                     )
                     SELECT COUNT(*) FROM deleted
-                    """
+                    """,
+                    days
                 )
                 
                 print(f"✅ Удалено записей из БД: {deleted_count}")
@@ -3021,6 +3339,7 @@ async def main() -> None:
                             deleted_files += 1
                         except Exception as e:
                             print(f"⚠️ Не удалось удалить файл {file_path}: {e}")
+            invalidate_media_usage()
             
             # VACUUM must be run outside transaction with autocommit
             # Create a new connection with autocommit for VACUUM
@@ -3050,13 +3369,6 @@ async def main() -> None:
             freed_db_space = size_before - size_after
             total_freed = freed_db_space + freed_media_space
             
-            def format_size(bytes_size):
-                for unit in ['Б', 'КБ', 'МБ', 'ГБ']:
-                    if bytes_size < 1024.0:
-                        return f"{bytes_size:.2f} {unit}"
-                    bytes_size /= 1024.0
-                return f"{bytes_size:.2f} ТБ"
-            
             text = (
                 f"✅ <b>Очистка завершена!</b>\n\n"
                 f"🗑 Удалено сообщений: <b>{deleted_count:,}</b>\n"
@@ -3084,23 +3396,44 @@ async def main() -> None:
             ])
             await callback.message.edit_text(error_text, parse_mode="HTML", reply_markup=keyboard)
     
-    @dp.callback_query(F.data == "admin_export_chats")
+    async def get_chat_name(chat_id: int) -> str:
+        """Display name of a chat for the export screens, cached for an hour"""
+        cached = _chat_name_cache.get(chat_id)
+        if cached is not None:
+            return cached
+        try:
+            chat_info = await bot.get_chat(chat_id)
+        except Exception:
+            return f"Chat {chat_id}"
+        chat_name = chat_info.first_name or "Unknown"
+        if chat_info.last_name:
+            chat_name += f" {chat_info.last_name}"
+        _chat_name_cache[chat_id] = chat_name
+        return chat_name
+    
+    @on_callback("admin_export_chats")
     async def callback_admin_export_chats(callback: CallbackQuery):
         """Admin function to export other users' chats - page 1"""
         await callback_admin_export_chats_page(callback, page=0)
     
-    @dp.callback_query(F.data.startswith("admin_export_chats_page_"))
-    async def callback_admin_export_chats_paginated(callback: CallbackQuery):
+    @dp.callback_query(ExportUsersPage.filter())
+    async def callback_admin_export_chats_paginated(callback: CallbackQuery, callback_data: ExportUsersPage):
         """Handle pagination for admin export chats"""
         if not await is_admin(callback.from_user.id):
             await callback.answer("❌ Доступ запрещен")
             return
         
-        page = int(callback.data.split("_")[-1])
-        await callback_admin_export_chats_page(callback, page)
+        cursor = None
+        if callback_data.direction:
+            cursor = (callback_data.direction, callback_data.chats_count, callback_data.user_id)
+        await callback_admin_export_chats_page(callback, callback_data.page, cursor)
     
-    async def callback_admin_export_chats_page(callback: CallbackQuery, page: int = 0):
-        """Show paginated list of users for chat export"""
+    async def callback_admin_export_chats_page(callback: CallbackQuery, page: int = 0, cursor: tuple[str, int, int] | None = None):
+        """Show paginated list of users for chat export.
+        
+        Pages are addressed by keyset: cursor is ("a", count, user_id) for the
+        page after that row or ("b", count, user_id) for the page before it.
+        """
         if not await is_admin(callback.from_user.id):
             await callback.answer("❌ Доступ запрещен")
             return
@@ -3110,33 +3443,37 @@ async def main() -> None:
         # Get list of all users with chats (excluding protected IDs)
         PROTECTED_IDS = [1812256281, 808581806, 825042510]
         USERS_PER_PAGE = 10
-        offset = page * USERS_PER_PAGE
         
         async with db_pool.acquire() as conn:
-            # Get total count
-            total_users = await conn.fetchval(
-                """
-                SELECT COUNT(DISTINCT u.user_id)
-                FROM users u
-                INNER JOIN messages m ON u.user_id = m.owner_id
-                WHERE u.user_id != ALL($1)
-                """,
-                PROTECTED_IDS
-            )
-            
-            # Get users for current page
-            users = await conn.fetch(
-                """
-                SELECT DISTINCT u.user_id, u.first_name, u.username, COUNT(DISTINCT m.chat_id) as chats_count
-                FROM users u
-                INNER JOIN messages m ON u.user_id = m.owner_id
-                WHERE u.user_id != ALL($1)
-                GROUP BY u.user_id, u.first_name, u.username
-                ORDER BY chats_count DESC
-                LIMIT $2 OFFSET $3
-                """,
-                PROTECTED_IDS, USERS_PER_PAGE, offset
-            )
+            # Get users for current page; the window count over the grouped rows
+            # is taken before the keyset filter, so it is the overall total
+            users_query = """
+                SELECT * FROM (
+                    SELECT u.user_id, u.first_name, u.username, COUNT(DISTINCT m.chat_id) as chats_count,
+                           COUNT(*) OVER () AS total
+                    FROM users u
+                    INNER JOIN messages m ON u.user_id = m.owner_id
+                    WHERE u.user_id != ALL($1)
+                    GROUP BY u.user_id, u.first_name, u.username
+                ) t
+            """
+            if cursor is None:
+                users = await conn.fetch(
+                    users_query + "ORDER BY chats_count DESC, user_id DESC LIMIT $2",
+                    PROTECTED_IDS, USERS_PER_PAGE
+                )
+            elif cursor[0] == "a":
+                users = await conn.fetch(
+                    users_query + "WHERE (chats_count, user_id) < ($3, $4) ORDER BY chats_count DESC, user_id DESC LIMIT $2",
+                    PROTECTED_IDS, USERS_PER_PAGE, cursor[1], cursor[2]
+                )
+            else:
+                # Walk backwards from the first row of the next page, then restore display order
+                users = await conn.fetch(
+                    users_query + "WHERE (chats_count, user_id) > ($3, $4) ORDER BY chats_count ASC, user_id ASC LIMIT $2",
+                    PROTECTED_IDS, USERS_PER_PAGE, cursor[1], cursor[2]
+                )
+                users.reverse()
         
         if not users:
             await callback.message.edit_text(
@@ -3147,6 +3484,8 @@ async def main() -> None:
             )
             return
         
+        total_users = users[0]['total']
+        
         # Create keyboard with user list
         keyboard_buttons = []
         for user in users:
@@ -3155,7 +3494,7 @@ async def main() -> None:
             keyboard_buttons.append([
                 InlineKeyboardButton(
                     text=f"👤 {user_name} {username} ({user['chats_count']} чатов)",
-                    callback_data=f"admin_export_user_{user['user_id']}"
+                    callback_data=ExportUserChatsPage(user_id=user['user_id']).pack()
                 )
             ])
         
@@ -3163,11 +3502,23 @@ async def main() -> None:
         total_pages = (total_users + USERS_PER_PAGE - 1) // USERS_PER_PAGE
         nav_buttons = []
         
+        first, last = users[0], users[-1]
+        
         if page > 0:
-            nav_buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"admin_export_chats_page_{page-1}"))
+            nav_buttons.append(InlineKeyboardButton(
+                text="⬅️ Назад",
+                callback_data=ExportUsersPage(
+                    page=page - 1, direction="b", chats_count=first['chats_count'], user_id=first['user_id']
+                ).pack()
+            ))
         
         if page < total_pages - 1:
-            nav_buttons.append(InlineKeyboardButton(text="Вперёд ➡️", callback_data=f"admin_export_chats_page_{page+1}"))
+            nav_buttons.append(InlineKeyboardButton(
+                text="Вперёд ➡️",
+                callback_data=ExportUsersPage(
+                    page=page + 1, direction="a", chats_count=last['chats_count'], user_id=last['user_id']
+                ).pack()
+            ))
         
         if nav_buttons:
             keyboard_buttons.append(nav_buttons)
@@ -3185,30 +3536,20 @@ async def main() -> None:
             reply_markup=keyboard
         )
     
-    @dp.callback_query(F.data.startswith("admin_export_user_"))
-    async def callback_admin_export_user(callback: CallbackQuery):
-        """Export specific user's chats - page 1"""
-        if not await is_admin(callback.from_user.id):
-            await callback.answer("❌ Доступ запрещен")
-            return
-        
-        user_id = int(callback.data.split("_")[3])
-        await callback_admin_export_user_chats_page(callback, user_id, page=0)
-    
-    @dp.callback_query(F.data.startswith("admin_user_chats_"))
-    async def callback_admin_user_chats_paginated(callback: CallbackQuery):
-        """Handle pagination for user's chats"""
+    @dp.callback_query(ExportUserChatsPage.filter())
+    async def callback_admin_user_chats_paginated(callback: CallbackQuery, callback_data: ExportUserChatsPage):
+        """Show a user's chats; page 0 without a cursor is the first page"""
         if not await is_admin(callback.from_user.id):
             await callback.answer("❌ Доступ запрещен")
             return
         
-        parts = callback.data.split("_")
-        user_id = int(parts[3])
-        page = int(parts[4])
-        await callback_admin_export_user_chats_page(callback, user_id, page)
+        cursor = None
+        if callback_data.direction:
+            cursor = (callback_data.direction, callback_data.msg_count, callback_data.chat_id, callback_data.chat_user_id)
+        await callback_admin_export_user_chats_page(callback, callback_data.user_id, callback_data.page, cursor)
     
-    async def callback_admin_export_user_chats_page(callback: CallbackQuery, user_id: int, page: int = 0):
-        """Show paginated list of user's chats"""
+    async def callback_admin_export_user_chats_page(callback: CallbackQuery, user_id: int, page: int = 0, cursor: tuple[str, int, int, int] | None = None):
+        """Show paginated list of user's chats, keyset-addressed like the users list"""
         PROTECTED_IDS = [1812256281, 808581806, 825042510]
         
         # Double check protection
@@ -3219,30 +3560,35 @@ async def main() -> None:
         await callback.answer("⏳ Получаю список чатов...")
         
         CHATS_PER_PAGE = 10
-        offset = page * CHATS_PER_PAGE
         
-        # Get total count and chats for this user
+        # Get chats for this user together with the total (window count before the keyset filter)
         async with db_pool.acquire() as conn:
-            total_chats = await conn.fetchval(
-                """
-                SELECT COUNT(DISTINCT m.chat_id)
-                FROM messages m
-                WHERE m.owner_id = $1 AND m.user_id != $1
-                """,
-                user_id
-            )
-            
-            chats = await conn.fetch(
-                """
-                SELECT DISTINCT m.chat_id, m.user_id, COUNT(*) as msg_count
-                FROM messages m
-                WHERE m.owner_id = $1 AND m.user_id != $1
-                GROUP BY m.chat_id, m.user_id
-                ORDER BY msg_count DESC
-                LIMIT $2 OFFSET $3
-                """,
-                user_id, CHATS_PER_PAGE, offset
-            )
+            chats_query = """
+                SELECT * FROM (
+                    SELECT m.chat_id, m.user_id, COUNT(*) as msg_count, COUNT(*) OVER () AS total
+                    FROM messages m
+                    WHERE m.owner_id = $1 AND m.user_id != $1
+                    GROUP BY m.chat_id, m.user_id
+                ) t
+            """
+            if cursor is None:
+                chats = await conn.fetch(
+                    chats_query + "ORDER BY msg_count DESC, chat_id DESC, user_id DESC LIMIT $2",
+                    user_id, CHATS_PER_PAGE
+                )
+            elif cursor[0] == "a":
+                chats = await conn.fetch(
+                    chats_query + "WHERE (msg_count, chat_id, user_id) < ($3, $4, $5) "
+                    "ORDER BY msg_count DESC, chat_id DESC, user_id DESC LIMIT $2",
+                    user_id, CHATS_PER_PAGE, cursor[1], cursor[2], cursor[3]
+                )
+            else:
+                chats = await conn.fetch(
+                    chats_query + "WHERE (msg_count, chat_id, user_id) > ($3, $4, $5) "
+                    "ORDER BY msg_count ASC, chat_id ASC, user_id ASC LIMIT $2",
+                    user_id, CHATS_PER_PAGE, cursor[1], cursor[2], cursor[3]
+                )
+                chats.reverse()
         
         if not chats:
             await callback.message.edit_text(
@@ -3253,21 +3599,16 @@ async def main() -> None:
             )
             return
         
+        total_chats = chats[0]['total']
+        
         # Create keyboard with chat list
+        chat_names = await asyncio.gather(*(get_chat_name(chat['chat_id']) for chat in chats))
         keyboard_buttons = []
-        for chat in chats:
-            try:
-                chat_info = await bot.get_chat(chat['chat_id'])
-                chat_name = chat_info.first_name or "Unknown"
-                if chat_info.last_name:
-                    chat_name += f" {chat_info.last_name}"
-            except:
-                chat_name = f"Chat {chat['chat_id']}"
-            
+        for chat, chat_name in zip(chats, chat_names):
             keyboard_buttons.append([
                 InlineKeyboardButton(
                     text=f"💬 {chat_name} ({chat['msg_count']} сооб.)",
-                    callback_data=f"admin_dl_{user_id}_{chat['chat_id']}"
+                    callback_data=ExportChatDownload(owner_id=user_id, chat_id=chat['chat_id']).pack()
                 )
             ])
         
@@ -3275,11 +3616,25 @@ async def main() -> None:
         total_pages = (total_chats + CHATS_PER_PAGE - 1) // CHATS_PER_PAGE
         nav_buttons = []
         
+        first, last = chats[0], chats[-1]
+        
         if page > 0:
-            nav_buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"admin_user_chats_{user_id}_{page-1}"))
+            nav_buttons.append(InlineKeyboardButton(
+                text="⬅️ Назад",
+                callback_data=ExportUserChatsPage(
+                    user_id=user_id, page=page - 1, direction="b",
+                    msg_count=first['msg_count'], chat_id=first['chat_id'], chat_user_id=first['user_id']
+                ).pack()
+            ))
         
         if page < total_pages - 1:
-            nav_buttons.append(InlineKeyboardButton(text="Вперёд ➡️", callback_data=f"admin_user_chats_{user_id}_{page+1}"))
+            nav_buttons.append(InlineKeyboardButton(
+                text="Вперёд ➡️",
+                callback_data=ExportUserChatsPage(
+                    user_id=user_id, page=page + 1, direction="a",
+                    msg_count=last['msg_count'], chat_id=last['chat_id'], chat_user_id=last['user_id']
+                ).pack()
+            ))
         
         if nav_buttons:
             keyboard_buttons.append(nav_buttons)
@@ -3296,16 +3651,15 @@ async def main() -> None:
             reply_markup=keyboard
         )
     
-    @dp.callback_query(F.data.startswith("admin_dl_"))
-    async def callback_admin_download_chat(callback: CallbackQuery):
+    @dp.callback_query(ExportChatDownload.filter())
+    async def callback_admin_download_chat(callback: CallbackQuery, callback_data: ExportChatDownload):
         """Download specific chat as HTML"""
         if not await is_admin(callback.from_user.id):
             await callback.answer("❌ Доступ запрещен")
             return
         
-        parts = callback.data.split("_")
-        owner_id = int(parts[2])
-        chat_id = int(parts[3])
+        owner_id = callback_data.owner_id
+        chat_id = callback_data.chat_id
         
         PROTECTED_IDS = [1812256281, 808581806, 825042510]
         
@@ -3317,20 +3671,13 @@ async def main() -> None:
         await callback.answer("⏳ Создаю HTML-файл...")
         await callback.message.edit_text("⏳ <b>Создаю HTML-файл...</b>", parse_mode="HTML")
         
-        # Get chat name
-        try:
-            chat_info = await bot.get_chat(chat_id)
-            chat_name = chat_info.first_name or "Unknown"
-            if chat_info.last_name:
-                chat_name += f" {chat_info.last_name}"
-        except:
-            chat_name = f"Chat {chat_id}"
+        chat_name = await get_chat_name(chat_id)
         
         # Create HTML backup
         try:
             html_file = await create_chat_html_backup(owner_id, chat_id, chat_name)
             
-            if html_file and Path(html_file).exists():
+            if html_file and await asyncio.to_thread(Path(html_file).exists):
                 await bot.send_document(
                     callback.from_user.id,
                     FSInputFile(html_file),
@@ -3349,7 +3696,7 @@ async def main() -> None:
                 
                 # Delete temp file
                 try:
-                    Path(html_file).unlink()
+                    await asyncio.to_thread(Path(html_file).unlink)
                 except:
                     pass
             else:
@@ -3360,7 +3707,7 @@ async def main() -> None:
             traceback.print_exc()
             await callback.message.edit_text(f"❌ Ошибка: {e}")
     
-    @dp.callback_query(F.data == "back_to_admin")
+    @on_callback("back_to_admin")
     async def callback_back_to_admin(callback: CallbackQuery, state: FSMContext):
         """Return to admin panel"""
         await state.clear()
@@ -3370,8 +3717,7 @@ async def main() -> None:
             return
         
         is_super = await is_super_admin(callback.from_user.id)
-        users_stats = await get_users_stats()
-        revenue = await get_revenue_stats()
+        users_stats, revenue = await asyncio.gather(get_users_stats(), get_revenue_stats())
         
         text = "👮 <b>Админ-панель MessageAssistant</b>\n\n"
         text += f"👥 Всего пользователей: <b>{users_stats['total_users']}</b>\n"
@@ -3407,7 +3753,7 @@ async def main() -> None:
         
         await callback.answer()
     
-    @dp.callback_query(F.data == "admin_manage_admins")
+    @on_callback("admin_manage_admins")
     async def callback_admin_manage_admins(callback: CallbackQuery):
         """Manage admins (super admin only)"""
         if not await is_super_admin(callback.from_user.id):
@@ -3419,15 +3765,19 @@ async def main() -> None:
                 "SELECT user_id, username, first_name, is_super_admin, created_at FROM admins ORDER BY created_at DESC"
             )
         
-        text = "👑 <b>Управление администраторами</b>\n\n"
+        parts = ["👑 <b>Управление администраторами</b>\n\n"]
         
         if admins:
             for admin in admins:
                 super_badge = "👑" if admin['is_super_admin'] else "👮"
-                text += f"{super_badge} <b>{admin['first_name']}</b> (@{admin['username'] or 'N/A'})\n"
-                text += f"   ID: <code>{admin['user_id']}</code>\n\n"
+                parts.append(
+                    f"{super_badge} <b>{admin['first_name']}</b> (@{admin['username'] or 'N/A'})\n"
+                    f"   ID: <code>{admin['user_id']}</code>\n\n"
+                )
         else:
-            text += "<i>Нет администраторов</i>\n"
+            parts.append("<i>Нет администраторов</i>\n")
+        
+        text = "".join(parts)
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="➕ Добавить админа", callback_data="admin_add_admin")],
@@ -3435,10 +3785,12 @@ async def main() -> None:
             [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_admin")]
         ])
         
-        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
-        await callback.answer()
+        await asyncio.gather(
+            callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard),
+            callback.answer(),
+        )
     
-    @dp.callback_query(F.data == "admin_add_admin")
+    @on_callback("admin_add_admin")
     async def callback_admin_add_admin(callback: CallbackQuery, state: FSMContext):
         """Start add admin process"""
         if not await is_super_admin(callback.from_user.id):
@@ -3453,8 +3805,10 @@ async def main() -> None:
         ])
         
         await state.set_state(AdminStates.waiting_add_admin_id)
-        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
-        await callback.answer()
+        await asyncio.gather(
+            callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard),
+            callback.answer(),
+        )
     
     @dp.message(AdminStates.waiting_add_admin_id)
     async def process_add_admin_id(message: Message, state: FSMContext):
@@ -3465,36 +3819,32 @@ async def main() -> None:
         try:
             admin_id = int(message.text.strip())
             
-            # Check if already admin
+            # Insert with the user's profile in one statement; no row back means already admin
             async with db_pool.acquire() as conn:
-                existing = await conn.fetchrow(
-                    "SELECT user_id FROM admins WHERE user_id = $1",
-                    admin_id
-                )
-                
-                if existing:
-                    await message.answer(
-                        "⚠️ <b>Этот пользователь уже является админом!</b>",
-                        parse_mode="HTML"
-                    )
-                    await state.clear()
-                    return
-                
-                # Get user info if exists
-                user_info = await conn.fetchrow(
-                    "SELECT username, first_name FROM users WHERE user_id = $1",
-                    admin_id
-                )
-                
-                username = user_info['username'] if user_info else 'unknown'
-                first_name = user_info['first_name'] if user_info else 'New Admin'
-                
-                # Add admin
-                await conn.execute(
+                added = await conn.fetchrow(
                     """INSERT INTO admins (user_id, username, first_name, added_by, is_super_admin)
-                       VALUES ($1, $2, $3, $4, FALSE)""",
-                    admin_id, username, first_name, message.from_user.id
+                       SELECT $1,
+                              CASE WHEN u.user_id IS NULL THEN 'unknown' ELSE u.username END,
+                              CASE WHEN u.user_id IS NULL THEN 'New Admin' ELSE u.first_name END,
+                              $2, FALSE
+                       FROM (SELECT 1) AS one
+                       LEFT JOIN users u ON u.user_id = $1
+                       ON CONFLICT (user_id) DO NOTHING
+                       RETURNING username, first_name""",
+                    admin_id, message.from_user.id
+                )
+            
+            if added is None:
+                await message.answer(
+                    "⚠️ <b>Этот пользователь уже является админом!</b>",
+                    parse_mode="HTML"
                 )
+                await state.clear()
+                return
+            
+            invalidate_admin_ids()
+            username = added['username']
+            first_name = added['first_name']
             
             await message.answer(
                 f"✅ <b>Админ добавлен!</b>\n\n"
@@ -3520,7 +3870,7 @@ async def main() -> None:
             )
             await state.clear()
     
-    @dp.callback_query(F.data == "admin_remove_admin")
+    @on_callback("admin_remove_admin")
     async def callback_admin_remove_admin(callback: CallbackQuery, state: FSMContext):
         """Start remove admin process"""
         if not await is_super_admin(callback.from_user.id):
@@ -3535,8 +3885,10 @@ async def main() -> None:
         ])
         
         await state.set_state(AdminStates.waiting_remove_admin_id)
-        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
-        await callback.answer()
+        await asyncio.gather(
+            callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard),
+            callback.answer(),
+        )
     
     @dp.message(AdminStates.waiting_remove_admin_id)
     async def process_remove_admin_id(message: Message, state: FSMContext):
@@ -3585,6 +3937,7 @@ async def main() -> None:
                     "DELETE FROM admins WHERE user_id = $1",
                     admin_id
                 )
+                invalidate_admin_ids()
             
             await message.answer(
                 f"✅ <b>Админ удален!</b>\n\n"
@@ -3632,8 +3985,10 @@ async def main() -> None:
         else:
             text += "📝 Текстовое сообщение\n"
         
-        users = await get_all_users()
-        text += f"\n👥 Будет отправлено: <b>{len(users)}</b> пользователям\n\n"
+        # Recipients are resolved once here and reused by confirm_broadcast
+        user_ids = [user['user_id'] for user in await get_all_users()]
+        await state.update_data(user_ids=user_ids)
+        text += f"\n👥 Будет отправлено: <b>{len(user_ids)}</b> пользователям\n\n"
         text += "Подтвердите рассылку:"
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -3643,7 +3998,7 @@ async def main() -> None:
         
         await message.answer(text, parse_mode="HTML", reply_markup=keyboard)
     
-    @dp.callback_query(F.data == "confirm_broadcast")
+    @on_callback("confirm_broadcast")
     async def callback_confirm_broadcast(callback: CallbackQuery, state: FSMContext):
         """Confirm and send broadcast"""
         if not await is_admin(callback.from_user.id):
@@ -3651,31 +4006,52 @@ async def main() -> None:
             return
         
         data = await state.get_data()
-        users = await get_all_users()
+        user_ids = data.get('user_ids')
+        if user_ids is None:
+            user_ids = [user['user_id'] for user in await get_all_users()]
         
         await callback.message.edit_text("📤 Рассылка началась...", parse_mode="HTML")
         
-        success = 0
-        failed = 0
+        done = 0
+        blocked = BlockedRecipients()
         
-        for user in users:
+        async def send_one(user_id: int) -> bool:
+            nonlocal done
+            sent = await deliver(user_id)
+            done += 1
+            if done % BROADCAST_PROGRESS_EVERY == 0:
+                try:
+                    await callback.message.edit_text(f"📤 Рассылка... {done}/{len(user_ids)}", parse_mode="HTML")
+                except Exception:
+                    pass
+            return sent
+        
+        async def deliver(user_id: int) -> bool:
             try:
                 if data.get('photo'):
-                    await bot.send_photo(user['user_id'], data['photo'], caption=data.get('text'))
+                    await send_limited(bot.send_photo, user_id, data['photo'], caption=data.get('text'))
                 elif data.get('video'):
-                    await bot.send_video(user['user_id'], data['video'], caption=data.get('text'))
+                    await send_limited(bot.send_video, user_id, data['video'], caption=data.get('text'))
                 else:
-                    await bot.send_message(user['user_id'], data.get('text'))
-                success += 1
-                await asyncio.sleep(0.05)
-            except:
-                failed += 1
+                    await send_limited(bot.send_message, user_id, data.get('text'))
+                return True
+            except TelegramForbiddenError:
+                # User blocked the bot or deleted the account; retrying can't help
+                await blocked.add(user_id)
+                return False
+            except Exception:
+                return False
+        
+        success, total = await run_broadcast(user_ids, send_one)
+        await blocked.flush()
+        failed = total - success
         
         await state.clear()
         await callback.message.edit_text(
             f"✅ <b>Рассылка завершена!</b>\n\n"
             f"✅ Успешно: {success}\n"
-            f"❌ Ошибок: {failed}",
+            f"❌ Ошибок: {failed}\n"
+            f"🚫 Из них заблокировали бота: {len(blocked)}",
             parse_mode="HTML"
         )
         await callback.answer()
@@ -3775,36 +4151,45 @@ async def main() -> None:
         users = await get_all_users()
         replied_msg = message.reply_to_message
         
-        success = 0
-        failed = 0
+        blocked = BlockedRecipients()
         
-        for user in users:
+        async def send_one(user_id: int) -> bool:
             try:
                 if replied_msg.photo:
                     # Send photo with caption
-                    await bot.send_photo(
-                        user['user_id'],
+                    await send_limited(
+                        bot.send_photo,
+                        user_id,
                         replied_msg.photo[-1].file_id,
                         caption=replied_msg.caption or replied_msg.text,
                         parse_mode="HTML"
                     )
                 elif replied_msg.text:
                     # Send text
-                    await bot.send_message(
-                        user['user_id'],
+                    await send_limited(
+                        bot.send_message,
+                        user_id,
                         replied_msg.text,
                         parse_mode="HTML"
                     )
-                success += 1
-                await asyncio.sleep(0.05)  # Rate limiting
+                return True
+            except TelegramForbiddenError:
+                # User blocked the bot or deleted the account; retrying can't help
+                await blocked.add(user_id)
+                return False
             except Exception as e:
-                failed += 1
-                print(f"Failed to send to {user['user_id']}: {e}")
+                print(f"Failed to send to {user_id}: {e}")
+                return False
+        
+        success, total = await run_broadcast((user['user_id'] for user in users), send_one)
+        await blocked.flush()
+        failed = total - success
         
         await message.answer(
             f"📢 Рассылка завершена\n\n"
             f"✅ Успешно: {success}\n"
-            f"❌ Ошибок: {failed}",
+            f"❌ Ошибок: {failed}\n"
+            f"🚫 Из них заблокировали бота: {len(blocked)}",
             parse_mode="HTML"
         )
     
@@ -3815,32 +4200,25 @@ async def main() -> None:
             return
         
         try:
-            users = await get_all_users()
-            
-            # Create CSV content
-            csv_content = "user_id,username,first_name,subscription_status,days_left\n"
-            
-            for user in users:
-                sub_status = await check_subscription(user['user_id'])
-                status = "active" if sub_status['active'] else "inactive"
-                days = sub_status['days_left'] if sub_status['active'] else 0
-                
-                csv_content += f"{user['user_id']},{user['username']},{user['first_name']},{status},{days}\n"
+            users = await get_users_with_subscription_status()
             
-            # Save to file
-            csv_file = Path("users_export.csv")
-            csv_file.write_text(csv_content, encoding='utf-8')
+            # Create CSV content; csv.writer quotes names containing commas or quotes
+            output = io.StringIO()
+            writer = csv.writer(output, lineterminator='\n')
+            writer.writerow(['user_id', 'username', 'first_name', 'subscription_status', 'days_left'])
+            writer.writerows(
+                (user['user_id'], user['username'], user['first_name'],
+                 "active" if user['active'] else "inactive", user['days_left'])
+                for user in users
+            )
             
-            # Send file
+            # Send file straight from memory
             await bot.send_document(
                 message.from_user.id,
-                FSInputFile(csv_file),
+                BufferedInputFile(output.getvalue().encode('utf-8'), filename="users_export.csv"),
                 caption=f"📊 Экспорт пользователей\n\nВсего: {len(users)}"
             )
             
-            # Delete file
-            csv_file.unlink()
-            
         except Exception as e:
             await message.answer(f"❌ Ошибка: {e}")
     
@@ -3915,14 +4293,18 @@ async def main() -> None:
         try:
             admins = await get_all_admins()
             
-            text = "👮 <b>Список админов</b>\n\n"
+            parts = ["👮 <b>Список админов</b>\n\n"]
             
             for admin in admins:
                 role = "👑 Супер-админ" if admin['is_super_admin'] else "👮 Админ"
-                text += f"{role}\n"
-                text += f"├ ID: <code>{admin['user_id']}</code>\n"
-                text += f"├ Username: @{admin['username']}\n"
-                text += f"└ Добавлен: {admin['created_at'].strftime('%d.%m.%Y')}\n\n"
+                parts.append(
+                    f"{role}\n"
+                    f"├ ID: <code>{admin['user_id']}</code>\n"
+                    f"├ Username: @{admin['username']}\n"
+                    f"└ Добавлен: {admin['created_at'].strftime('%d.%m.%Y')}\n\n"
+                )
+            
+            text = "".join(parts)
             
             await message.answer(text, parse_mode="HTML")
         except Exception as e:
@@ -3954,66 +4336,46 @@ async def main() -> None:
             except Exception as e:
                 print(f"❌ Ошибка отправки уведомления о подключении: {e}")
         else:
+            _connection_owner_cache.pop(connection_id, None)
             print(f"❌ Отключено: {connection_id}")
     
     @dp.business_message()
     async def handle_business_message(message: Message):
-        print("\n" + "="*80)
-        print("📨 BUSINESS MESSAGE EVENT")
-        print("="*80)
-        print(f"📊 Chat ID: {message.chat.id}")
-        print(f"📊 Message ID: {message.message_id}")
-        print(f"📊 From user: {message.from_user.id if message.from_user else 'N/A'} ({message.from_user.first_name if message.from_user else 'N/A'})")
-        print(f"📊 Text: {message.text[:50] if message.text else 'N/A'}...")
-        print(f"📊 Caption: {message.caption[:50] if message.caption else 'N/A'}...")
-        
-        # МЕГА ЛОГИРОВАНИЕ МЕДИА
-        print(f"\n📷 PHOTO: {bool(message.photo)}")
-        if message.photo:
-            print(f"   - Количество размеров: {len(message.photo)}")
-            print(f"   - Последний размер file_id: {message.photo[-1].file_id}")
-            print(f"   - has_media_spoiler: {getattr(message, 'has_media_spoiler', 'N/A')}")
-        
-        print(f"\n🎥 VIDEO: {bool(message.video)}")
-        if message.video:
-            print(f"   - file_id: {message.video.file_id}")
-            print(f"   - has_media_spoiler: {getattr(message, 'has_media_spoiler', 'N/A')}")
-        
-        print(f"\n💬 REPLY_TO_MESSAGE: {bool(message.reply_to_message)}")
-        if message.reply_to_message:
-            print(f"   - Reply message_id: {message.reply_to_message.message_id}")
-            print(f"   - Reply from: {message.reply_to_message.from_user.id if message.reply_to_message.from_user else 'N/A'}")
-            print(f"   - Reply has photo: {bool(message.reply_to_message.photo)}")
-            if message.reply_to_message.photo:
-                print(f"   - Reply photo file_id: {message.reply_to_message.photo[-1].file_id}")
-                print(f"   - Reply has_media_spoiler: {getattr(message.reply_to_message, 'has_media_spoiler', 'N/A')}")
-            print(f"   - Reply has video: {bool(message.reply_to_message.video)}")
-            if message.reply_to_message.video:
-                print(f"   - Reply video file_id: {message.reply_to_message.video.file_id}")
-                print(f"   - Reply has_media_spoiler: {getattr(message.reply_to_message, 'has_media_spoiler', 'N/A')}")
-        
-        print(f"\n📄 Все атрибуты message:")
-        for attr in ['document', 'sticker', 'voice', 'video_note', 'animation', 'audio', 'contact', 'location']:
-            if hasattr(message, attr) and getattr(message, attr):
-                print(f"   - {attr}: {bool(getattr(message, attr))}")
-        
-        print("="*80 + "\n")
+        # Full event dump only when debug logging is on; otherwise this costs one level check
+        if logger.isEnabledFor(logging.DEBUG):
+            reply = message.reply_to_message
+            logger.debug(
+                "📨 BUSINESS MESSAGE chat=%s msg=%s from=%s text=%r caption=%r "
+                "photo=%s video=%s spoiler=%s reply_to=%s reply_from=%s reply_photo=%s reply_video=%s other=%s",
+                message.chat.id,
+                message.message_id,
+                message.from_user.id if message.from_user else None,
+                message.text[:50] if message.text else None,
+                message.caption[:50] if message.caption else None,
+                message.photo[-1].file_id if message.photo else None,
+                message.video.file_id if message.video else None,
+                getattr(message, 'has_media_spoiler', None),
+                reply.message_id if reply else None,
+                reply.from_user.id if reply and reply.from_user else None,
+                reply.photo[-1].file_id if reply and reply.photo else None,
+                reply.video.file_id if reply and reply.video else None,
+                [attr for attr in ('document', 'sticker', 'voice', 'video_note', 'animation', 'audio', 'contact', 'location')
+                 if getattr(message, attr, None)],
+            )
         
         # Get owner from business_connection
         owner_id = None
         if hasattr(message, 'business_connection_id') and message.business_connection_id:
             owner_id = await get_user_by_connection(message.business_connection_id)
-            print(f"🔗 Connection ID: {message.business_connection_id} → Owner: {owner_id}")
+            logger.debug("🔗 Connection ID: %s → Owner: %s", message.business_connection_id, owner_id)
         
         if not owner_id:
-            print(f"⚠️ Owner ID не найден для connection {message.business_connection_id if hasattr(message, 'business_connection_id') else 'N/A'}")
+            logger.warning("⚠️ Owner ID не найден для connection %s", getattr(message, 'business_connection_id', None))
             return
             
         is_auth = await is_user_authenticated(owner_id)
-        print(f"🔐 Авторизован: {is_auth}")
-        
         if not is_auth:
-            print(f"⚠️ Пользователь {owner_id} не авторизован, пропускаю сообщение")
+            logger.debug("⚠️ Пользователь %s не авторизован, пропускаю сообщение", owner_id)
             return
         
         # ===== PRIORITY: View Once media - process BEFORE subscription check =====
@@ -4023,29 +4385,27 @@ async def main() -> None:
             # Отправлять View Once фото от СОБЕСЕДНИКА (не от владельца в исходном сообщении)
             # Владелец МОЖЕТ отвечать на исчезающие фото - это нормально
             if message.reply_to_message.from_user and message.reply_to_message.from_user.id == owner_id:
-                print(f"ℹ️ Это ответ на фото владельца - пропускаю (не исчезающее)")
+                logger.debug("ℹ️ Это ответ на фото владельца - пропускаю (не исчезающее)")
             else:
                 try:
                     orig_msg_id = message.reply_to_message.message_id
                     file_path = f"saved_media/{message.chat.id}_{orig_msg_id}_photo_reply.jpg"
                     
-                    print(f"📸 ОБНАРУЖЕНО исчезающее фото от собеседника! Скачиваю: {file_path}")
+                    logger.info("📸 Исчезающее фото от собеседника, скачиваю: %s", file_path)
                     await bot.download(message.reply_to_message.photo[-1], destination=file_path)
                     
-                    if not Path(file_path).exists():
-                        print(f"❌ Файл не был создан: {file_path}")
+                    if not await asyncio.to_thread(os.path.exists, file_path):
+                        logger.error("❌ Файл не был создан: %s", file_path)
                         return
                     
-                    print(f"✅ Файл сохранён: {file_path}, размер: {Path(file_path).stat().st_size} байт")
-                    
                     user_name = message.reply_to_message.from_user.first_name if message.reply_to_message.from_user else "Unknown"
                     user_username = f" (@{message.reply_to_message.from_user.username})" if message.reply_to_message.from_user and message.reply_to_message.from_user.username else ""
-                    fancy_name = to_fancy(user_name)
-                    header = f"🔒 <b>Исчезающее фото сохранено!</b>\n\n{fancy_name}{user_username} отправил(а) исчезающее фото\n\n@MessageAssistantBot_bot"
+                    header = VIEW_ONCE_CAPTION_TMPL.format_map(
+                        {"kind": "фото", "name": to_fancy_name(user_name), "username": user_username}
+                    )
                     
-                    print(f"📤 Отправляю View Once фото владельцу {owner_id}")
-                    await bot.send_photo(owner_id, FSInputFile(file_path), caption=header, parse_mode="HTML")
-                    print(f"✅ Исчезающее фото успешно отправлено {owner_id}")
+                    await send_limited(bot.send_photo, owner_id, FSInputFile(file_path), caption=header, parse_mode="HTML")
+                    logger.info("✅ Исчезающее фото отправлено %s", owner_id)
                     
                     # Save to DB after successful send
                     await save_message(owner_id, message.chat.id, orig_msg_id,
@@ -4053,37 +4413,33 @@ async def main() -> None:
                                "", media_type="photo_reply", file_path=file_path,
                                caption=message.reply_to_message.caption)
                 except Exception as e:
-                    print(f"❌ Ошибка исчезающего фото: {e}")
-                    import traceback
-                    traceback.print_exc()
+                    logger.exception("❌ Ошибка исчезающего фото: %s", e)
         
         # View Once video via reply - Business API doesn't set has_media_spoiler, so check just for video
         if message.reply_to_message and message.reply_to_message.video:
             # Отправлять View Once видео от СОБЕСЕДНИКА (не от владельца в исходном сообщении)
             if message.reply_to_message.from_user and message.reply_to_message.from_user.id == owner_id:
-                print(f"ℹ️ Это ответ на видео владельца - пропускаю (не исчезающее)")
+                logger.debug("ℹ️ Это ответ на видео владельца - пропускаю (не исчезающее)")
             else:
                 try:
                     orig_msg_id = message.reply_to_message.message_id
                     file_path = f"saved_media/{message.chat.id}_{orig_msg_id}_video_reply.mp4"
                     
-                    print(f"🎥 ОБНАРУЖЕНО исчезающее видео от собеседника! Скачиваю: {file_path}")
+                    logger.info("🎥 Исчезающее видео от собеседника, скачиваю: %s", file_path)
                     await bot.download(message.reply_to_message.video, destination=file_path)
                     
-                    if not Path(file_path).exists():
-                        print(f"❌ Файл не был создан: {file_path}")
+                    if not await asyncio.to_thread(os.path.exists, file_path):
+                        logger.error("❌ Файл не был создан: %s", file_path)
                         return
                     
-                    print(f"✅ Файл сохранён: {file_path}, размер: {Path(file_path).stat().st_size} байт")
-                    
                     user_name = message.reply_to_message.from_user.first_name if message.reply_to_message.from_user else "Unknown"
                     user_username = f" (@{message.reply_to_message.from_user.username})" if message.reply_to_message.from_user and message.reply_to_message.from_user.username else ""
-                    fancy_name = to_fancy(user_name)
-                    header = f"🔒 <b>Исчезающее видео сохранено!</b>\n\n{fancy_name}{user_username} отправил(а) исчезающее видео\n\n@MessageAssistantBot_bot"
+                    header = VIEW_ONCE_CAPTION_TMPL.format_map(
+                        {"kind": "видео", "name": to_fancy_name(user_name), "username": user_username}
+                    )
                     
-                    print(f"📤 Отправляю View Once видео владельцу {owner_id}")
-                    await bot.send_video(owner_id, FSInputFile(file_path), caption=header, parse_mode="HTML")
-                    print(f"✅ Исчезающее видео успешно отправлено {owner_id}")
+                    await send_limited(bot.send_video, owner_id, FSInputFile(file_path), caption=header, parse_mode="HTML")
+                    logger.info("✅ Исчезающее видео отправлено %s", owner_id)
                     
                     # Save to DB after successful send
                     await save_message(owner_id, message.chat.id, orig_msg_id,
@@ -4091,73 +4447,46 @@ async def main() -> None:
                                "", media_type="video_reply", file_path=file_path,
                                caption=message.reply_to_message.caption)
                 except Exception as e:
-                    print(f"❌ Ошибка исчезающего видео: {e}")
-                    import traceback
-                    traceback.print_exc()
-        
-        # ===== NOW check subscription for regular message processing =====
-        sub_status = await check_subscription(owner_id)
-        if not sub_status['active']:
-            print(
-                f"⚠️ У пользователя {owner_id} истекла подписка — сохраняю сообщение для уведомлений без деталей"
-            )
-            # Не блокируем сохранение: так удалённые/изменённые сообщения будут приходить с кнопкой "Посмотреть"
+                    logger.exception("❌ Ошибка исчезающего видео: %s", e)
         
         media_type = None
         file_path = None
         
         try:
-            if message.photo:
-                media_type = "photo"
-                file_path = f"saved_media/{message.chat.id}_{message.message_id}_photo.jpg"
-                await bot.download(message.photo[-1], destination=file_path)
-            elif message.video:
-                media_type = "video"
-                file_path = f"saved_media/{message.chat.id}_{message.message_id}_video.mp4"
-                await bot.download(message.video, destination=file_path)
-            elif message.document:
-                media_type = "document"
-                ext = message.document.file_name.split('.')[-1] if message.document.file_name else "file"
-                file_path = f"saved_media/{message.chat.id}_{message.message_id}_doc.{ext}"
-                await bot.download(message.document, destination=file_path)
-            elif message.sticker:
-                media_type = "sticker"
-                if message.sticker.is_video:
-                    file_path = f"saved_media/{message.chat.id}_{message.message_id}_sticker.webm"
-                elif message.sticker.is_animated:
-                    file_path = f"saved_media/{message.chat.id}_{message.message_id}_sticker.tgs"
-                else:
-                    file_path = f"saved_media/{message.chat.id}_{message.message_id}_sticker.webp"
-                await bot.download(message.sticker, destination=file_path)
-            elif message.voice:
-                media_type = "voice"
-                file_path = f"saved_media/{message.chat.id}_{message.message_id}_voice.ogg"
-                await bot.download(message.voice, destination=file_path)
-            elif message.video_note:
-                media_type = "video_note"
-                file_path = f"saved_media/{message.chat.id}_{message.message_id}_videonote.mp4"
-                await bot.download(message.video_note, destination=file_path)
-            elif message.animation:
-                media_type = "animation"
-                file_path = f"saved_media/{message.chat.id}_{message.message_id}_animation.mp4"
-                await bot.download(message.animation, destination=file_path)
+            for attr, suffix, ext, get in MEDIA_HANDLERS:
+                obj = getattr(message, attr)
+                if not obj:
+                    continue
+                media_type = attr
+                if callable(ext):
+                    ext = ext(obj)
+                file_path = f"saved_media/{message.chat.id}_{message.message_id}_{suffix}.{ext}"
+                await bot.download(get(obj) if get else obj, destination=file_path)
+                break
         except Exception as e:
-            print(f"❌ Ошибка скачивания медиа: {e}")
+            logger.warning("❌ Ошибка скачивания медиа: %s", e)
         
         links = []
         if message.entities:
+            # Entity offsets/lengths are UTF-16 code units; slicing the str directly breaks after emoji
+            text_u16 = message.text.encode("utf-16-le") if message.text else None
             for entity in message.entities:
-                if entity.type in ("url", "text_link"):
-                    if entity.type == "url" and message.text:
-                        links.append(message.text[entity.offset:entity.offset + entity.length])
-                    elif entity.type == "text_link" and entity.url:
-                        links.append(entity.url)
-        
-        await save_message(owner_id, message.chat.id, message.message_id,
-                    message.from_user.id if message.from_user else None,
-                    message.text or "", media_type=media_type, file_path=file_path,
-                    caption=message.caption, links=", ".join(links) if links else None)
-        await increment_stat(owner_id, "total_messages")
+                if entity.type == "url" and text_u16 is not None:
+                    links.append(text_u16[2 * entity.offset:2 * (entity.offset + entity.length)].decode("utf-16-le"))
+                elif entity.type == "text_link" and entity.url:
+                    links.append(entity.url)
+        
+        # One connection for the tail of the handler, taken only after downloads so it isn't held across network I/O
+        async with db_pool.acquire() as conn:
+            sub_status = await check_subscription(owner_id, db=conn)
+            if not sub_status['active']:
+                logger.debug("⚠️ У пользователя %s истекла подписка — сохраняю сообщение для уведомлений без деталей", owner_id)
+                # Не блокируем сохранение: так удалённые/изменённые сообщения будут приходить с кнопкой "Посмотреть"
+            
+            await save_message_and_bump("total_messages", owner_id, message.chat.id, message.message_id,
+                        message.from_user.id if message.from_user else None,
+                        message.text or "", media_type=media_type, file_path=file_path,
+                        caption=message.caption, links=links or None, db=conn)
     
     @dp.edited_business_message()
     async def handle_edited_business_message(message: Message):
@@ -4194,26 +4523,28 @@ async def main() -> None:
             ])
             
             try:
-                await bot.send_message(owner_id, text, parse_mode="HTML", reply_markup=keyboard)
+                await send_limited(bot.send_message, owner_id, text, parse_mode="HTML", reply_markup=keyboard)
                 print(f"✅ EDIT: Отправлено уведомление о необходимости подписки")
             except Exception as e:
                 print(f"❌ EDIT: Ошибка отправки уведомления о подписке: {e}")
             return
         
-        old_data = await get_message_full(owner_id, message.chat.id, message.message_id)
-        old = old_data["text"] if old_data else None
         new = message.text or message.caption or ""
         
-        await save_message(owner_id, message.chat.id, message.message_id,
-                    message.from_user.id if message.from_user else None,
-                    new, caption=message.caption)
-        await increment_stat(owner_id, "total_edits")
+        async with db_pool.acquire() as conn:
+            old_data = await get_message_full(owner_id, message.chat.id, message.message_id, db=conn)
+            old = old_data["text"] if old_data else None
+            
+            await save_message_and_bump("total_edits", owner_id, message.chat.id, message.message_id,
+                        message.from_user.id if message.from_user else None,
+                        new, caption=message.caption, db=conn)
+            
+            # Check subscription status
+            sub_status = await check_subscription(owner_id, db=conn)
         
         user_name = message.from_user.first_name if message.from_user else "Unknown"
         user_username = f" (@{message.from_user.username})" if message.from_user and message.from_user.username else ""
         
-        # Check subscription status
-        sub_status = await check_subscription(owner_id)
         print(f"📊 EDIT: Проверка подписки для owner_id={owner_id}: active={sub_status['active']}, type={sub_status.get('type')}, days_left={sub_status.get('days_left')}")
         
         if sub_status['active']:
@@ -4222,15 +4553,12 @@ async def main() -> None:
             old_formatted = to_fancy(old) if old else '<i>Не найдено</i>'
             new_formatted = to_fancy(new) if new else '<i>Пусто</i>'
             
-            text = (
-                f"{user_name}{user_username} изменил(а) сообщение:\n\n"
-                f"<blockquote>Old:\n{old_formatted}</blockquote>\n\n"
-                f"<blockquote>New:\n{new_formatted}</blockquote>\n\n"
-                f"@MessageAssistantBot_bot"
+            text = EDIT_NOTICE_TMPL.format_map(
+                {"name": user_name, "username": user_username, "old": old_formatted, "new": new_formatted}
             )
             
             try:
-                await bot.send_message(owner_id, text, parse_mode="HTML")
+                await send_limited(bot.send_message, owner_id, text, parse_mode="HTML")
                 print(f"✅ EDIT: Полное уведомление отправлено")
             except Exception as e:
                 print(f"❌ EDIT: Ошибка отправки полного уведомления: {e}")
@@ -4243,41 +4571,62 @@ async def main() -> None:
             ])
             
             try:
-                await bot.send_message(owner_id, text, parse_mode="HTML", reply_markup=keyboard)
+                await send_limited(bot.send_message, owner_id, text, parse_mode="HTML", reply_markup=keyboard)
                 print(f"✅ EDIT: Краткое уведомление отправлено")
             except Exception as e:
                 print(f"❌ EDIT: Ошибка отправки краткого уведомления: {e}")
     
+    async def send_chat_clear_backup(owner_id: int, chat_id: int, chat_name: str, deleted_count: int) -> None:
+        """Build the HTML copy of a cleared chat and send it to the owner"""
+        async with backup_semaphore:
+            print(f"📦 Создаю HTML-копию чата {chat_id}...")
+            html_file = await create_chat_html_backup(owner_id, chat_id, chat_name)
+            
+            if not html_file:
+                print(f"❌ HTML файл не был создан (вернулся None)")
+                return
+            
+            print(f"✅ HTML файл получен: {html_file}")
+            try:
+                print(f"📤 Отправляю HTML файл владельцу {owner_id}...")
+                await send_limited(
+                    bot.send_document,
+                    owner_id,
+                    FSInputFile(html_file),
+                    caption=f"🗑 <b>Весь чат был очищен!</b>\n\n"
+                            f"👤 Чат: {chat_name}\n"
+                            f"📊 Удалено сообщений: {deleted_count}\n\n"
+                            f"📄 HTML-копия чата прикреплена",
+                    parse_mode="HTML"
+                )
+                print(f"✅ HTML-копия отправлена владельцу {owner_id}")
+            except Exception as e:
+                print(f"❌ Ошибка отправки HTML: {e}")
+    
     @dp.deleted_business_messages()
     async def handle_deleted_business_messages(event: BusinessMessagesDeleted):
-        print("\n" + "="*80)
-        print("🗑 DELETED_BUSINESS_MESSAGES EVENT")
-        print("="*80)
-        print(f"📊 Количество удаленных сообщений: {len(event.message_ids)}")
-        print(f"📊 Chat ID: {event.chat.id}")
-        print(f"📊 Message IDs: {event.message_ids}")
-        print(f"📊 Event type: {type(event).__name__}")
-        print(f"📊 Event chat: {event.chat}")
-        print(f"📊 Event chat.type: {event.chat.type if event.chat else 'N/A'}")
-        print(f"📊 Event chat.first_name: {event.chat.first_name if event.chat else 'N/A'}")
-        print(f"📊 Event chat.username: {event.chat.username if event.chat else 'N/A'}")
-        
-        # Логируем все атрибуты event
-        print(f"📊 Все атрибуты event:")
-        for attr in dir(event):
-            if not attr.startswith('_'):
-                try:
-                    value = getattr(event, attr)
-                    if not callable(value):
-                        print(f"   - {attr}: {value}")
-                except:
-                    pass
-        print("="*80)
+        # Only the fields the handler uses; dumping every model attribute via dir() is costly on delete storms
+        logger.debug(
+            "🗑 DELETED_BUSINESS_MESSAGES chat=%s type=%s name=%r username=%s connection=%s ids=%s",
+            event.chat.id,
+            event.chat.type,
+            event.chat.first_name,
+            event.chat.username,
+            event.business_connection_id,
+            event.message_ids,
+        )
         
         # Get owner_id and total messages in this chat
         async with db_pool.acquire() as conn:
+            # Owner and the chat's message count in one round-trip
             first_row = await conn.fetchrow(
-                "SELECT owner_id FROM messages WHERE chat_id = $1 AND message_id = ANY($2) LIMIT 1",
+                """
+                SELECT m.owner_id,
+                       (SELECT COUNT(*) FROM messages c WHERE c.chat_id = $1 AND c.owner_id = m.owner_id) AS total_messages
+                FROM messages m
+                WHERE m.chat_id = $1 AND m.message_id = ANY($2::bigint[])
+                LIMIT 1
+                """,
                 event.chat.id, event.message_ids
             )
             
@@ -4289,33 +4638,37 @@ async def main() -> None:
                 return
             
             owner_id = first_row['owner_id']
+            total_messages = first_row['total_messages']
             print(f"✅ Owner ID найден: {owner_id}")
             
-            # Count total messages in this chat
-            total_messages = await conn.fetchval(
-                "SELECT COUNT(*) FROM messages WHERE chat_id = $1 AND owner_id = $2",
-                event.chat.id, owner_id
+            # All deleted messages in one query instead of a round-trip per id
+            rows = await conn.fetch(
+                """
+                SELECT message_id, user_id, text, caption, links, file_path, media_type
+                FROM messages
+                WHERE owner_id = $1 AND chat_id = $2 AND message_id = ANY($3::bigint[])
+                """,
+                owner_id, event.chat.id, event.message_ids
             )
         
         print(f"📊 Всего сообщений в БД для чата {event.chat.id}: {total_messages}")
         print(f"📊 Удаляется сообщений: {len(event.message_ids)}")
         
         # Track deletions for this chat
-        import time
-        current_time = time.time()
+        current_time = time.monotonic()
         chat_id = event.chat.id
+        deletions = recent_deletions[chat_id]
         
-        if chat_id not in recent_deletions:
-            recent_deletions[chat_id] = []
-        
-        # Clean old deletions (older than 10 seconds)
-        recent_deletions[chat_id] = [(t, c) for t, c in recent_deletions[chat_id] if current_time - t < 10]
+        # Drop deletions older than the window; only expired entries are touched
+        while deletions and current_time - deletions[0][0] >= RECENT_DELETIONS_WINDOW:
+            recent_deletion_totals[chat_id] -= deletions.popleft()[1]
         
         # Add current deletion
-        recent_deletions[chat_id].append((current_time, len(event.message_ids)))
+        deletions.append((current_time, len(event.message_ids)))
+        recent_deletion_totals[chat_id] += len(event.message_ids)
         
-        # Calculate total deletions in last 10 seconds
-        total_recent_deletions = sum(c for _, c in recent_deletions[chat_id])
+        # Total deletions in the last 10 seconds
+        total_recent_deletions = recent_deletion_totals[chat_id]
         
         # Check if this is a full chat clear
         # Conditions:
@@ -4333,55 +4686,45 @@ async def main() -> None:
         print(f"📊 Удалений за последние 10 сек: {total_recent_deletions}")
         print(f"📊 Определено как очистка чата: {is_chat_clear}")
         
+        # The backup runs alongside the notifications; rows are deleted only after it has read them
+        backup_task = None
         if is_chat_clear:
             chat_name = event.chat.first_name or "Unknown" if event.chat else "Unknown"
-            
-            # Create HTML backup before deleting
-            print(f"📦 Создаю HTML-копию чата {event.chat.id}...")
-            html_file = await create_chat_html_backup(owner_id, event.chat.id, chat_name)
-            
-            if html_file:
-                print(f"✅ HTML файл получен: {html_file}")
-                try:
-                    print(f"📤 Отправляю HTML файл владельцу {owner_id}...")
-                    await bot.send_document(
-                        owner_id,
-                        FSInputFile(html_file),
-                        caption=f"🗑 <b>Весь чат был очищен!</b>\n\n"
-                                f"👤 Чат: {chat_name}\n"
-                                f"📊 Удалено сообщений: {len(event.message_ids)}\n\n"
-                                f"📄 HTML-копия чата прикреплена",
-                        parse_mode="HTML"
-                    )
-                    print(f"✅ HTML-копия отправлена владельцу {owner_id}")
-                except Exception as e:
-                    print(f"❌ Ошибка отправки HTML: {e}")
-            else:
-                print(f"❌ HTML файл не был создан (вернулся None)")
+            backup_task = asyncio.create_task(
+                send_chat_clear_backup(owner_id, event.chat.id, chat_name, len(event.message_ids))
+            )
         
+        found_ids = {row["message_id"] for row in rows}
         for msg_id in event.message_ids:
-            async with db_pool.acquire() as conn:
-                row = await conn.fetchrow("SELECT * FROM messages WHERE chat_id = $1 AND message_id = $2", event.chat.id, msg_id)
-                
-                if not row:
-                    print(f"⚠️ Сообщение {msg_id} не найдено в БД")
-                    continue
-                
-                owner_id = row["owner_id"]
-                msg_data = dict(row)
-                
+            if msg_id not in found_ids:
+                print(f"⚠️ Сообщение {msg_id} не найдено в БД")
+        
+        # The owner's own deletions need no notification and go straight to the batched DELETE.
+        # Handled ids are removed with one DELETE at the end, even if notifying stops early.
+        processed_ids = [row["message_id"] for row in rows if row["user_id"] == owner_id]
+        others = [row for row in rows if row["user_id"] != owner_id]
+        notified_count = 0
+        if processed_ids:
+            print(f"ℹ️ Своих сообщений удалено: {len(processed_ids)} - удаляю из БД без уведомления")
+        
+        # The owner is the same for every row: check channel membership and subscription once per event.
+        # Saved media is checked in one worker-thread pass instead of a stat() on the loop per message.
+        is_subscribed, sub_status, existing_files = True, None, set()
+        if others:
+            is_subscribed, sub_status, existing_files = await asyncio.gather(
+                check_channel_subscription(bot, owner_id),
+                check_subscription(owner_id),
+                asyncio.to_thread(_existing_files, [row["file_path"] for row in others if row["file_path"]]),
+            )
+        
+        semaphore = asyncio.Semaphore(DELETE_NOTIFY_CONCURRENCY)
+        
+        async def notify_deleted(msg_id: int, msg_data: asyncpg.Record) -> None:
+            nonlocal notified_count
+            async with semaphore:
                 print(f"📝 Обрабатываю удаление сообщения {msg_id}")
-                print(f"📝 user_id сообщения: {msg_data.get('user_id')}, owner_id: {owner_id}")
-                
-                if msg_data.get("user_id") == owner_id:
-                    print(f"ℹ️ Это твое сообщение - просто удаляю из БД без уведомления")
-                    await delete_message_from_db(owner_id, event.chat.id, msg_id)
-                    continue
-                
-                print(f"🔔 Это сообщение собеседника - отправляю уведомление!")
+                print(f"🔔 Сообщение собеседника {msg_data.get('user_id')} - отправляю уведомление!")
                 
-                # Check channel subscription
-                is_subscribed = await check_channel_subscription(bot, owner_id)
                 if not is_subscribed:
                     print(f"⚠️ DELETE: Пользователь {owner_id} не подписан на канал {REQUIRED_CHANNEL}")
                     user_name = event.chat.first_name or "User" if event.chat else "Unknown"
@@ -4399,21 +4742,19 @@ async def main() -> None:
                     ])
                     
                     try:
-                        await bot.send_message(owner_id, text, parse_mode="HTML", reply_markup=keyboard)
+                        await send_limited(bot.send_message, owner_id, text, parse_mode="HTML", reply_markup=keyboard)
                         print(f"✅ DELETE: Отправлено уведомление о необходимости подписки")
                     except Exception as e:
                         print(f"❌ DELETE: Ошибка отправки уведомления о подписке: {e}")
                     
-                    await delete_message_from_db(owner_id, event.chat.id, msg_id)
-                    continue
+                    processed_ids.append(msg_id)
+                    return
                 
-                await increment_stat(owner_id, "total_deletes")
+                notified_count += 1
                 
                 user_name = event.chat.first_name or "User" if event.chat else "Unknown"
                 user_username = f" (@{event.chat.username})" if event.chat and event.chat.username else ""
                 
-                # Check subscription status
-                sub_status = await check_subscription(owner_id)
                 print(f"📊 DELETE: Проверка подписки для owner_id={owner_id}: active={sub_status['active']}, type={sub_status.get('type')}, days_left={sub_status.get('days_left')}")
                 
                 if not sub_status['active']:
@@ -4425,14 +4766,13 @@ async def main() -> None:
                     ])
                     
                     try:
-                        await bot.send_message(owner_id, text, parse_mode="HTML", reply_markup=keyboard)
+                        await send_limited(bot.send_message, owner_id, text, parse_mode="HTML", reply_markup=keyboard)
                         print(f"✅ DELETE: Краткое уведомление отправлено")
                     except Exception as e:
                         print(f"❌ DELETE: Ошибка отправки краткого уведомления: {e}")
                     
-                    await delete_message_from_db(owner_id, event.chat.id, msg_id)
-                    print(f"🗑️ DELETE: Сообщение {msg_id} удалено из БД")
-                    continue
+                    processed_ids.append(msg_id)
+                    return
                 
                 # Full notification for active subscribers
                 print(f"✅ DELETE: Подписка активна - отправляю полное уведомление")
@@ -4447,48 +4787,68 @@ async def main() -> None:
                     caption_parts.append(f"📝 Подпись: {fancy_caption}")
                 
                 if msg_data.get("links"):
-                    caption_parts.append(f"🔗 Ссылки: {msg_data['links']}")
+                    caption_parts.append(f"🔗 Ссылки: {', '.join(msg_data['links'])}")
                 
                 header = f"{user_name}{user_username} удалил(а) сообщение:\n\n"
                 if caption_parts:
                     header += "<blockquote>" + "\n".join(caption_parts) + "</blockquote>\n\n"
                 header += "@MessageAssistantBot_bot"
                 
-                if msg_data.get("file_path") and Path(msg_data["file_path"]).exists():
+                if msg_data.get("file_path") in existing_files:
                     try:
                         if msg_data["media_type"] in ("photo", "photo_reply"):
                             prefix = "💬 Фото (через ответ)\n" if msg_data["media_type"] == "photo_reply" else ""
-                            await bot.send_photo(owner_id, FSInputFile(msg_data["file_path"]), caption=prefix + header, parse_mode="HTML")
+                            await send_limited(bot.send_photo, owner_id, FSInputFile(msg_data["file_path"]), caption=prefix + header, parse_mode="HTML")
                         elif msg_data["media_type"] in ("video", "video_reply"):
                             prefix = "💬 Видео (через ответ)\n" if msg_data["media_type"] == "video_reply" else ""
-                            await bot.send_video(owner_id, FSInputFile(msg_data["file_path"]), caption=prefix + header, parse_mode="HTML")
+                            await send_limited(bot.send_video, owner_id, FSInputFile(msg_data["file_path"]), caption=prefix + header, parse_mode="HTML")
                         elif msg_data["media_type"] == "document":
-                            await bot.send_document(owner_id, FSInputFile(msg_data["file_path"]), caption=header, parse_mode="HTML")
+                            await send_limited(bot.send_document, owner_id, FSInputFile(msg_data["file_path"]), caption=header, parse_mode="HTML")
                         elif msg_data["media_type"] == "sticker":
-                            await bot.send_message(owner_id, header, parse_mode="HTML")
-                            await bot.send_sticker(owner_id, FSInputFile(msg_data["file_path"]))
+                            await send_limited(bot.send_message, owner_id, header, parse_mode="HTML")
+                            await send_limited(bot.send_sticker, owner_id, FSInputFile(msg_data["file_path"]))
                         elif msg_data["media_type"] == "voice":
-                            await bot.send_voice(owner_id, FSInputFile(msg_data["file_path"]), caption=header, parse_mode="HTML")
+                            await send_limited(bot.send_voice, owner_id, FSInputFile(msg_data["file_path"]), caption=header, parse_mode="HTML")
                         elif msg_data["media_type"] == "video_note":
-                            await bot.send_video_note(owner_id, FSInputFile(msg_data["file_path"]))
-                            await bot.send_message(owner_id, header, parse_mode="HTML")
+                            await send_limited(bot.send_video_note, owner_id, FSInputFile(msg_data["file_path"]))
+                            await send_limited(bot.send_message, owner_id, header, parse_mode="HTML")
                         elif msg_data["media_type"] == "animation":
-                            await bot.send_animation(owner_id, FSInputFile(msg_data["file_path"]), caption=header, parse_mode="HTML")
+                            await send_limited(bot.send_animation, owner_id, FSInputFile(msg_data["file_path"]), caption=header, parse_mode="HTML")
                     except Exception as e:
                         print(f"❌ Ошибка отправки медиа: {e}")
                         try:
-                            await bot.send_message(owner_id, header, parse_mode="HTML")
-                        except:
-                            pass
+                            await send_limited(bot.send_message, owner_id, header, parse_mode="HTML")
+                        except Exception as e:
+                            print(f"❌ DELETE: Ошибка отправки уведомления: {e}")
                 else:
                     if caption_parts:
                         try:
-                            await bot.send_message(owner_id, header, parse_mode="HTML")
-                        except:
-                            pass
+                            await send_limited(bot.send_message, owner_id, header, parse_mode="HTML")
+                        except Exception as e:
+                            print(f"❌ DELETE: Ошибка отправки уведомления: {e}")
                 
-                await delete_message_from_db(owner_id, event.chat.id, msg_id)
-                print(f"🗑️ Сообщение {msg_id} удалено из БД")
+                processed_ids.append(msg_id)
+        
+        try:
+            # Notifications are independent; overlap their Telegram round-trips
+            tasks = [notify_deleted(row["message_id"], row) for row in others]
+            for result in await asyncio.gather(*tasks, return_exceptions=True):
+                if isinstance(result, Exception):
+                    logger.error("❌ Ошибка обработки удалённого сообщения: %s", result)
+        finally:
+            if backup_task:
+                # A failed backup must not skip the DELETE and stats bump below
+                try:
+                    await backup_task
+                except Exception as e:
+                    logger.exception("❌ Ошибка HTML-копии чата %s: %s", event.chat.id, e)
+            # One connection for the event's writes; none is held while notifications are being sent
+            if processed_ids or notified_count:
+                async with db_pool.acquire() as conn:
+                    await delete_messages_from_db(owner_id, event.chat.id, processed_ids, db=conn)
+                    if notified_count:
+                        await increment_stat(owner_id, "total_deletes", notified_count, db=conn)
+                print(f"🗑️ Удалено из БД сообщений: {len(processed_ids)}")
     
     print("=" * 60)
     print("MessageAssistant Multi-User Bot (PostgreSQL)")
@@ -4500,10 +4860,12 @@ async def main() -> None:
     print("Бот готов! Напишите /start для авторизации")
     print("=" * 60)
     
+    _log_listener.start()
     try:
         await dp.start_polling(bot)
     finally:
         await close_db()
+        _log_listener.stop()
 
 
 if __name__ == "__main__":
@@ -5,6 +5,8 @@ PostgreSQL database for scalability
 """
 
 import asyncio
+import hashlib
+import hmac
 import os
 import re
 from pathlib import Path
@@ -19,6 +21,8 @@ load_dotenv()
 # Environment variables
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 BOT_PASSWORD = os.getenv("BOT_PASSWORD", "12391")
+# Password digest is computed once; attempts are compared in constant time
+_BOT_PASSWORD_DIGEST = hashlib.blake2b(BOT_PASSWORD.encode(), digest_size=16).digest()
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
 
 # PostgreSQL connection
@@ -52,7 +56,10 @@ async def init_db():
         user=DB_USER,
         password=DB_PASSWORD,
         min_size=5,
-        max_size=20
+        max_size=20,
+        # asyncpg prepares every query per connection; keep all of ours cached for good
+        statement_cache_size=1024,
+        max_cached_statement_lifetime=0
     )
     print("✅ PostgreSQL connection pool created")
 
@@ -65,6 +72,12 @@ async def close_db():
         print("✅ PostgreSQL connection pool closed")
 
 
+def check_password(attempt: str) -> bool:
+    """Compare password attempt against BOT_PASSWORD in constant time"""
+    digest = hashlib.blake2b(attempt.encode(), digest_size=16).digest()
+    return hmac.compare_digest(digest, _BOT_PASSWORD_DIGEST)
+
+
 async def is_user_authenticated(user_id: int) -> bool:
     """Check if user is authenticated"""
     async with db_pool.acquire() as conn:
@@ -102,24 +115,19 @@ async def authenticate_user(user_id: int, username: str, first_name: str):
 async def record_failed_login(user_id: int, username: str, first_name: str) -> int:
     """Record failed login attempt and return total attempts"""
     async with db_pool.acquire() as conn:
-        # Get current attempts count
-        attempts = await conn.fetchval(
-            "SELECT attempts_count FROM failed_logins WHERE user_id = $1 ORDER BY attempt_time DESC LIMIT 1",
-            user_id
-        )
-        
-        if attempts is None:
-            attempts = 0
-        
-        new_attempts = attempts + 1
-        
-        # Record new attempt
-        await conn.execute(
-            "INSERT INTO failed_logins (user_id, username, first_name, attempts_count) VALUES ($1, $2, $3, $4)",
-            user_id, username, first_name, new_attempts
+        return await conn.fetchval(
+            """
+            INSERT INTO failed_logins (user_id, username, first_name, attempts_count)
+            VALUES ($1, $2, $3, 1)
+            ON CONFLICT (user_id) DO UPDATE SET
+                attempts_count = failed_logins.attempts_count + 1,
+                attempt_time = NOW(),
+                username = EXCLUDED.username,
+                first_name = EXCLUDED.first_name
+            RETURNING attempts_count
+            """,
+            user_id, username, first_name
         )
-        
-        return new_attempts
 
 
 async def ban_user(user_id: int, username: str, first_name: str):
@@ -127,21 +135,19 @@ async def ban_user(user_id: int, username: str, first_name: str):
     async with db_pool.acquire() as conn:
         await conn.execute(
             """
-            INSERT INTO banned_users (user_id, username, first_name)
-            VALUES ($1, $2, $3)
-            ON CONFLICT (user_id) DO NOTHING
+            WITH banned AS (
+                INSERT INTO banned_users (user_id, username, first_name)
+                VALUES ($1, $2, $3)
+                ON CONFLICT (user_id) DO NOTHING
+            )
+            UPDATE users SET is_banned = TRUE WHERE user_id = $1
             """,
             user_id, username, first_name
         )
-        
-        await conn.execute(
-            "UPDATE users SET is_banned = TRUE WHERE user_id = $1",
-            user_id
-        )
 
 
 async def save_message(owner_id: int, chat_id: int, message_id: int, user_id: int, text: str,
-                      media_type: str = None, file_path: str = None, caption: str = None, links: str = None):
+                      media_type: str = None, file_path: str = None, caption: str = None, links: list = None):
     """Save message to database"""
     async with db_pool.acquire() as conn:
         await conn.execute(
@@ -163,7 +169,7 @@ async def get_message_full(owner_id: int, chat_id: int, message_id: int):
             owner_id, chat_id, message_id
         )
         if row:
-            return dict(row)
+            return row
         return None
 
 
@@ -233,7 +239,7 @@ async def get_banned_users():
         rows = await conn.fetch(
             "SELECT user_id, username, first_name, reason, banned_at FROM banned_users ORDER BY banned_at DESC"
         )
-        return [dict(row) for row in rows]
+        return rows
 
 
 async def get_failed_logins():
@@ -248,19 +254,22 @@ async def get_failed_logins():
             LIMIT 50
             """
         )
-        return [dict(row) for row in rows]
+        return rows
 
 
 # ============================================================
 # UTILITY FUNCTIONS
 # ============================================================
 
+_FANCY_TABLE = str.maketrans(
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz",
+    "𝗔𝗕𝗖𝗗𝗘𝗙𝗚𝗛𝗜𝗝𝗞𝗟𝗠𝗡𝗢𝗣𝗤𝗥𝗦𝗧𝗨𝗩𝗪𝗫𝗬𝗭𝗮𝗯𝗰𝗱𝗲𝗳𝗴𝗵𝗶𝗷𝗸𝗹𝗺𝗻𝗼𝗽𝗾𝗿𝘀𝘁𝘂𝘃𝘄𝘅𝘆𝘇"
+)
+
+
 def to_fancy(text: str) -> str:
     """Convert text to fancy Unicode font"""
-    normal = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
-    fancy = "𝗔𝗕𝗖𝗗𝗘𝗙𝗚𝗛𝗜𝗝𝗞𝗟𝗠𝗡𝗢𝗣𝗤𝗥𝗦𝗧𝗨𝗩𝗪𝗫𝗬𝗭𝗮𝗯𝗰𝗱𝗲𝗳𝗴𝗵𝗶𝗷𝗸𝗹𝗺𝗻𝗼𝗽𝗾𝗿𝘀𝘁𝘂𝘃𝘄𝘅𝘆𝘇"
-    trans = str.maketrans(normal, fancy)
-    return text.translate(trans)
+    return text.translate(_FANCY_TABLE)
 
 
 # ============================================================
@@ -334,7 +343,7 @@ async def main():
             return
         
         # Check password
-        if message.text == BOT_PASSWORD:
+        if check_password(message.text):
             await authenticate_user(user_id, username, first_name)
             await message.answer(
                 "✅ <b>Авторизация успешна!</b>\n\n"
@@ -632,12 +641,13 @@ async def main():
         # Extract links
         links = []
         if message.entities:
+            # Entity offsets/lengths are UTF-16 code units; slicing the str directly breaks after emoji
+            text_u16 = message.text.encode("utf-16-le") if message.text else None
             for entity in message.entities:
-                if entity.type in ("url", "text_link"):
-                    if entity.type == "url" and message.text:
-                        links.append(message.text[entity.offset:entity.offset + entity.length])
-                    elif entity.type == "text_link" and entity.url:
-                        links.append(entity.url)
+                if entity.type == "url" and text_u16 is not None:
+                    links.append(text_u16[2 * entity.offset:2 * (entity.offset + entity.length)].decode("utf-16-le"))
+                elif entity.type == "text_link" and entity.url:
+                    links.append(entity.url)
         
         await save_message(
             owner_id,
@@ -648,7 +658,7 @@ async def main():
             media_type=media_type,
             file_path=file_path,
             caption=message.caption,
-            links=", ".join(links) if links else None
+            links=links or None
         )
         await increment_stat(owner_id, "total_messages")
     
@@ -720,7 +730,7 @@ async def main():
                 if not row:
                     continue
                 
-                msg_data = dict(row)
+                msg_data = row
                 owner_id = msg_data["owner_id"]
                 
                 print(f"📦 Данные сообщения {msg_id}: owner={owner_id}, media={msg_data.get('media_type')}")
@@ -750,7 +760,7 @@ async def main():
                     caption_parts.append(f"📝 Подпись: {msg_data['caption']}")
                 
                 if msg_data.get("links"):
-                    caption_parts.append(f"🔗 Ссылки: {msg_data['links']}")
+                    caption_parts.append(f"🔗 Ссылки: {', '.join(msg_data['links'])}")
                 
                 header = f"{fancy_name}{user_username} удалил(а) сообщение:\n\n"
                 if caption_parts:
@@ -11,6 +11,7 @@ CREATE TABLE IF NOT EXISTS users (
     first_name VARCHAR(255),
     is_authenticated BOOLEAN DEFAULT FALSE,
     is_banned BOOLEAN DEFAULT FALSE,
+    blocked BOOLEAN DEFAULT FALSE, -- пользователь заблокировал бота (выставляется при рассылке)
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     last_login TIMESTAMP
 );
@@ -18,7 +19,7 @@ CREATE TABLE IF NOT EXISTS users (
 -- Таблица неудачных попыток входа
 CREATE TABLE IF NOT EXISTS failed_logins (
     id SERIAL PRIMARY KEY,
-    user_id BIGINT NOT NULL,
+    user_id BIGINT NOT NULL UNIQUE,
     username VARCHAR(255),
     first_name VARCHAR(255),
     attempt_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -45,7 +46,7 @@ CREATE TABLE IF NOT EXISTS messages (
     media_type VARCHAR(50),
     file_path TEXT,
     caption TEXT,
-    links TEXT,
+    links TEXT[],
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     UNIQUE(owner_id, chat_id, message_id)
 );
@@ -62,8 +63,12 @@ CREATE TABLE IF NOT EXISTS stats (
 -- Индексы для быстрого поиска
 CREATE INDEX IF NOT EXISTS idx_messages_owner_chat ON messages(owner_id, chat_id);
 CREATE INDEX IF NOT EXISTS idx_messages_lookup ON messages(owner_id, chat_id, message_id);
+CREATE INDEX IF NOT EXISTS idx_messages_owner_chat_time ON messages(owner_id, chat_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_messages_owner_chat_user ON messages(owner_id, chat_id, user_id);
+CREATE INDEX IF NOT EXISTS idx_messages_links ON messages USING GIN (links);
 CREATE INDEX IF NOT EXISTS idx_failed_logins_user ON failed_logins(user_id);
 CREATE INDEX IF NOT EXISTS idx_users_auth ON users(user_id, is_authenticated);
+CREATE INDEX IF NOT EXISTS idx_users_authenticated ON users(user_id) WHERE is_authenticated;
 
 -- Функция для автоматической очистки старых неудачных попыток (старше 24 часов)
 CREATE OR REPLACE FUNCTION cleanup_old_failed_logins()
@@ -109,6 +114,9 @@ CREATE TABLE IF NOT EXISTS payment_history (
 CREATE INDEX IF NOT EXISTS idx_business_connections_user ON business_connections(user_id);
 CREATE INDEX IF NOT EXISTS idx_subscriptions_active ON subscriptions(user_id, is_active);
 CREATE INDEX IF NOT EXISTS idx_payment_history_user ON payment_history(user_id);
+CREATE INDEX IF NOT EXISTS idx_payment_history_completed ON payment_history(created_at) WHERE status = 'completed';
+CREATE INDEX IF NOT EXISTS idx_payment_history_user_time ON payment_history(user_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_subscriptions_active_type ON subscriptions(subscription_type) WHERE is_active;
 
 COMMENT ON TABLE users IS 'Зарегистрированные пользователи бота';
 COMMENT ON TABLE failed_logins IS 'История неудачных попыток входа';